@@ -1,13 +1,24 @@
-from django.contrib import admin
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.http import HttpResponseRedirect
 from django.contrib.auth.admin import UserAdmin
 from django.utils.html import escape, mark_safe
 
 
 from .models import *
+from . import enriquiment, prestecs
 
 class CategoriaAdmin(admin.ModelAdmin):
-	list_display = ('nom','parent')
-	ordering = ('parent','nom')
+	list_display = ('nom_arbre','parent')
+	list_select_related = ('parent',)
+	# el camí materialitzat ordena cada categoria just darrere del seu pare
+	ordering = ('cami',)
+	search_fields = ('nom',)
+	@admin.display(description='Nom', ordering='cami')
+	def nom_arbre(self,obj):
+		return "— " * obj.nivell + obj.nom
 
 
 class UsuariAdmin(UserAdmin):
@@ -28,6 +39,10 @@ class UsuariAdmin(UserAdmin):
     # Mostramos el campo 'telefon' en la lista de usuarios
     list_display = UserAdmin.list_display + ('telefon',)
 
+    # Búsqueda por prefijo: puede usar los índices (también en el autocompletado de préstecs/reserves)
+    search_fields = ('^username', '^email', '^first_name', '^last_name')
+    show_full_result_count = False
+
 class ExemplarsInline(admin.TabularInline):
 	model = Exemplar
 	extra = 1
@@ -40,8 +55,28 @@ class LlibreAdmin(admin.ModelAdmin):
 	search_fields = ('titol','autor','CDU','signatura','ISBN','editorial','colleccio')
 	list_display = ('titol','autor','editorial','num_exemplars')
 	readonly_fields = ('thumb',)
+	show_full_result_count = False
+	actions = ('enriqueix_openlibrary',)
+	@admin.action(description="Completa les dades buides des d'OpenLibrary")
+	def enriqueix_openlibrary(self,request,queryset):
+		# es fa dins la petició: una selecció gran la deixaria penjada (i el worker HTTP ocupat)
+		maxim = getattr(settings, "ENRIQUIMENT_MAXIM_ADMIN", 100)
+		seleccionats = queryset.count()
+		if seleccionats > maxim:
+			self.message_user(request, "Heu seleccionat {} llibres i l'acció n'admet {} com a màxim. "
+				"Per a més llibres feu servir la comanda ./manage.py enriqueix_llibres".format(
+				seleccionats, maxim), messages.ERROR)
+			return
+		enriquidor = enriquiment.Enriquidor().enriqueix(queryset)
+		self.message_user(request, "{} llibres actualitzats ({} trobats a OpenLibrary)".format(
+			enriquidor.actualitzats, enriquidor.trobats))
+		if enriquidor.errors:
+			self.message_user(request, "No s'ha pogut consultar OpenLibrary per a {} ISBN".format(
+				len(enriquidor.errors)), messages.WARNING)
+	@admin.display(description='Exemplars', ordering='exemplars_total')
 	def num_exemplars(self,obj):
-		return obj.exemplar_set.count()
+		# comptador desnormalitzat: cap consulta per fila
+		return obj.exemplars_total
 	def thumb(self,obj):
 		return mark_safe("<img src='{}' />".format(escape(obj.thumbnail_url)))
 	thumb.allow_tags = True
@@ -55,18 +90,95 @@ admin.site.register(Revista)
 admin.site.register(Dispositiu)
 admin.site.register(Imatge)
 
+class ExemplarAdmin(admin.ModelAdmin):
+    list_display = ('registre', 'cataleg', 'exclos_prestec', 'baixa')
+    list_select_related = ('cataleg',)
+    list_filter = ('baixa', 'exclos_prestec')
+    # cerca per prefix del registre (codi de barres) o del títol, tots dos indexats
+    search_fields = ('^registre', '^cataleg__titol')
+    ordering = ('registre',)
+    raw_id_fields = ('cataleg',)
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # també l'usa l'autocompletat: __str__ llegeix cataleg.titol
+        return super().get_queryset(request).select_related('cataleg')
+
 class PrestecAdmin(admin.ModelAdmin):
-    readonly_fields = ('data_prestec',)
-    fields = ('exemplar','usuari','data_prestec','data_retorn','anotacions')
-    list_display = ('exemplar','usuari','data_prestec','data_retorn')
+    readonly_fields = ('data_prestec', 'vencut')
+    fields = ('exemplar','usuari','data_prestec','data_venciment','data_retorn','vencut','anotacions')
+    list_display = ('exemplar','usuari','data_prestec','data_venciment','data_retorn','vencut')
+    list_filter = ('vencut',)
+    list_select_related = ('exemplar__cataleg', 'usuari')
+    autocomplete_fields = ('exemplar', 'usuari')
+    show_full_result_count = False
+
+class ReservaForm(forms.ModelForm):
+    class Meta:
+        model = Reserva
+        fields = ('cataleg', 'usuari')
+
+    def clean(self):
+        dades = super().clean()
+        cataleg, usuari = dades.get('cataleg'), dades.get('usuari')
+        if cataleg and usuari:
+            if not cataleg.exemplars_prestables:
+                raise ValidationError("El registre no té exemplars prestables")
+            if Reserva.objects.filter(usuari=usuari, cataleg=cataleg, estat__in=Reserva.ESTATS_ACTIUS).exists():
+                raise ValidationError("L'usuari ja té una reserva activa d'aquest registre")
+        return dades
 
 class ReservaAdmin(admin.ModelAdmin):
-    readonly_fields = ('data',)
-    fields = ('exemplar', 'usuari', 'data')
-    list_display = ('exemplar', 'usuari', 'data')
+    form = ReservaForm
+    # la cua (torns, exemplar apartat) la mantenen les operacions de prestecs.py
+    readonly_fields = ('estat', 'posicio', 'exemplar', 'data', 'data_assignacio', 'data_limit')
+    fields = ('cataleg', 'usuari', 'estat', 'posicio', 'exemplar', 'data', 'data_assignacio', 'data_limit')
+    list_display = ('cataleg', 'usuari', 'estat', 'posicio', 'exemplar', 'data', 'data_limit')
+    list_filter = ('estat',)
+    list_select_related = ('cataleg', 'exemplar__cataleg', 'usuari')
+    autocomplete_fields = ('usuari',)
+    raw_id_fields = ('cataleg',)
+    show_full_result_count = False
+
+    def has_change_permission(self, request, obj=None):
+        # només es poden crear (entren a la cua) o esborrar (surten de la cua)
+        return obj is None and super().has_change_permission(request, obj)
+
+    def save_model(self, request, obj, form, change):
+        # entra a la cua (o se li aparta un exemplar lliure)
+        try:
+            obj.pk = prestecs.reserva(obj.usuari_id, obj.cataleg_id).pk
+        except prestecs.ErrorPrestec as e:
+            # el formulari ja ho comprova, però una altra petició s'hi pot haver avançat
+            self.message_user(request, e.missatge, messages.ERROR)
+
+    def log_addition(self, request, obj, message):
+        if obj.pk is not None:
+            return super().log_addition(request, obj, message)
+
+    def response_add(self, request, obj, post_url_continue=None):
+        if obj.pk is None:
+            # no s'ha creat: de nou al formulari, amb l'error
+            return HttpResponseRedirect(request.get_full_path())
+        return super().response_add(request, obj, post_url_continue)
+
+    def delete_model(self, request, obj):
+        if obj.estat in Reserva.ESTATS_ACTIUS:
+            try:
+                prestecs.cancella(obj.pk)
+            except prestecs.ErrorPrestec:
+                # ja no era activa (servida, caducada o esborrada per una altra petició)
+                pass
+            obj.refresh_from_db()
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.delete_model(request, obj)
 
 admin.site.register(Centre)
 admin.site.register(Cicle)
+admin.site.register(Exemplar, ExemplarAdmin)
 admin.site.register(Reserva, ReservaAdmin)
 admin.site.register(Prestec,PrestecAdmin)
 admin.site.register(Peticio)
@@ -1,26 +1,42 @@
 from django.contrib.auth import authenticate
 from ninja import NinjaAPI, Schema
 from ninja.security import HttpBasicAuth, HttpBearer
+from ninja.errors import HttpError
 from .models import *
 from typing import List, Optional, Union, Literal, Dict
+from datetime import date, time
 import secrets
 from ninja import NinjaAPI, Router
 from ninja.files import UploadedFile
 from .models import Usuari, Centre, Cicle 
 import csv
+import io
 import os
 import re
 import traceback
 from django.conf import settings
 from django.core.files.storage import default_storage
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.core.exceptions import ValidationError 
+from .paginacio import pagina_keyset, resposta_ndjson, codifica_cursor, descodifica_cursor, LIMIT_PER_DEFECTE, ORDENACIONS
+from . import cerca, prestecs
+from .importacio import ImportadorUsuarios, es_utf8
+from .importacio_cataleg import ImportadorCataleg, files_csv, files_ndjson, TIPUS as TIPUS_IMPORTACIO
+from . import marc
+from .autenticacio import cache_tokens, emet_token_signat, verifica_token_signat, revocacions, UsuariDiferit
+from . import instrumentacio, metriques
+from .versio import condicional
+from .respostes import en_cache
+from .sortida import columnes_esquema, directa, files_esquema, llista_parametre, resposta_directa
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.db.models import F, Subquery
 #from somewhere import UploadResponse
 
 
 
 
-api = NinjaAPI()
+api = NinjaAPI(renderer=instrumentacio.RendererInstrumentat())
 
 # Crear un Router específico para el endpoint de subida de documentos
 
@@ -66,22 +82,45 @@ class UploadResponse(Schema):
 class BasicAuth(HttpBasicAuth):
     def authenticate(self, request, username, password):
         user = authenticate(username=username, password=password)
+        metriques.autenticacio("basic", user is not None)
         if user:
+            if settings.API_TOKEN_MODE == "signat":
+                # token signat: no cal escriure res a la BD
+                return emet_token_signat(user)
             # Genera un token simple
             token = secrets.token_hex(16)
             user.auth_token = token
-            user.save()
+            user.save(update_fields=["auth_token"])
             return token
         return None
 
 # Autenticació per Token Bearer
 class AuthBearer(HttpBearer):
     def authenticate(self, request, token):
-        try:
-            user = Usuari.objects.get(auth_token=token)
-            return user
-        except Usuari.DoesNotExist:
-            return None
+        if ":" in token:
+            # token signat: es verifica sense consultar la BD, i l'usuari
+            # només es carrega si la vista el fa servir
+            info = verifica_token_signat(token)
+            metriques.autenticacio("bearer_signat", info is not None)
+            if info is None:
+                return None
+            request.token = info
+            return UsuariDiferit(lambda: Usuari.objects.get(pk=info.usuari_id))
+        user = cache_tokens.obte(token)
+        if user is None:
+            user = Usuari.objects.filter(auth_token=token, is_active=True).first()
+            if user is None:
+                metriques.autenticacio("bearer_bd", False)
+                return None
+            cache_tokens.desa(token, user)
+        metriques.autenticacio("bearer_bd", True)
+        return user
+
+def es_bibliotecari(request):
+    info = getattr(request, "token", None)
+    if info is not None:
+        return "bibliotecari" in info.permisos
+    return request.auth.is_staff
 
 # Endpoint per obtenir un token
 @api.get("/token", auth=BasicAuth())
@@ -89,6 +128,52 @@ class AuthBearer(HttpBearer):
 def obtenir_token(request):
     return {"token": request.auth}
 
+class EstadistiquesCacheTokens(Schema):
+    entrades: int
+    encerts: int
+    errades: int
+    invalidacions: int
+    taxa_encert: float
+
+@api.get("/token/cache", response=EstadistiquesCacheTokens, auth=AuthBearer())
+def estadistiques_cache_tokens(request):
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    return cache_tokens.estadistiques()
+
+@api.get("/instrumentacio", response=Dict[str, Dict], auth=AuthBearer())
+def estadistiques_instrumentacio(request, buida: bool = False):
+    # resum per endpoint de les peticions mesurades per InstrumentacioSQL (d'aquest procés)
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    estadistiques = instrumentacio.resum.estadistiques()
+    if buida:
+        instrumentacio.resum.buida()
+    return estadistiques
+
+@api.post("/logout", auth=AuthBearer())
+@api.post("/logout/", auth=AuthBearer())
+def logout(request):
+    info = getattr(request, "token", None)
+    if info is not None:
+        revocacions.revoca(info)
+    else:
+        request.auth.auth_token = None
+        request.auth.save(update_fields=["auth_token"])
+    return {"ok": True}
+
+@api.post("/usuaris/{usuari_id}/revoca-tokens", auth=AuthBearer())
+def revoca_tokens(request, usuari_id: int):
+    # caducitat forçada de totes les sessions d'un usuari
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    usuari = get_object_or_404(Usuari, pk=usuari_id)
+    revocacions.revoca_usuari(usuari.pk)
+    if usuari.auth_token:
+        usuari.auth_token = None
+        usuari.save(update_fields=["auth_token"])
+    return {"ok": True}
+
 
 
 
@@ -120,33 +205,156 @@ class CatalegOut(Schema):
     id: int
     titol: str
     autor: Optional[str]
+    exemplars_total: int
+    exemplars_actius: int
+    exemplars_prestables: int
+    exemplars_prestats: int
+    exemplars_reservats: int
+    exemplars_disponibles: int
+
+# Camps de CatalegOut que no són columnes (per a la sortida directa, amb .values())
+CALCULATS_CATALEG = {
+    "exemplars_disponibles": lambda fila: max(fila["exemplars_prestables"] - fila["exemplars_prestats"], 0),
+}
 
 class LlibreOut(CatalegOut):
     editorial: Optional[str]
     ISBN: Optional[str]
 
+class RevistaOut(CatalegOut):
+    ISSN: Optional[str]
+    editorial: Optional[str]
+    lloc: Optional[str]
+    numero: Optional[int]
+    volums: Optional[int]
+    pagines: Optional[int]
+
+class CDOut(CatalegOut):
+    discografica: str
+    estil: str
+    duracio: time
+
+class DVDOut(CatalegOut):
+    productora: str
+    duracio: time
+
+class BROut(CatalegOut):
+    productora: str
+    duracio: time
+
+class DispositiuOut(CatalegOut):
+    marca: str
+    model: Optional[str]
+
+# Subtipus de Cataleg amb el seu esquema de sortida, en l'ordre en què es resolen
+TIPUS_CATALEG = (
+    ("llibre", Llibre, LlibreOut),
+    ("revista", Revista, RevistaOut),
+    ("cd", CD, CDOut),
+    ("dvd", DVD, DVDOut),
+    ("br", BR, BROut),
+    ("dispositiu", Dispositiu, DispositiuOut),
+)
+
 class ExemplarOut(Schema):
     id: int
-    registre: str
+    registre: Optional[str]
     exclos_prestec: bool
     baixa: bool
-    cataleg: Union[LlibreOut,CatalegOut]
+    cataleg: Union[LlibreOut,RevistaOut,CDOut,DVDOut,BROut,DispositiuOut,CatalegOut]
     tipus: str
 
 class LlibreIn(Schema):
     titol: str
     editorial: str
 
-
-
-
-
-@api.get("/llibres", response=List[LlibreOut])
-@api.get("/llibres/", response=List[LlibreOut])
+class PaginaLlibres(Schema):
+    items: List[LlibreOut]
+    next: Optional[str] = None
+
+
+
+
+
+def filtra_categoria(qs, categoria, descendants=False):
+    if categoria is None:
+        return qs
+    if not descendants:
+        return qs.filter(tags=categoria)
+    # tot el subarbre amb una sola consulta: categories el camí de les quals
+    # comença pel de la categoria demanada
+    cami = Categoria.objects.filter(pk=categoria).values("cami")[:1]
+    etiquetes = Cataleg.tags.through.objects.filter(categoria__cami__startswith=Subquery(cami))
+    return qs.filter(pk__in=etiquetes.values("cataleg_id"))
+
+
+# Relacions que es poden afegir als llibres amb ?expand=
+EXPANSIONS_LLIBRE = ("pais", "llengua", "tags")
+
+def etiquetes_catalegs(ids):
+    """{cataleg_id: [{"id", "nom"}, ...]} amb una sola consulta."""
+    etiquetes = {}
+    files = (Cataleg.tags.through.objects.filter(cataleg_id__in=ids)
+             .values_list("cataleg_id", "categoria_id", "categoria__nom").order_by("categoria_id"))
+    for cataleg_id, categoria_id, nom in files:
+        etiquetes.setdefault(cataleg_id, []).append({"id": categoria_id, "nom": nom})
+    return etiquetes
+
+def files_llibres(files, camps, expansions):
+    """Files de sortida amb els `camps` demanats i les relacions de `expansions`."""
+    sortida = files_esquema(files, LlibreOut, CALCULATS_CATALEG, camps)
+    if "tags" in expansions:
+        etiquetes = etiquetes_catalegs([fila["id"] for fila in files])
+    for fila, item in zip(files, sortida):
+        for relacio in ("pais", "llengua"):
+            if relacio in expansions:
+                pk = fila[f"{relacio}_id"]
+                item[relacio] = {"id": pk, "nom": fila[f"{relacio}__nom"]} if pk is not None else None
+        if "tags" in expansions:
+            item["tags"] = etiquetes.get(fila["id"], [])
+    return sortida
+
+# Sense paginació és una llista, com sempre (el frontend l'espera així); amb
+# paginat, cursor o limit són pàgines {items, next}
+@api.get("/llibres", response=Union[List[LlibreOut], PaginaLlibres])
+@api.get("/llibres/", response=Union[List[LlibreOut], PaginaLlibres])
 #@api.get("/llibres/", response=List[LlibreOut], auth=AuthBearer())
-def get_llibres(request):
-    qs = Llibre.objects.all()
-    return qs
+@condicional
+@en_cache
+def get_llibres(request, paginat: bool = False, cursor: str = None, limit: int = None,
+                ordre: Literal["id", "titol"] = "id",
+                format: Literal["json", "ndjson"] = "json",
+                categoria: int = None, descendants: bool = False,
+                fields: str = None, expand: str = None):
+    qs = filtra_categoria(Llibre.objects.all(), categoria, descendants)
+    camps = llista_parametre(fields, LlibreOut.model_fields, "fields") or list(LlibreOut.model_fields)
+    expansions = llista_parametre(expand, EXPANSIONS_LLIBRE, "expand")
+    # amb fields/expand la resposta no té la forma de LlibreOut: sempre sortida directa
+    sortida_directa = directa() or bool(fields) or bool(expansions)
+    if sortida_directa:
+        # només les columnes demanades (i les que calen per ordenar i calcular)
+        necessaries = ("id", "titol", "exemplars_prestables", "exemplars_prestats")
+        for relacio in ("pais", "llengua"):
+            if relacio in expansions:
+                # un JOIN a la mateixa consulta
+                necessaries += (f"{relacio}_id", f"{relacio}__nom")
+        qs = qs.values(*columnes_esquema(LlibreOut, CALCULATS_CATALEG, necessaries, camps))
+        serialitza = lambda files: files_llibres(files, camps, expansions)
+    else:
+        serialitza = lambda llibres: [LlibreOut.from_orm(llibre).dict() for llibre in llibres]
+    if format == "ndjson":
+        # tot el catàleg en streaming, una línia JSON per llibre
+        return resposta_ndjson(qs.order_by("id"), serialitza)
+    if not (paginat or cursor or limit is not None):
+        files = list(qs.order_by(*ORDENACIONS[ordre]))
+        if sortida_directa:
+            return resposta_directa(files_llibres(files, camps, expansions))
+        return serialitza(files)
+    # paginació per cursor: el cost de cada pàgina no depèn de la seva profunditat
+    items, seguent = pagina_keyset(qs, ordre, cursor, LIMIT_PER_DEFECTE if limit is None else limit)
+    if sortida_directa:
+        return resposta_directa({"items": files_llibres(items, camps, expansions), "next": seguent})
+    return {"items": items, "next": seguent}
 
 @api.post("/llibres/")
 def post_llibres(request, payload: LlibreIn):
@@ -156,171 +364,411 @@ def post_llibres(request, payload: LlibreIn):
         "titol": llibre.titol
     }
 
+class ErrorImportacioCataleg(Schema):
+    linia: int
+    error: str
+    fila: dict
+
+class ResultatImportacioCataleg(Schema):
+    files: int
+    creats: int
+    actualitzats: int
+    exemplars: int
+    errors: List[ErrorImportacioCataleg]
+
+@api.post("/cataleg/importa", response=ResultatImportacioCataleg, auth=AuthBearer())
+@api.post("/cataleg/importa/", response=ResultatImportacioCataleg, auth=AuthBearer())
+def importa_cataleg(request, fitxer: UploadedFile,
+                    tipus: Literal[tuple(TIPUS_IMPORTACIO)] = "llibre",
+                    format: Literal["ndjson", "csv"] = "ndjson"):
+    # càrrega massiva (NDJSON o CSV) de qualsevol subtipus; vegeu importacio_cataleg.py
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    text = io.TextIOWrapper(fitxer.file, encoding="utf-8-sig", newline="")
+    files = files_csv(text) if format == "csv" else files_ndjson(text)
+    importador = ImportadorCataleg(tipus)
+    try:
+        importador.procesa(files)
+    except UnicodeDecodeError:
+        raise HttpError(400, "El fitxer no és UTF-8")
+    finally:
+        importador.finalitza()
+    return {
+        "files": importador.files,
+        "creats": importador.creats,
+        "actualitzats": importador.actualitzats,
+        "exemplars": importador.exemplars,
+        "errors": importador.errors,
+    }
+
+class ResultatImportacioMARC(Schema):
+    registres: int
+    creats: int
+    actualitzats: int
+    exemplars: int
+    per_tipus: Dict[str, Dict[str, int]]
+    # d'on reprendre-la (des_de) si s'ha interromput
+    posicio: int
+    errors: List[ErrorImportacioCataleg]
+
+@api.post("/cataleg/importa-marc", response=ResultatImportacioMARC, auth=AuthBearer())
+@api.post("/cataleg/importa-marc/", response=ResultatImportacioMARC, auth=AuthBearer())
+def importa_marc(request, fitxer: UploadedFile,
+                 format: Literal["auto", "iso2709", "marcxml"] = "auto", des_de: int = 0):
+    # registres MARC21 amb els seus exemplars; vegeu marc.py
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    importador = marc.ImportadorMARC()
+    try:
+        importador.procesa(marc.lector(fitxer.file, format, max(des_de, 0)))
+    finally:
+        importador.finalitza()
+    return {
+        "registres": importador.registres,
+        "creats": importador.creats,
+        "actualitzats": importador.actualitzats,
+        "exemplars": importador.exemplars,
+        "per_tipus": importador.per_tipus(),
+        "posicio": importador.posicio,
+        "errors": importador.errors,
+    }
+
+def carrega_catalegs(ids):
+    """
+    Retorna {id: (tipus, esquema)} per als catàlegs indicats, amb una sola
+    consulta IN per subtipus en lloc d'un JOIN amb totes les taules filles.
+    """
+    pendents = set(ids)
+    resultat = {}
+    for tipus, model, esquema in TIPUS_CATALEG:
+        if not pendents:
+            break
+        for pk, obj in model.objects.in_bulk(pendents).items():
+            resultat[pk] = (tipus, esquema.from_orm(obj))
+        pendents.difference_update(resultat)
+    if pendents:
+        # catàlegs sense cap subtipus conegut
+        for pk, obj in Cataleg.objects.in_bulk(pendents).items():
+            resultat[pk] = ("indefinit", CatalegOut.from_orm(obj))
+    return resultat
+
+
+def files_catalegs(ids, subconsulta):
+    """
+    Com carrega_catalegs però amb dicts de .values(), per a la sortida
+    directa. `subconsulta` selecciona els mateixos `ids` dins la BD: una
+    sola consulta per subtipus, sense llistes IN enormes.
+    """
+    resultat = {}
+    for tipus, model, esquema in TIPUS_CATALEG:
+        files = model.objects.filter(pk__in=subconsulta).values(*columnes_esquema(esquema, CALCULATS_CATALEG))
+        for fila in files_esquema(files, esquema, CALCULATS_CATALEG):
+            resultat[fila["id"]] = (tipus, fila)
+    # catàlegs sense cap subtipus conegut
+    pendents = sorted(set(ids) - set(resultat))
+    columnes = columnes_esquema(CatalegOut, CALCULATS_CATALEG)
+    for i in range(0, len(pendents), 500):
+        files = Cataleg.objects.filter(pk__in=pendents[i:i + 500]).values(*columnes)
+        for fila in files_esquema(files, CatalegOut, CALCULATS_CATALEG):
+            resultat[fila["id"]] = ("indefinit", fila)
+    return resultat
+
+
 @api.get("/exemplars", response=List[ExemplarOut])
 @api.get("/exemplars/", response=List[ExemplarOut])
+@condicional
+@en_cache
 def get_exemplars(request):
-    # carreguem objectes amb els proxy models relacionats exactes
-    exemplars = Exemplar.objects.select_related(
-        "cataleg__llibre",
-        "cataleg__revista",
-        "cataleg__cd",
-        "cataleg__dvd",
-        "cataleg__br",
-        "cataleg__dispositiu",
-    ).all()
-    result = []
+    exemplars = list(Exemplar.objects.values(
+        "id", "registre", "exclos_prestec", "baixa", "cataleg_id"
+    ).order_by("id"))
+    if directa():
+        catalegs = files_catalegs((e["cataleg_id"] for e in exemplars), Exemplar.objects.values("cataleg_id"))
+        result = []
+        for exemplar in exemplars:
+            tipus, cataleg = catalegs[exemplar.pop("cataleg_id")]
+            result.append({**exemplar, "cataleg": cataleg, "tipus": tipus})
+        return resposta_directa(result)
+    catalegs = carrega_catalegs(e["cataleg_id"] for e in exemplars)
 
+    result = []
     for exemplar in exemplars:
-        cataleg_instance = exemplar.cataleg
-
-        # Determinar el tipus de l'objecte Cataleg
-        if hasattr(cataleg_instance, "llibre"):
-            cataleg_schema = LlibreOut.from_orm(cataleg_instance.llibre)
-            tipus = "llibre"
-        #elif hasattr(cataleg_instance, "dispositiu"):
-        #    cataleg_schema = LlibreOut.from_orm(cataleg_instance.dispositiu)
-        # TODO: afegir altres esquemes
-        else:
-            cataleg_schema = CatalegOut.from_orm(cataleg_instance)
-            tipus = "indefinit"
-
-        # Afegir l'Exemplar amb el Cataleg serialitzat
-        result.append(
-            ExemplarOut(
-                id=exemplar.id,
-                registre=exemplar.registre,
-                exclos_prestec=exemplar.exclos_prestec,
-                baixa=exemplar.baixa,
-                cataleg=cataleg_schema,
-                tipus=tipus,
-            )
-        )
-
+        tipus, cataleg_schema = catalegs[exemplar.pop("cataleg_id")]
+        result.append(ExemplarOut(**exemplar, cataleg=cataleg_schema, tipus=tipus))
     return result
 
 
-# Crear un Router específico para el endpoint de subida de documentos
-router = Router()
+class ResultatCerca(CatalegOut):
+    puntuacio: float
+
+class PaginaCerca(Schema):
+    items: List[ResultatCerca]
+    next: Optional[str] = None
+
+@api.get("/cerca", response=PaginaCerca)
+@api.get("/cerca/", response=PaginaCerca)
+@condicional
+@en_cache
+def get_cerca(request, q: str, cursor: str = None, limit: int = 20):
+    limit = max(1, min(limit, 100))
+    offset = descodifica_cursor(cursor, 1)[0] if cursor else 0
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise HttpError(400, "Cursor no vàlid")
+    resultats, hi_ha_mes = cerca.cerca(q, offset, limit)
+    catalegs = Cataleg.objects.defer("resum", "anotacions").in_bulk([pk for pk, _ in resultats])
+    items = [
+        ResultatCerca(**CatalegOut.from_orm(catalegs[pk]).dict(), puntuacio=puntuacio)
+        for pk, puntuacio in resultats if pk in catalegs
+    ]
+    seguent = codifica_cursor([offset + limit]) if hi_ha_mes else None
+    return {"items": items, "next": seguent}
+
+
+class PrestecIn(Schema):
+    registre: Optional[str] = None
+    exemplar: Optional[int] = None
+    usuari: Optional[int] = None
+    username: Optional[str] = None
+    anotacions: Optional[str] = None
+
+class RetornIn(Schema):
+    registre: Optional[str] = None
+    exemplar: Optional[int] = None
+
+class PrestecOut(Schema):
+    id: int
+    exemplar: int
+    registre: Optional[str] = None
+    usuari: int
+    data_prestec: date
+    data_venciment: Optional[date] = None
+    data_retorn: Optional[date] = None
+    # en el retorn: reserva per a la qual ha quedat apartat l'exemplar
+    reserva_assignada: Optional[int] = None
+
+def prestec_out(prestec):
+    reserva = getattr(prestec, "reserva_assignada", None)
+    return PrestecOut(
+        id=prestec.pk, exemplar=prestec.exemplar_id, registre=prestec.exemplar.registre,
+        usuari=prestec.usuari_id, data_prestec=prestec.data_prestec,
+        data_venciment=prestec.data_venciment, data_retorn=prestec.data_retorn,
+        reserva_assignada=reserva.pk if reserva else None,
+    )
 
-# Función para validar si el nombre contiene solo letras
-def validar_nombre(nombre):
-    if not re.match(r'^[A-Za-záéíóúÁÉÍÓÚñÑ]+$', nombre):
-        raise ValidationError(f"El nombre '{nombre}' contiene caracteres no válidos.")
+@api.post("/prestecs/checkout", response={201: PrestecOut}, auth=AuthBearer())
+@api.post("/prestecs/checkout/", response={201: PrestecOut}, auth=AuthBearer())
+def checkout(request, payload: PrestecIn):
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    try:
+        prestec = prestecs.checkout(payload.registre, payload.exemplar, payload.usuari,
+                                    payload.username, payload.anotacions)
+    except prestecs.ErrorPrestec as e:
+        raise HttpError(e.estat, e.missatge)
+    return 201, prestec_out(prestec)
+
+@api.post("/prestecs/checkin", response=PrestecOut, auth=AuthBearer())
+@api.post("/prestecs/checkin/", response=PrestecOut, auth=AuthBearer())
+def checkin(request, payload: RetornIn):
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    try:
+        prestec = prestecs.checkin(payload.registre, payload.exemplar)
+    except prestecs.ErrorPrestec as e:
+        raise HttpError(e.estat, e.missatge)
+    return prestec_out(prestec)
 
-# Función para validar si el teléfono contiene solo números
-def validar_telefono(telefono):
-    if not telefono.isdigit():
-        raise ValidationError(f"El teléfono '{telefono}' debe contener solo números.")
 
+class PrestecVencutOut(Schema):
+    id: int
+    exemplar: int
+    registre: Optional[str] = None
+    titol: str
+    usuari: int
+    username: str
+    email: Optional[str] = None
+    data_prestec: date
+    data_venciment: date
+    dies_retard: int
+
+class PaginaPrestecsVencuts(Schema):
+    items: List[PrestecVencutOut]
+    next: Optional[str] = None
+
+ORDENACIO_VENCUTS = {"venciment": ("data_venciment", "id")}
+
+@api.get("/prestecs/vencuts", response=PaginaPrestecsVencuts, auth=AuthBearer())
+@api.get("/prestecs/vencuts/", response=PaginaPrestecsVencuts, auth=AuthBearer())
+def get_prestecs_vencuts(request, cursor: str = None, limit: int = LIMIT_PER_DEFECTE):
+    if not es_bibliotecari(request):
+        raise HttpError(403, "Només per a bibliotecaris")
+    avui = timezone.localdate()
+    # préstecs oberts amb el venciment passat, recorreguts per l'índex prestec_obert_venc_idx
+    qs = Prestec.objects.filter(data_retorn__isnull=True, data_venciment__lt=avui).values(
+        "id", "exemplar_id", "usuari_id", "data_prestec", "data_venciment",
+        registre=F("exemplar__registre"), titol=F("exemplar__cataleg__titol"),
+        username=F("usuari__username"), email=F("usuari__email"),
+    )
+    files, seguent = pagina_keyset(qs, "venciment", cursor, limit, ORDENACIO_VENCUTS)
+    for fila in files:
+        fila["exemplar"] = fila.pop("exemplar_id")
+        fila["usuari"] = fila.pop("usuari_id")
+        fila["dies_retard"] = (avui - fila["data_venciment"]).days
+    return {"items": files, "next": seguent}
+
+def usuari_peticio(request):
+    # amb token signat no cal carregar l'usuari
+    info = getattr(request, "token", None)
+    return info.usuari_id if info is not None else request.auth.pk
+
+class ReservaIn(Schema):
+    cataleg: int
+
+class ReservaOut(Schema):
+    id: int
+    cataleg: int
+    titol: str
+    estat: str
+    # lloc a la cua (1 = el següent); null si ja té un exemplar apartat
+    posicio: Optional[int] = None
+    registre: Optional[str] = None
+    data: date
+    data_limit: Optional[date] = None
+
+def reserva_out(reserva):
+    return ReservaOut(
+        id=reserva.pk, cataleg=reserva.cataleg_id, titol=reserva.cataleg.titol, estat=reserva.estat,
+        posicio=prestecs.posicio_cua(reserva),
+        registre=reserva.exemplar.registre if reserva.exemplar_id else None,
+        data=reserva.data, data_limit=reserva.data_limit,
+    )
 
-@router.post("/subir-documento/", response={200: UploadResponse, 500: UploadResponse})
-def subir_documento(request, archivo: UploadedFile):
-    print("Recibiendo archivo...")
-    file_path = default_storage.save(f"temp/{archivo.name}", archivo)
-    full_path = os.path.join(settings.MEDIA_ROOT, file_path)
+def reserves_amb_cua():
+    return Reserva.objects.select_related("cataleg", "exemplar").only(
+        "id", "cataleg_id", "estat", "posicio", "data", "data_limit", "exemplar_id",
+        "cataleg__titol", "cataleg__cua_inici", "exemplar__registre",
+    )
+
+@api.get("/reserves", response=List[ReservaOut], auth=AuthBearer())
+@api.get("/reserves/", response=List[ReservaOut], auth=AuthBearer())
+def get_reserves(request):
+    # el lloc a la cua surt dels torns desats: una sola consulta, sense comptar files
+    reserves = reserves_amb_cua().filter(
+        usuari_id=usuari_peticio(request), estat__in=Reserva.ESTATS_ACTIUS
+    ).order_by("data", "id")
+    return [reserva_out(r) for r in reserves]
+
+@api.post("/reserves", response={201: ReservaOut}, auth=AuthBearer())
+@api.post("/reserves/", response={201: ReservaOut}, auth=AuthBearer())
+def post_reserves(request, payload: ReservaIn):
+    try:
+        reserva = prestecs.reserva(usuari_peticio(request), payload.cataleg)
+    except prestecs.ErrorPrestec as e:
+        raise HttpError(e.estat, e.missatge)
+    return 201, reserva_out(reserves_amb_cua().get(pk=reserva.pk))
+
+@api.delete("/reserves/{reserva_id}", response=ReservaOut, auth=AuthBearer())
+def delete_reserva(request, reserva_id: int):
+    propietari = Reserva.objects.filter(pk=reserva_id).values_list("usuari_id", flat=True).first()
+    if propietari is None:
+        raise HttpError(404, "Reserva inexistent")
+    if propietari != usuari_peticio(request) and not es_bibliotecari(request):
+        raise HttpError(403, "No pots cancel·lar la reserva d'un altre usuari")
+    try:
+        prestecs.cancella(reserva_id)
+    except prestecs.ErrorPrestec as e:
+        raise HttpError(e.estat, e.missatge)
+    return reserva_out(reserves_amb_cua().get(pk=reserva_id))
+
+
+# Crear un Router específico para el endpoint de subida de documentos
+router = Router()
 
-    registros: List[UsuariCSV] = []
-    errores: List[Dict] = []
-    usuarios_creados = 0
+class ImportacioCreada(Schema):
+    id: int
+    estat: str
 
 
+@router.post("/subir-documento/", response={200: UploadResponse, 202: ImportacioCreada, 500: UploadResponse})
+def subir_documento(request, archivo: UploadedFile, asincron: bool = False):
+    print("Recibiendo archivo...")
+    if asincron:
+        # l'estat (/imports/{id}) només el veuen qui l'ha pujada i els bibliotecaris:
+        # cal el token per saber qui la puja
+        request.auth = AuthBearer()(request)
+        if request.auth is None:
+            raise HttpError(401, "Unauthorized")
+        # el worker (manage.py importacions_worker) la processarà en segon pla;
+        # el fitxer va a default_storage, no a la BD
+        if not es_utf8(archivo):
+            return 500, UploadResponse(mensaje="Error interno del servidor.", error="El archivo no está en UTF-8.")
+        importacio = ImportacioCSV.objects.create(
+            usuari_id=usuari_peticio(request),
+            nom_fitxer=archivo.name,
+            fitxer=archivo,
+        )
+        return 202, {"id": importacio.pk, "estat": importacio.estat}
+
+    importador = ImportadorUsuarios()
 
     try:
-        print("Abriendo archivo CSV...")
-        with open(full_path, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                print(f"Procesando fila: {row}")
-                cleaned_row = {key.strip(): (value.strip() if value is not None else "") for key, value in row.items()}
-
-
-                if not any(cleaned_row.values()):
-                    continue
-
-                email = (cleaned_row.get("email") or "").strip().replace(' ', '').lower()
-
-
-                if not email:
-                    errores.append({"fila": cleaned_row, "error": "Email vacío"})
-                    continue
-
-                if Usuari.objects.filter(username=email).exists():
-                    errores.append({"fila": cleaned_row, "error": f"El email {email} ya existe."})
-                    continue
-
-                nom = (cleaned_row.get("nom") or "").strip()
-                cognom1 = (cleaned_row.get("cognom1") or "").strip()
-                cognom2 = (cleaned_row.get("cognom2") or "").strip()
-                telefon = cleaned_row.get("telefon", "")
-                centre_nom = cleaned_row.get("centre", "")
-                cicle_nom = cleaned_row.get("grup", "")
-
-                if not all([nom, cognom1, cognom2, telefon, centre_nom, cicle_nom]):
-                    errores.append({"fila": cleaned_row, "error": "Faltan campos obligatorios."})
-                    continue
-
-                try:
-                    validar_nombre(nom)
-                    validar_nombre(cognom1)
-                    if cognom2:
-                        validar_nombre(cognom2)
-                    validar_telefono(telefon)
-                    validar_email(email) 
-
-                    centre, _ = Centre.objects.get_or_create(nom=centre_nom)
-                    cicle, _ = Cicle.objects.get_or_create(nom=cicle_nom)
-
-                    Usuari.objects.create_user(
-                        username=email,
-                        email=email,
-                        first_name=nom,
-                        last_name=f"{cognom1} {cognom2}",
-                        telefon=telefon,
-                        centre=centre,
-                        cicle=cicle,
-                        password="1234"
-                    )
-                    usuarios_creados += 1
-
-                    registros.append(UsuariCSV(
-                        nom=nom,
-                        cognom1=cognom1,
-                        cognom2=cognom2,
-                        email=email,
-                        telefon=telefon,
-                        centre=centre_nom,
-                        grup=cicle_nom
-                    ))
-
-                except ValidationError as e:
-                    print(f"Error al procesar el CSV: {str(e)}")
-                    errores.append({"fila": cleaned_row, "error": str(e)})
-                    continue
+        # llegim l'arxiu pujat directament, sense desar-lo abans a MEDIA_ROOT
+        f = io.TextIOWrapper(archivo.file, encoding='utf-8', newline='')
+        importador.procesa(csv.DictReader(f))
 
     except Exception as e:
         print("🔥 Error procesando CSV:", e)
         traceback.print_exc()
         return JsonResponse({"mensaje": "Error interno del servidor."}, status=500)
 
-    finally:
-        try:
-            os.remove(full_path)
-        except:
-            pass
-    print(f"Usuarios creados: {usuarios_creados}")
+    print(f"Usuarios creados: {importador.usuarios_creados}")
     return 200, UploadResponse(
-        mensaje=f"✅ Archivo procesado. Usuarios creados: {usuarios_creados}",
-        registros=registros,
-        errores=errores if errores else None
+        mensaje=f"✅ Archivo procesado. Usuarios creados: {importador.usuarios_creados}",
+        registros=importador.registros,
+        errores=importador.errores if importador.errores else None
     )
 
 
-def validar_email(email):
-    # Expresión regular para un email válido (básico)
-    email_regex = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
-    if not re.match(email_regex, email):
-        raise ValidationError(f"El email '{email}' no tiene un formato válido.")
+class EstatImportacio(Schema):
+    id: int
+    nom_fitxer: str
+    estat: str
+    files_processades: int
+    usuaris_creats: int
+    files_per_segon: Optional[float] = None
+    errores: List[FilaError]
+    resultat: Optional[UploadResponse] = None
+
+
+@router.get("/imports/{importacio_id}", response=EstatImportacio, auth=AuthBearer())
+@router.get("/imports/{importacio_id}/", response=EstatImportacio, auth=AuthBearer())
+def estat_importacio(request, importacio_id: int):
+    # els errors porten files senceres del CSV (noms, correus, telèfons): només
+    # les veuen els bibliotecaris i qui ha pujat el fitxer; als altres, 404
+    importacio = get_object_or_404(ImportacioCSV, pk=importacio_id)
+    if importacio.usuari_id != usuari_peticio(request) and not es_bibliotecari(request):
+        raise Http404
+    files_per_segon = None
+    if importacio.data_inici:
+        segons = ((importacio.data_fi or timezone.now()) - importacio.data_inici).total_seconds()
+        if segons > 0:
+            files_per_segon = importacio.files_processades / segons
+    return {
+        "id": importacio.pk,
+        "nom_fitxer": importacio.nom_fitxer,
+        "estat": importacio.estat,
+        "files_processades": importacio.files_processades,
+        "usuaris_creats": importacio.usuaris_creats,
+        "files_per_segon": files_per_segon,
+        "errores": importacio.errors,
+        "resultat": importacio.resultat,
+    }
+
 
 # Registrar el router con el api
 #api.add_router("/api/", router)
 api.add_router("/", router)
+
+# cal fer-ho quan ja hi són totes les operacions
+instrumentacio.instrumenta_api(api)
+metriques.instrumenta_api(api)
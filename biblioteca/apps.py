@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class BibliotecaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'biblioteca'
\ No newline at end of file
+    name = 'biblioteca'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,213 @@
+"""
+Tokens de l'API.
+
+Memòria cau en procés dels tokens guardats a la BD (token -> usuari).
+
+Amb la memòria cau calenta, validar un token Bearer no fa cap consulta.
+Les entrades caduquen després d'AUTH_TOKEN_CACHE_TTL segons i, com a
+molt, se'n guarden AUTH_TOKEN_CACHE_MIDA (les menys usades surten primer).
+Quan es desa o s'esborra un usuari (canvi de token, baixa...) se
+n'invaliden les entrades des de signals.py. Cada procés té la seva
+pròpia memòria cau: el TTL limita el temps que un altre procés pot
+seguir acceptant un token que ja ha canviat.
+
+Tokens signats (API_TOKEN_MODE = "signat"): el token porta l'usuari,
+el moment d'emissió i els permisos, signats amb SECRET_KEY, i es
+verifica sense llegir la BD. Per tancar sessions abans que caduquin hi
+ha una llista de revocació (RevocacioToken) que cada procés manté en
+memòria i refresca cada API_TOKEN_REFRESC_REVOCACIONS segons.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, NamedTuple
+
+from django.conf import settings
+from django.core import signing
+from django.utils.functional import SimpleLazyObject
+
+
+class CacheTokens:
+    def __init__(self, mida=10000, ttl=300):
+        self.mida = mida
+        self.ttl = ttl
+        self._entrades = OrderedDict()
+        self._per_usuari = {}
+        self._lock = threading.Lock()
+        self.encerts = 0
+        self.errades = 0
+        self.invalidacions = 0
+
+    def obte(self, token):
+        with self._lock:
+            entrada = self._entrades.get(token)
+            if entrada is None or entrada[1] < time.monotonic():
+                if entrada is not None:
+                    self._treu(token)
+                self.errades += 1
+                return None
+            self._entrades.move_to_end(token)
+            self.encerts += 1
+            return entrada[0]
+
+    def desa(self, token, usuari):
+        with self._lock:
+            if token in self._entrades:
+                self._treu(token)
+            self._entrades[token] = (usuari, time.monotonic() + self.ttl)
+            self._per_usuari.setdefault(usuari.pk, set()).add(token)
+            while len(self._entrades) > self.mida:
+                self._treu(next(iter(self._entrades)))
+
+    def invalida_usuari(self, usuari_id):
+        with self._lock:
+            for token in self._per_usuari.pop(usuari_id, ()):
+                if self._entrades.pop(token, None) is not None:
+                    self.invalidacions += 1
+
+    def buida(self):
+        with self._lock:
+            self._entrades.clear()
+            self._per_usuari.clear()
+
+    def _treu(self, token):
+        usuari, _ = self._entrades.pop(token)
+        tokens = self._per_usuari.get(usuari.pk)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._per_usuari[usuari.pk]
+
+    def estadistiques(self):
+        with self._lock:
+            consultes = self.encerts + self.errades
+            return {
+                "entrades": len(self._entrades),
+                "encerts": self.encerts,
+                "errades": self.errades,
+                "invalidacions": self.invalidacions,
+                "taxa_encert": self.encerts / consultes if consultes else 0.0,
+            }
+
+
+cache_tokens = CacheTokens(
+    mida=getattr(settings, "AUTH_TOKEN_CACHE_MIDA", 10000),
+    ttl=getattr(settings, "AUTH_TOKEN_CACHE_TTL", 300),
+)
+
+
+# Tokens signats
+
+SALT_TOKEN = "biblioteca.api.token"
+
+
+class InfoToken(NamedTuple):
+    usuari_id: int
+    emes: float
+    permisos: List[str]
+    jti: str
+
+
+def durada_token():
+    return getattr(settings, "API_TOKEN_DURADA", 8 * 3600)
+
+
+def permisos_usuari(usuari):
+    permisos = ["lectura"]
+    if usuari.is_staff:
+        permisos.append("bibliotecari")
+    return permisos
+
+
+def emet_token_signat(usuari):
+    dades = {
+        "u": usuari.pk,
+        # amb decimals: un token emès just després d'una revocació, encara que
+        # sigui dins del mateix segon, no hi ha de quedar inclòs
+        "iat": time.time(),
+        "s": permisos_usuari(usuari),
+        "j": secrets.token_hex(8),
+    }
+    return signing.dumps(dades, salt=SALT_TOKEN, compress=True)
+
+
+def verifica_token_signat(token):
+    try:
+        dades = signing.loads(token, salt=SALT_TOKEN, max_age=durada_token())
+    except signing.BadSignature:
+        return None
+    info = InfoToken(dades["u"], dades["iat"], dades["s"], dades["j"])
+    if revocacions.revocat(info):
+        return None
+    return info
+
+
+class UsuariDiferit(SimpleLazyObject):
+    """
+    Usuari d'un token signat que només es llegeix de la BD si la vista el
+    fa servir. Ninja comprova la veracitat del resultat de l'autenticació,
+    i això no ha de forçar la consulta.
+    """
+    def __bool__(self):
+        return True
+
+
+class LlistaRevocacio:
+    """
+    Còpia en memòria de les revocacions vigents. Només inclou les que
+    encara no han caducat, de manera que es manté petita.
+    """
+    def __init__(self, refresc=30):
+        self.refresc = refresc
+        self._jtis = set()
+        self._talls = {}
+        self._carregada = None
+        self._lock = threading.Lock()
+
+    def revocat(self, info):
+        self._refresca()
+        return info.jti in self._jtis or info.emes <= self._talls.get(info.usuari_id, 0)
+
+    def _refresca(self):
+        if self._carregada is not None and time.monotonic() - self._carregada < self.refresc:
+            return
+        from .models import RevocacioToken
+        with self._lock:
+            jtis, talls = set(), {}
+            vigents = RevocacioToken.objects.filter(expira__gt=datetime.now(timezone.utc))
+            for jti, usuari_id, fins_a in vigents.values_list("jti", "usuari_id", "emesos_fins_a"):
+                if jti:
+                    jtis.add(jti)
+                else:
+                    talls[usuari_id] = fins_a
+            self._jtis, self._talls = jtis, talls
+            self._carregada = time.monotonic()
+
+    def revoca(self, info):
+        # logout: només aquest token
+        from .models import RevocacioToken
+        expira = datetime.fromtimestamp(info.emes + durada_token(), timezone.utc)
+        RevocacioToken.objects.get_or_create(jti=info.jti, defaults={"expira": expira})
+        with self._lock:
+            self._jtis.add(info.jti)
+        self.purga()
+
+    def revoca_usuari(self, usuari_id):
+        # caducitat forçada: tots els tokens de l'usuari emesos fins ara
+        from .models import RevocacioToken
+        ara = time.time()
+        expira = datetime.fromtimestamp(ara + durada_token(), timezone.utc)
+        RevocacioToken.objects.update_or_create(
+            usuari_id=usuari_id, defaults={"emesos_fins_a": ara, "expira": expira}
+        )
+        with self._lock:
+            self._talls[usuari_id] = ara
+
+    def purga(self):
+        from .models import RevocacioToken
+        RevocacioToken.objects.filter(expira__lte=datetime.now(timezone.utc)).delete()
+
+
+revocacions = LlistaRevocacio(getattr(settings, "API_TOKEN_REFRESC_REVOCACIONS", 30))
@@ -0,0 +1,291 @@
+"""
+Cerca al catàleg amb un índex invertit propi (TermeCerca / PostingCerca).
+
+Els textos es normalitzen plegant accents i majúscules, de manera que
+"Col·lecció", "colleccio" i "COL.LECCIÓ" donen el mateix terme. Els
+resultats s'ordenen amb BM25. Cada posting guarda ja el seu pes BM25 i
+l'índex (terme, -pes) permet llegir només els documents més rellevants
+de cada terme, de manera que una consulta no recorre tota la llista de
+documents d'un terme freqüent.
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Count, F
+
+from .models import Cataleg, DocumentCerca, PostingCerca, TermeCerca
+
+
+# Camps indexats i el seu pes dins del document
+CAMPS = {
+    "titol": 3,
+    "titol_original": 2,
+    "autor": 2,
+    "resum": 1,
+    "CDU": 1,
+    "signatura": 1,
+    "ISBN": 1,
+}
+# Camps identificadors: també s'indexen sencers, sense separadors
+CAMPS_CODI = ("CDU", "signatura", "ISBN")
+
+PARAULES_BUIDES = {
+    # català
+    "de", "del", "dels", "la", "les", "el", "els", "en", "i", "a", "al", "als",
+    "per", "amb", "un", "una", "uns", "unes", "que", "o", "es", "se", "lo",
+    # castellà
+    "y", "los", "las", "con", "por", "para", "una", "e", "u",
+}
+
+K1 = 1.2
+B = 0.75
+MAX_CANDIDATS = 1000
+LLARGADA_TERME = 100
+CLAU_ESTADISTIQUES = "cerca:estadistiques"
+
+
+def normalitza(text):
+    text = text.lower()
+    # punt volat: col·lecció, col.lecció -> colleccio
+    text = re.sub(r"l[·.•]l", "ll", text)
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokens(text):
+    if not text:
+        return []
+    return [
+        t[:LLARGADA_TERME]
+        for t in re.findall(r"[a-z0-9]+", normalitza(text))
+        if t not in PARAULES_BUIDES and (len(t) > 1 or t.isdigit())
+    ]
+
+
+def codi_compacte(text):
+    if not text:
+        return None
+    codi = re.sub(r"[^a-z0-9]", "", normalitza(text))
+    return codi[:LLARGADA_TERME] or None
+
+
+def termes_document(valors):
+    """Retorna (Counter de freqüències ponderades, longitud) d'un document."""
+    frequencies = Counter()
+    for camp, pes in CAMPS.items():
+        text = valors.get(camp)
+        for t in tokens(text):
+            frequencies[t] += pes
+        if camp in CAMPS_CODI:
+            codi = codi_compacte(text)
+            if codi:
+                frequencies[codi] += pes
+    return frequencies, sum(frequencies.values())
+
+
+def valors_cataleg(cataleg):
+    return {camp: getattr(cataleg, camp, None) for camp in CAMPS}
+
+
+def termes_consulta(text):
+    termes = set(tokens(text))
+    for tros in (text or "").split():
+        if any(c.isdigit() for c in tros):
+            codi = codi_compacte(tros)
+            if codi:
+                termes.add(codi)
+    return termes
+
+
+def pes_bm25(frequencia, longitud, mitjana):
+    return frequencia * (K1 + 1) / (frequencia + K1 * (1 - B + B * longitud / mitjana))
+
+
+def idf(documents, total):
+    return math.log(1 + (total - documents + 0.5) / (documents + 0.5))
+
+
+def estadistiques():
+    """(nombre de documents, longitud mitjana), en memòria cau una estona."""
+    stats = cache.get(CLAU_ESTADISTIQUES)
+    if stats is None:
+        agregat = DocumentCerca.objects.aggregate(total=Count("pk"), mitjana=Avg("longitud"))
+        stats = (agregat["total"] or 0, agregat["mitjana"] or 1.0)
+        cache.set(CLAU_ESTADISTIQUES, stats, 600)
+    return stats
+
+
+def indexacio_automatica():
+    return getattr(settings, "CERCA_INDEXACIO_AUTOMATICA", True)
+
+
+@transaction.atomic
+def desindexa(cataleg_id):
+    termes = PostingCerca.objects.filter(cataleg_id=cataleg_id).values("terme_id")
+    TermeCerca.objects.filter(pk__in=termes).update(documents=F("documents") - 1)
+    PostingCerca.objects.filter(cataleg_id=cataleg_id).delete()
+    DocumentCerca.objects.filter(cataleg_id=cataleg_id).delete()
+
+
+@transaction.atomic
+def indexa(cataleg):
+    """Actualitza l'índex d'un sol registre del catàleg (des dels senyals)."""
+    desindexa(cataleg.pk)
+    frequencies, longitud = termes_document(valors_cataleg(cataleg))
+    DocumentCerca.objects.create(cataleg_id=cataleg.pk, longitud=longitud)
+    if not frequencies:
+        return
+    ids = ids_termes(frequencies)
+    TermeCerca.objects.filter(pk__in=ids.values()).update(documents=F("documents") + 1)
+    _, mitjana = estadistiques()
+    PostingCerca.objects.bulk_create([
+        PostingCerca(terme_id=ids[t], cataleg_id=cataleg.pk, frequencia=f,
+                     pes=pes_bm25(f, longitud, mitjana))
+        for t, f in frequencies.items()
+    ])
+
+
+def ids_termes(termes):
+    TermeCerca.objects.bulk_create(
+        [TermeCerca(terme=t) for t in termes], ignore_conflicts=True, batch_size=500
+    )
+    ids = {}
+    termes = list(termes)
+    for i in range(0, len(termes), 500):
+        ids.update(TermeCerca.objects.filter(terme__in=termes[i:i + 500]).values_list("terme", "pk"))
+    return ids
+
+
+def suma_documents(documents, signe=1):
+    """Suma (o resta) a TermeCerca.documents {terme_id: n}: una consulta per cada n diferent."""
+    per_n = defaultdict(list)
+    for terme_id, n in documents.items():
+        per_n[n].append(terme_id)
+    for n, termes in per_n.items():
+        for i in range(0, len(termes), 500):
+            TermeCerca.objects.filter(pk__in=termes[i:i + 500]).update(documents=F("documents") + signe * n)
+
+
+@transaction.atomic
+def indexa_lot(ids, mida_bloc=2000):
+    """
+    Com `indexa`, per a molts registres alhora (importacions massives): per
+    cada bloc, unes poques consultes en lloc d'unes quantes per registre.
+    """
+    ids = sorted(ids)
+    _, mitjana = estadistiques()
+    for i in range(0, len(ids), mida_bloc):
+        bloc = ids[i:i + mida_bloc]
+        anteriors = PostingCerca.objects.filter(cataleg_id__in=bloc).values("terme_id").annotate(n=Count("pk"))
+        suma_documents({fila["terme_id"]: fila["n"] for fila in anteriors}, -1)
+        PostingCerca.objects.filter(cataleg_id__in=bloc).delete()
+        DocumentCerca.objects.filter(cataleg_id__in=bloc).delete()
+
+        documents = list(documents_cataleg(mida_bloc, Cataleg.objects.filter(pk__in=bloc)))
+        ids_t = ids_termes({t for _, frequencies, _ in documents for t in frequencies})
+        suma_documents(Counter(ids_t[t] for _, frequencies, _ in documents for t in frequencies))
+        DocumentCerca.objects.bulk_create(
+            [DocumentCerca(cataleg_id=pk, longitud=longitud) for pk, _, longitud in documents], batch_size=mida_bloc
+        )
+        PostingCerca.objects.bulk_create([
+            PostingCerca(terme_id=ids_t[t], cataleg_id=pk, frequencia=f, pes=pes_bm25(f, longitud, mitjana))
+            for pk, frequencies, longitud in documents
+            for t, f in frequencies.items()
+        ], batch_size=mida_bloc)
+    cache.delete(CLAU_ESTADISTIQUES)
+
+
+def documents_cataleg(mida_bloc=2000, qs=None):
+    camps = [c for c in CAMPS if c != "ISBN"]
+    qs = (Cataleg.objects.all() if qs is None else qs).values("pk", *camps, ISBN=F("llibre__ISBN")).order_by("pk")
+    for valors in qs.iterator(chunk_size=mida_bloc):
+        frequencies, longitud = termes_document(valors)
+        yield valors["pk"], frequencies, longitud
+
+
+def reindexa_tot(mida_bloc=2000, sortida=None):
+    """
+    Reconstrueix tot l'índex. Fa dues passades pel catàleg: la primera
+    calcula la freqüència dels termes i la longitud mitjana, la segona
+    escriu els postings amb el pes BM25 definitiu.
+    """
+    documents = Counter()
+    total = 0
+    suma_longituds = 0
+    for _, frequencies, longitud in documents_cataleg(mida_bloc):
+        documents.update(frequencies.keys())
+        total += 1
+        suma_longituds += longitud
+    mitjana = (suma_longituds / total) if total else 1.0
+
+    with transaction.atomic():
+        PostingCerca.objects.all().delete()
+        DocumentCerca.objects.all().delete()
+        TermeCerca.objects.all().delete()
+        TermeCerca.objects.bulk_create(
+            [TermeCerca(terme=t, documents=n) for t, n in documents.items()], batch_size=mida_bloc
+        )
+    ids = dict(TermeCerca.objects.values_list("terme", "pk"))
+    del documents
+
+    fets = 0
+    postings, docs = [], []
+    for pk, frequencies, longitud in documents_cataleg(mida_bloc):
+        docs.append(DocumentCerca(cataleg_id=pk, longitud=longitud))
+        postings.extend(
+            PostingCerca(terme_id=ids[t], cataleg_id=pk, frequencia=f,
+                         pes=pes_bm25(f, longitud, mitjana))
+            for t, f in frequencies.items()
+        )
+        if len(docs) >= mida_bloc:
+            fets += _escriu(docs, postings, mida_bloc)
+            docs, postings = [], []
+            if sortida:
+                sortida(f"Indexats {fets} documents...")
+    fets += _escriu(docs, postings, mida_bloc)
+    cache.set(CLAU_ESTADISTIQUES, (total, mitjana), 600)
+    return fets
+
+
+def _escriu(docs, postings, mida_bloc):
+    with transaction.atomic():
+        DocumentCerca.objects.bulk_create(docs, batch_size=mida_bloc)
+        PostingCerca.objects.bulk_create(postings, batch_size=mida_bloc)
+    return len(docs)
+
+
+def cerca(text, offset=0, limit=20):
+    """
+    Retorna (llista de (cataleg_id, puntuacio), hi_ha_mes) ordenada per BM25.
+    Per a cada terme només es llegeixen els MAX_CANDIDATS postings de més pes.
+    """
+    termes = TermeCerca.objects.filter(terme__in=termes_consulta(text), documents__gt=0)
+    termes = dict(termes.values_list("pk", "documents"))
+    if not termes:
+        return [], False
+
+    total, _ = estadistiques()
+    total = max(total, max(termes.values()))
+    pesos_idf = {pk: idf(df, total) for pk, df in termes.items()}
+
+    candidats = set()
+    for terme_id in termes:
+        millors = PostingCerca.objects.filter(terme_id=terme_id).order_by("-pes")
+        candidats.update(millors.values_list("cataleg_id", flat=True)[:MAX_CANDIDATS])
+
+    puntuacions = Counter()
+    candidats = list(candidats)
+    for i in range(0, len(candidats), 900):
+        postings = PostingCerca.objects.filter(
+            terme_id__in=termes, cataleg_id__in=candidats[i:i + 900]
+        ).values_list("terme_id", "cataleg_id", "pes")
+        for terme_id, cataleg_id, pes in postings:
+            puntuacions[cataleg_id] += pesos_idf[terme_id] * pes
+
+    ordenats = sorted(puntuacions.items(), key=lambda p: (-p[1], p[0]))
+    return ordenats[offset:offset + limit], len(ordenats) > offset + limit
@@ -0,0 +1,119 @@
+"""
+Comptadors d'exemplars desnormalitzats a Cataleg.
+
+Cada exemplar, préstec o reserva aporta unes quantitats als comptadors
+del seu registre del catàleg. Quan es desa o s'esborra, signals.py resta
+l'aportació anterior i suma la nova amb un UPDATE ... SET camp = camp + n,
+dins la mateixa transacció que el canvi. Les operacions massives
+(bulk_create, update()) no envien senyals: després cal executar
+`manage.py recompta_exemplars`. Tots dos camins canvien la versió del
+catàleg (versio.py), perquè els comptadors surten a l'API. Els canvis
+que només toquen la disponibilitat (exemplars prestats i reservats, és a
+dir, la circulació) no la canvien: en marquen la part de disponibilitat,
+que es renova com a molt cada DISPONIBILITAT_INTERVAL segons.
+"""
+from collections import Counter
+
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from . import versio
+from .models import Cataleg, Exemplar, Prestec, Reserva
+
+
+CAMPS = Cataleg.CAMPS_COMPTADORS
+# els que canvien amb els préstecs i les reserves
+CAMPS_DISPONIBILITAT = ("exemplars_prestats", "exemplars_reservats")
+
+
+def aportacio_exemplar(cataleg_id, baixa, exclos_prestec):
+    return cataleg_id, {
+        "exemplars_total": 1,
+        "exemplars_actius": int(not baixa),
+        "exemplars_prestables": int(not baixa and not exclos_prestec),
+    }
+
+
+def aportacio_prestec(cataleg_id, data_retorn):
+    return cataleg_id, {"exemplars_prestats": int(data_retorn is None)}
+
+
+def aportacio_reserva(cataleg_id, estat):
+    return cataleg_id, {"exemplars_reservats": int(estat in Reserva.ESTATS_ACTIUS)}
+
+
+def estat_exemplar(exemplar):
+    return aportacio_exemplar(exemplar.cataleg_id, exemplar.baixa, exemplar.exclos_prestec)
+
+
+def estat_desat_exemplar(pk):
+    fila = Exemplar.objects.filter(pk=pk).values_list("cataleg_id", "baixa", "exclos_prestec").first()
+    return aportacio_exemplar(*fila) if fila else None
+
+
+def estat_prestec(prestec):
+    return aportacio_prestec(cataleg_de(prestec.exemplar_id), prestec.data_retorn)
+
+
+def estat_desat_prestec(pk):
+    fila = Prestec.objects.filter(pk=pk).values_list("exemplar__cataleg_id", "data_retorn").first()
+    return aportacio_prestec(*fila) if fila else None
+
+
+def estat_reserva(reserva):
+    return aportacio_reserva(reserva.cataleg_id, reserva.estat)
+
+
+def estat_desat_reserva(pk):
+    fila = Reserva.objects.filter(pk=pk).values_list("cataleg_id", "estat").first()
+    return aportacio_reserva(*fila) if fila else None
+
+
+def cataleg_de(exemplar_id):
+    return Exemplar.objects.filter(pk=exemplar_id).values_list("cataleg_id", flat=True).first()
+
+
+def aplica(anterior, nou):
+    """Resta l'aportació `anterior` i suma la `nova` (qualsevol pot ser None)."""
+    deltes = {}
+    for aportacio, signe in ((anterior, -1), (nou, 1)):
+        if aportacio is None or aportacio[0] is None:
+            continue
+        cataleg_id, valors = aportacio
+        delta = deltes.setdefault(cataleg_id, Counter())
+        for camp, valor in valors.items():
+            delta[camp] += signe * valor
+    for cataleg_id, delta in deltes.items():
+        canvis = {camp: F(camp) + valor for camp, valor in delta.items() if valor}
+        if canvis:
+            Cataleg.objects.filter(pk=cataleg_id).update(**canvis)
+            if set(canvis) <= set(CAMPS_DISPONIBILITAT):
+                versio.circula()
+            else:
+                versio.canvia()
+
+
+def recompta(catalegs=None):
+    """Recalcula tots els comptadors amb un sol UPDATE amb subconsultes."""
+    def compte(qs):
+        subconsulta = qs.values("c").annotate(n=Count("pk")).values("n")
+        return Coalesce(Subquery(subconsulta, output_field=IntegerField()), Value(0))
+
+    exemplars = Exemplar.objects.filter(cataleg=OuterRef("pk")).annotate(c=F("cataleg_id"))
+    prestecs = Prestec.objects.filter(exemplar__cataleg=OuterRef("pk"), data_retorn__isnull=True) \
+        .annotate(c=F("exemplar__cataleg_id"))
+    reserves = Reserva.objects.filter(cataleg=OuterRef("pk"), estat__in=Reserva.ESTATS_ACTIUS) \
+        .annotate(c=F("cataleg_id"))
+
+    qs = Cataleg.objects.all()
+    if catalegs is not None:
+        qs = qs.filter(pk__in=catalegs)
+    n = qs.update(
+        exemplars_total=compte(exemplars),
+        exemplars_actius=compte(exemplars.filter(baixa=False)),
+        exemplars_prestables=compte(exemplars.filter(baixa=False, exclos_prestec=False)),
+        exemplars_prestats=compte(prestecs),
+        exemplars_reservats=compte(reserves),
+    )
+    versio.canvia()
+    return n
@@ -0,0 +1,269 @@
+"""
+Enriquiment dels llibres amb les dades d'OpenLibrary, des del servidor.
+
+`Enriquidor.enriqueix` completa l'editorial, les pàgines, la data
+d'edició i els enllaços (fitxa, previsualització i miniatura) dels
+llibres amb ISBN. L'API Books d'OpenLibrary accepta diversos ISBN per
+petició: es fan peticions de ENRIQUIMENT_MIDA_LOT ISBN, amb un màxim de
+ENRIQUIMENT_CONCURRENCIA peticions alhora (asyncio; urllib és
+bloquejant i va en fils amb asyncio.to_thread). Les respostes 429 i 5xx
+i els errors de xarxa es tornen a provar unes quantes vegades.
+
+Cada resposta es desa a una memòria cau en disc (ENRIQUIMENT_CACHE_DIR),
+un fitxer JSON per ISBN. Els ISBN que OpenLibrary no coneix també s'hi
+desen (memòria cau negativa), amb una caducitat més curta: tornar a
+enriquir el catàleg només consulta els ISBN nous o caducats. Els errors
+no es desen i es tornen a provar a la següent execució.
+
+Per defecte només s'omplen els camps buits i només es consulten els
+llibres que en tenen algun; amb sobreescriu=True les dades d'OpenLibrary
+substitueixen les que hi hagi. Com que s'escriu amb bulk_update, que no
+envia senyals, es canvia la versió del catàleg (cap d'aquests camps és
+a l'índex de cerca).
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+
+from . import versio
+from .importacio import en_trozos
+from .marc import RE_ANY
+from .models import Llibre
+
+
+logger = logging.getLogger("biblioteca.enriquiment")
+
+CAMPS = ("editorial", "pagines", "data_edicio", "info_url", "preview_url", "thumbnail_url")
+# llibres que es llegeixen, consulten i desen de cop
+MIDA_BLOC = 1000
+INTENTS = 3
+ESPERA_REINTENT = 1.0
+CODIS_REINTENT = (429, 500, 502, 503, 504)
+FORMATS_DATA = ("%Y-%m-%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%B %Y", "%b %Y", "%Y")
+
+
+def data_publicacio(text):
+    """Data de `publish_date` ("1998", "March 3, 1998", "c1998"...): si només hi ha l'any, l'1 de gener."""
+    text = (text or "").strip()
+    for format in FORMATS_DATA:
+        try:
+            return datetime.strptime(text, format).date()
+        except ValueError:
+            pass
+    any_edicio = RE_ANY.search(text)
+    return date(int(any_edicio.group(1)), 1, 1) if any_edicio else None
+
+
+def _text(valor, camp):
+    if not isinstance(valor, str) or not valor.strip():
+        return None
+    return valor.strip()[:Llibre._meta.get_field(camp).max_length]
+
+
+def _url(valor, camp):
+    # una URL retallada no serveix de res: si no hi cap, no es desa
+    if not isinstance(valor, str) or not valor.strip():
+        return None
+    valor = valor.strip()
+    return valor if len(valor) <= Llibre._meta.get_field(camp).max_length else None
+
+
+def camps_openlibrary(llibre):
+    """Camps del model a partir d'una entrada de l'API Books (jscmd=details); None si no n'hi ha."""
+    detalls = llibre.get("details") or {}
+    editorials = detalls.get("publishers") or [None]
+    editorial = editorials[0]["name"] if isinstance(editorials[0], dict) else editorials[0]
+    pagines = detalls.get("number_of_pages")
+    return {
+        "editorial": _text(editorial, "editorial"),
+        "pagines": pagines if isinstance(pagines, int) and pagines > 0 else None,
+        "data_edicio": data_publicacio(detalls.get("publish_date")),
+        "info_url": _url(llibre.get("info_url"), "info_url"),
+        "preview_url": _url(llibre.get("preview_url"), "preview_url"),
+        "thumbnail_url": _url(llibre.get("thumbnail_url"), "thumbnail_url"),
+    }
+
+
+class CacheDisc:
+    """Un fitxer per ISBN: {"desat": segons, "llibre": entrada d'OpenLibrary, o null si no el coneix}."""
+
+    def __init__(self, directori, caducitat, caducitat_negativa):
+        self.directori = directori
+        self.caducitat = caducitat
+        self.caducitat_negativa = caducitat_negativa
+
+    def cami(self, isbn):
+        # subdirectoris per no tenir centenars de milers de fitxers junts
+        return os.path.join(self.directori, isbn[-2:], f"{isbn}.json")
+
+    def llegeix(self, isbn):
+        """(True, entrada o None) si l'ISBN és a la memòria cau i no ha caducat; (False, None) si no."""
+        try:
+            with open(self.cami(isbn), encoding="utf-8") as fitxer:
+                desat = json.load(fitxer)
+            llibre = desat["llibre"]
+            caducitat = self.caducitat if llibre is not None else self.caducitat_negativa
+            if time.time() - desat["desat"] < caducitat:
+                return True, llibre
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return False, None
+
+    def desa(self, isbn, llibre):
+        cami = self.cami(isbn)
+        os.makedirs(os.path.dirname(cami), exist_ok=True)
+        # escriptura atòmica: un altre procés no pot llegir un fitxer a mig escriure
+        descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(cami), suffix=".tmp")
+        with os.fdopen(descriptor, "w", encoding="utf-8") as fitxer:
+            json.dump({"desat": time.time(), "llibre": llibre}, fitxer)
+        os.replace(temporal, cami)
+
+
+def cache_per_defecte():
+    dia = 24 * 3600
+    return CacheDisc(
+        getattr(settings, "ENRIQUIMENT_CACHE_DIR", os.path.join(settings.BASE_DIR, "cache", "openlibrary")),
+        getattr(settings, "ENRIQUIMENT_CADUCITAT_DIES", 90) * dia,
+        getattr(settings, "ENRIQUIMENT_CADUCITAT_NEGATIVA_DIES", 7) * dia,
+    )
+
+
+def _descarrega(url, timeout):
+    peticio = urllib.request.Request(url, headers={
+        "Accept": "application/json",
+        "User-Agent": "Biblioteca-Maricarmen (enriquiment del catàleg)",
+    })
+    with urllib.request.urlopen(peticio, timeout=timeout) as resposta:
+        return json.load(resposta)
+
+
+class Enriquidor:
+    def __init__(self, sobreescriu=False, refresca=False, concurrencia=None, mida_lot=None, cache=None,
+                 progres=None):
+        self.sobreescriu = sobreescriu
+        # refresca: torna a consultar OpenLibrary encara que l'ISBN sigui a la memòria cau
+        self.refresca = refresca
+        self.concurrencia = concurrencia or getattr(settings, "ENRIQUIMENT_CONCURRENCIA", 4)
+        self.mida_lot = mida_lot or getattr(settings, "ENRIQUIMENT_MIDA_LOT", 50)
+        self.url = getattr(settings, "OPENLIBRARY_URL", "https://openlibrary.org").rstrip("/")
+        self.timeout = getattr(settings, "ENRIQUIMENT_TIMEOUT", 15)
+        self.cache = cache or cache_per_defecte()
+        self.progres = progres
+        self.llibres = 0
+        self.consultats = 0
+        self.de_cache = 0
+        self.trobats = 0
+        self.actualitzats = 0
+        self.errors = []
+
+    def url_lot(self, isbns):
+        consulta = urllib.parse.urlencode({
+            "bibkeys": ",".join(f"ISBN:{isbn}" for isbn in isbns),
+            "jscmd": "details",
+            "format": "json",
+        })
+        return f"{self.url}/api/books?{consulta}"
+
+    async def _consulta_lot(self, isbns, semafor):
+        async with semafor:
+            for intent in range(INTENTS):
+                try:
+                    resposta = await asyncio.to_thread(_descarrega, self.url_lot(isbns), self.timeout)
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code not in CODIS_REINTENT or intent == INTENTS - 1:
+                        raise
+                except OSError:
+                    if intent == INTENTS - 1:
+                        raise
+                # esperant amb el semàfor agafat: quan OpenLibrary va carregat, s'hi va més a poc a poc
+                await asyncio.sleep(ESPERA_REINTENT * 2 ** intent)
+        if not isinstance(resposta, dict):
+            raise ValueError("resposta inesperada d'OpenLibrary")
+        resultat = {isbn: resposta.get(f"ISBN:{isbn}") for isbn in isbns}
+        for isbn, llibre in resultat.items():
+            self.cache.desa(isbn, llibre)
+        return resultat
+
+    async def _consulta(self, isbns):
+        semafor = asyncio.Semaphore(self.concurrencia)
+        lots = list(en_trozos(isbns, self.mida_lot))
+        respostes = await asyncio.gather(*(self._consulta_lot(lot, semafor) for lot in lots),
+                                         return_exceptions=True)
+        resultat = {}
+        for lot, resposta in zip(lots, respostes):
+            if isinstance(resposta, Exception):
+                logger.warning("OpenLibrary: no s'han pogut consultar %d ISBN (%s)", len(lot), resposta)
+                self.errors.extend(lot)
+            else:
+                resultat.update(resposta)
+        return resultat
+
+    def metadades(self, isbns):
+        """{isbn: entrada d'OpenLibrary o None}, de la memòria cau o consultant els que hi falten."""
+        resultat = {}
+        falten = []
+        for isbn in dict.fromkeys(isbns):
+            trobat, llibre = (False, None) if self.refresca else self.cache.llegeix(isbn)
+            if trobat:
+                resultat[isbn] = llibre
+                self.de_cache += 1
+            else:
+                falten.append(isbn)
+        if falten:
+            self.consultats += len(falten)
+            resultat.update(asyncio.run(self._consulta(falten)))
+        return resultat
+
+    def _aplica(self, llibres, metadades):
+        canviats = []
+        camps_canviats = set()
+        for llibre in llibres:
+            dades = metadades.get(llibre.ISBN)
+            if not dades:
+                continue
+            self.trobats += 1
+            canvia = False
+            for camp, valor in camps_openlibrary(dades).items():
+                actual = getattr(llibre, camp)
+                if valor is None or valor == actual or (actual not in (None, "") and not self.sobreescriu):
+                    continue
+                setattr(llibre, camp, valor)
+                camps_canviats.add(camp)
+                canvia = True
+            if canvia:
+                canviats.append(llibre)
+        if canviats:
+            Llibre.objects.bulk_update(canviats, sorted(camps_canviats))
+            self.actualitzats += len(canviats)
+            versio.canvia()
+
+    def enriqueix(self, llibres=None):
+        """Enriqueix els llibres del queryset `llibres` (per defecte, tots) que tenen ISBN."""
+        llibres = (Llibre.objects.all() if llibres is None else llibres).filter(ISBN__isnull=False)
+        if not self.sobreescriu:
+            buits = Q()
+            for camp in CAMPS:
+                buits |= Q(**{f"{camp}__isnull": True})
+                if camp not in ("pagines", "data_edicio"):
+                    buits |= Q(**{camp: ""})
+            llibres = llibres.filter(buits)
+        llibres = llibres.only("pk", "ISBN", *CAMPS).order_by("pk")
+        llegits = llibres.iterator(chunk_size=MIDA_BLOC)
+        while bloc := list(islice(llegits, MIDA_BLOC)):
+            self.llibres += len(bloc)
+            self._aplica(bloc, self.metadades(llibre.ISBN for llibre in bloc))
+            if self.progres:
+                self.progres(self)
+        return self
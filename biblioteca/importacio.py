@@ -0,0 +1,326 @@
+"""
+Importación masiva de usuarios desde CSV.
+
+Las filas se procesan por lotes: para cada lote se consultan de una vez
+los usuarios existentes, los centros y los ciclos, y los usuarios nuevos
+y su pertenencia al grupo "usuari" se insertan con bulk_create dentro de
+una transacción. La contraseña inicial, común a todos, se cifra una sola
+vez por archivo.
+
+Los archivos grandes pueden importarse en segundo plano: la subida guarda
+el CSV en default_storage y crea una ImportacioCSV pendiente, y el comando
+`importacions_worker` la procesa por lotes, guardando el progreso y un
+latido (`data_batec`) después de cada uno. Si un worker muere, otro la
+reclama pasados IMPORTACIONS_TIMEOUT segundos sin latido y la reanuda
+después de las filas ya confirmadas. Cada reclamación incrementa
+`intents`: un worker que ha perdido la importación ya no puede confirmar
+ningún lote. Al terminar se borra el archivo.
+"""
+import codecs
+import csv
+import io
+import logging
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+from . import metriques
+from .models import Centre, Cicle, Usuari
+
+
+logger = logging.getLogger("biblioteca.importacio")
+
+PASSWORD_INICIAL = "1234"
+GRUPO_USUARIOS = "usuari"
+# límite de parámetros por consulta IN (SQLite)
+MIDA_CONSULTA = 500
+
+
+# Función para validar si el nombre contiene solo letras
+def validar_nombre(nombre):
+    if not re.match(r'^[A-Za-záéíóúÁÉÍÓÚñÑ]+$', nombre):
+        raise ValidationError(f"El nombre '{nombre}' contiene caracteres no válidos.")
+
+# Función para validar si el teléfono contiene solo números
+def validar_telefono(telefono):
+    if not telefono.isdigit():
+        raise ValidationError(f"El teléfono '{telefono}' debe contener solo números.")
+
+def validar_email(email):
+    # Expresión regular para un email válido (básico)
+    email_regex = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
+    if not re.match(email_regex, email):
+        raise ValidationError(f"El email '{email}' no tiene un formato válido.")
+
+
+def en_trozos(valores, mida=MIDA_CONSULTA):
+    valores = list(valores)
+    for i in range(0, len(valores), mida):
+        yield valores[i:i + mida]
+
+
+def resuelve_nombres(model, cache, nombres, crear=True):
+    """
+    Completa `cache` ({nom: pk}) con los nombres de `model` que faltan: un
+    solo SELECT (y un solo INSERT para los que no existen) por lote. Con
+    crear=False no inserta nada y devuelve los nombres que no existen.
+    """
+    pendientes = set(nombres) - set(cache)
+    for trozo in en_trozos(pendientes):
+        for pk, nom in model.objects.filter(nom__in=trozo).order_by("-pk").values_list("pk", "nom"):
+            cache[nom] = pk
+    faltan = pendientes - set(cache)
+    if faltan and crear:
+        model.objects.bulk_create([model(nom=nom) for nom in faltan])
+        for trozo in en_trozos(faltan):
+            cache.update((nom, pk) for pk, nom in model.objects.filter(nom__in=trozo).values_list("pk", "nom"))
+        return set()
+    return faltan
+
+
+class ImportadorUsuarios:
+    """
+    Uso:
+        importador = ImportadorUsuarios()
+        importador.procesa(csv.DictReader(f))
+        importador.registros, importador.errores, importador.usuarios_creados
+
+    Con mida_lot=None todo el archivo es un solo lote (y una sola
+    transacción). `progreso`, si se indica, se llama después de cada lote.
+    """
+
+    def __init__(self, mida_lot=None, progreso=None):
+        self.mida_lot = mida_lot
+        self.progreso = progreso
+        self.registros = []
+        self.errores = []
+        self.usuarios_creados = 0
+        self.filas_procesadas = 0
+        self._password = make_password(PASSWORD_INICIAL)
+        self._emails_vistos = set()
+        self._centres = {}
+        self._cicles = {}
+        self._grupo = None
+
+    def procesa(self, reader, desde=0):
+        """Con `desde`, se saltan (y se cuentan como procesadas) las primeras filas no vacías."""
+        lote = []
+        saltadas = 0
+        for row in reader:
+            cleaned_row = {key.strip(): (value.strip() if value is not None else "")
+                           for key, value in row.items() if key is not None}
+            if not any(cleaned_row.values()):
+                continue
+            if saltadas < desde:
+                saltadas += 1
+                self.filas_procesadas += 1
+                continue
+            lote.append(cleaned_row)
+            if self.mida_lot and len(lote) >= self.mida_lot:
+                self._procesa_lote(lote)
+                lote = []
+        if lote:
+            self._procesa_lote(lote)
+
+    def _procesa_lote(self, filas):
+        errores_antes, creados_antes = len(self.errores), self.usuarios_creados
+        emails = [(fila.get("email") or "").strip().replace(' ', '').lower() for fila in filas]
+        existentes = set()
+        for trozo in en_trozos({e for e in emails if e} - self._emails_vistos):
+            existentes.update(Usuari.objects.filter(username__in=trozo).values_list("username", flat=True))
+        self._emails_vistos.update(existentes)
+
+        nuevos = []
+        for cleaned_row, email in zip(filas, emails):
+            fila = self._valida_fila(cleaned_row, email)
+            if fila is not None:
+                # los duplicados dentro del mismo archivo también cuentan como existentes
+                self._emails_vistos.add(email)
+                nuevos.append(fila)
+
+        # el progreso se guarda en la misma transacción que el lote: si falla, el lote no se confirma
+        with transaction.atomic():
+            if nuevos:
+                self._crea_usuarios(nuevos)
+            self.filas_procesadas += len(filas)
+            if self.progreso:
+                self.progreso(self)
+        metriques.importacio(len(filas), len(self.errores) - errores_antes, self.usuarios_creados - creados_antes)
+
+    def _valida_fila(self, cleaned_row, email):
+        if not email:
+            self.errores.append({"fila": cleaned_row, "error": "Email vacío"})
+            return None
+
+        if email in self._emails_vistos:
+            self.errores.append({"fila": cleaned_row, "error": f"El email {email} ya existe."})
+            return None
+
+        fila = {
+            "nom": (cleaned_row.get("nom") or "").strip(),
+            "cognom1": (cleaned_row.get("cognom1") or "").strip(),
+            "cognom2": (cleaned_row.get("cognom2") or "").strip(),
+            "email": email,
+            "telefon": cleaned_row.get("telefon", ""),
+            "centre": cleaned_row.get("centre", ""),
+            "grup": cleaned_row.get("grup", ""),
+        }
+        if not all([fila["nom"], fila["cognom1"], fila["cognom2"], fila["telefon"], fila["centre"], fila["grup"]]):
+            self.errores.append({"fila": cleaned_row, "error": "Faltan campos obligatorios."})
+            return None
+
+        try:
+            validar_nombre(fila["nom"])
+            validar_nombre(fila["cognom1"])
+            if fila["cognom2"]:
+                validar_nombre(fila["cognom2"])
+            validar_telefono(fila["telefon"])
+            validar_email(email)
+        except ValidationError as e:
+            self.errores.append({"fila": cleaned_row, "error": str(e)})
+            return None
+        return fila
+
+    def _crea_usuarios(self, filas):
+        resuelve_nombres(Centre, self._centres, (f["centre"] for f in filas))
+        resuelve_nombres(Cicle, self._cicles, (f["grup"] for f in filas))
+
+        # los mismos usernames para insertar y para volver a leer los ids
+        usernames = [Usuari.normalize_username(f["email"]) for f in filas]
+        Usuari.objects.bulk_create([
+            Usuari(
+                username=username,
+                email=Usuari.objects.normalize_email(f["email"]),
+                first_name=f["nom"],
+                last_name=f"{f['cognom1']} {f['cognom2']}",
+                telefon=f["telefon"],
+                centre_id=self._centres[f["centre"]],
+                cicle_id=self._cicles[f["grup"]],
+                password=self._password,
+            )
+            for f, username in zip(filas, usernames)
+        ], batch_size=MIDA_CONSULTA)
+
+        # bulk_create no llama a Usuari.save(): añadimos el grupo aquí.
+        # Los ids se vuelven a leer porque MySQL no los devuelve en bulk_create.
+        if self._grupo is None:
+            self._grupo, _ = Group.objects.get_or_create(name=GRUPO_USUARIOS)
+        Pertenencia = Usuari.groups.through
+        ids = []
+        for trozo in en_trozos(usernames):
+            ids.extend(Usuari.objects.filter(username__in=trozo).values_list("pk", flat=True))
+        Pertenencia.objects.bulk_create(
+            [Pertenencia(usuari_id=pk, group_id=self._grupo.pk) for pk in ids],
+            batch_size=MIDA_CONSULTA, ignore_conflicts=True,
+        )
+
+        self.usuarios_creados += len(filas)
+        self.registros.extend(filas)
+
+
+# Importaciones en segundo plano (ImportacioCSV + comando importacions_worker)
+
+MIDA_LOT_SEGUNDO_PLANO = 500
+
+
+class ImportacioPerduda(Exception):
+    """Otro worker ha reclamado la importación."""
+
+
+def es_utf8(archivo):
+    """Comprueba, por trozos, que un archivo subido es UTF-8 y lo deja al principio."""
+    decodificador = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for trozo in archivo.chunks():
+            decodificador.decode(trozo)
+        decodificador.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    finally:
+        archivo.seek(0)
+    return True
+
+
+def timeout_importacio():
+    return getattr(settings, "IMPORTACIONS_TIMEOUT", 600)
+
+
+def reclama_importacio():
+    """
+    Marca como 'processant' la importación pendiente más antigua, o una
+    'processant' sin latido desde hace IMPORTACIONS_TIMEOUT segundos, y la devuelve.
+    """
+    from .models import ImportacioCSV
+    reclamables = Q(estat='pendent') | Q(estat='processant', data_batec__lt=now() - timedelta(seconds=timeout_importacio()))
+    candidatas = ImportacioCSV.objects.filter(reclamables).order_by('pk').values_list('pk', 'intents')
+    for pk, intents in candidatas[:10]:
+        ara = now()
+        # UPDATE condicional: si otro worker la ha cogido antes, no actualiza nada
+        if ImportacioCSV.objects.filter(reclamables, pk=pk, intents=intents).update(
+                estat='processant', data_inici=Coalesce(F('data_inici'), ara), data_batec=ara,
+                intents=F('intents') + 1):
+            return ImportacioCSV.objects.get(pk=pk)
+    return None
+
+
+def procesa_importacio(importacio):
+    from .models import ImportacioCSV
+    # solo mientras siga siendo nuestra (intents no ha cambiado)
+    propia = ImportacioCSV.objects.filter(pk=importacio.pk, intents=importacio.intents)
+
+    def actualiza(**campos):
+        if not propia.update(**campos):
+            raise ImportacioPerduda(importacio.pk)
+
+    def progreso(importador):
+        # dentro de la transacción del lote, que se confirma por separado para que
+        # /api/imports/{id} vea el avance; un worker que ha perdido la importación no confirma nada
+        actualiza(files_processades=importador.filas_procesadas,
+                  usuaris_creats=importador.usuarios_creados,
+                  errors=importador.errores, registres=importador.registros, data_batec=now())
+
+    importador = ImportadorUsuarios(mida_lot=MIDA_LOT_SEGUNDO_PLANO, progreso=progreso)
+    # si se reanuda, se sigue después de las filas ya confirmadas
+    importador.errores = list(importacio.errors)
+    importador.registros = list(importacio.registres)
+    importador.usuarios_creados = importacio.usuaris_creats
+    try:
+        with importacio.fitxer.open('rb') as fitxer:
+            importador.procesa(csv.DictReader(io.TextIOWrapper(fitxer, encoding='utf-8', newline='')),
+                               desde=importacio.files_processades)
+        final = dict(
+            estat='acabada', data_fi=now(),
+            files_processades=importador.filas_procesadas,
+            usuaris_creats=importador.usuarios_creados,
+            errors=importador.errores,
+            # ja són al resultat
+            registres=[],
+            resultat={
+                "mensaje": f"✅ Archivo procesado. Usuarios creados: {importador.usuarios_creados}",
+                "registros": importador.registros,
+                "errores": importador.errores or None,
+            },
+        )
+    except ImportacioPerduda:
+        logger.warning("La importación %s la ha reclamado otro worker", importacio.pk)
+        return
+    except Exception as e:
+        logger.exception("Error en la importación %s", importacio.pk)
+        final = dict(estat='error', data_fi=now(),
+                     resultat={"mensaje": "Error interno del servidor.", "error": str(e)})
+    try:
+        actualiza(**final)
+    except ImportacioPerduda:
+        logger.warning("La importación %s la ha reclamado otro worker", importacio.pk)
+        return
+    # terminada: el archivo ya no hace falta
+    importacio.fitxer.delete(save=False)
+    propia.update(fitxer="")
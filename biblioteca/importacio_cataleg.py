@@ -0,0 +1,322 @@
+"""
+Importació massiva del catàleg des de NDJSON o CSV.
+
+Cada fila és un registre d'un subtipus (llibre, revista, cd, dvd, br,
+dispositiu) amb els noms dels camps del model. `pais` i `llengua` es
+donen pel nom i `tags` és una llista de noms de categoria. `exemplars`
+és una llista de registres d'exemplar (o d'objectes amb `registre` i,
+opcionalment, `exclos_prestec` i `baixa`). Al CSV, tags i exemplars van
+separats per "|". Els noms es resolen lot a lot amb una memòria que dura
+tota la importació. Els països, llengües i categories que no existeixen
+es creen. Els exemplars amb un registre que ja existeix no es tornen a
+crear; si el registre és d'un altre element del catàleg, queda a
+`errors`.
+
+Les files es validen lot a lot amb les regles dels camps del model
+(clean_fields). S'escriuen amb massiu.crea_subtipus i bulk_update, amb
+una transacció per lot. Si l'ISBN d'un llibre (o l'ISSN d'una revista)
+ja és al catàleg, el registre s'actualitza en lloc de duplicar-se, i
+només canvien els camps que porta la fila. Les files amb errors no
+s'escriuen: queden a `errors` amb el número de línia.
+
+Com que no s'envien senyals, `finalitza` canvia la versió del catàleg i
+indexa els registres importats (cerca.indexa_lot).
+"""
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import cerca, comptadors, versio
+from .importacio import en_trozos, resuelve_nombres
+from .massiu import MIDA_LOT, crea_etiquetes, crea_subtipus
+from .models import (BR, CD, DVD, Cataleg, Categoria, Dispositiu, Exemplar, Llengua, Llibre, Pais, Revista,
+                     normalitza_isbn)
+
+
+TIPUS = {
+    "llibre": Llibre,
+    "revista": Revista,
+    "cd": CD,
+    "dvd": DVD,
+    "br": BR,
+    "dispositiu": Dispositiu,
+}
+# camp que identifica un registre que ja és al catàleg
+CLAUS = {Llibre: "ISBN", Revista: "ISSN"}
+RELACIONS = {"pais": Pais, "llengua": Llengua}
+SEPARADOR_LLISTES = "|"
+
+
+def camps_importables(model):
+    """Camps que pot portar una fila: els editables, sense l'id ni les relacions."""
+    return {
+        f.name: f for f in model._meta.concrete_fields
+        if f.editable and not f.primary_key and not f.is_relation
+    }
+
+
+def normalitza_clau(camp, valor):
+    if camp == "ISBN":
+        return normalitza_isbn(valor)
+    return (valor or "").strip() or None
+
+
+def missatge(error):
+    if hasattr(error, "error_dict"):
+        return "; ".join(f"{camp}: {' '.join(missatges)}" for camp, missatges in error.message_dict.items())
+    return " ".join(error.messages)
+
+
+def files_ndjson(fitxer):
+    """(línia, fila, error) de cada línia no buida d'un NDJSON."""
+    for linia, text in enumerate(fitxer, 1):
+        text = text.strip()
+        if not text:
+            continue
+        try:
+            yield linia, json.loads(text), None
+        except ValueError as e:
+            yield linia, None, f"JSON no vàlid: {e}"
+
+
+def files_csv(fitxer):
+    """(línia, fila, error) de cada fila no buida d'un CSV amb capçalera."""
+    lector = csv.DictReader(fitxer)
+    for fila in lector:
+        neta = {clau.strip(): (valor or "").strip() for clau, valor in fila.items() if clau is not None}
+        if not any(neta.values()):
+            continue
+        for camp in ("tags", "exemplars"):
+            if camp in neta:
+                neta[camp] = [nom.strip() for nom in neta[camp].split(SEPARADOR_LLISTES) if nom.strip()]
+        yield lector.line_num, neta, None
+
+
+class ImportadorCataleg:
+    """
+    Ús:
+        importador = ImportadorCataleg("llibre")
+        importador.procesa(files_ndjson(fitxer))
+        importador.finalitza()
+        importador.creats, importador.actualitzats, importador.errors
+
+    `progres`, si s'indica, es crida després de cada lot.
+    """
+
+    def __init__(self, tipus, mida_lot=MIDA_LOT, progres=None):
+        if tipus not in TIPUS:
+            raise ValueError(f"Tipus desconegut: {tipus}")
+        self.model = TIPUS[tipus]
+        self.mida_lot = mida_lot
+        self.progres = progres
+        self.camps = camps_importables(self.model)
+        self.clau = CLAUS.get(self.model)
+        noms_camps = {f.name for f in self.model._meta.fields}
+        self.relacions = {nom: model for nom, model in RELACIONS.items() if nom in noms_camps}
+        self.permesos = set(self.camps) | set(self.relacions) | {"tags", "exemplars"}
+        # clean_fields no ha de mirar les claus foranes (consultaria la BD) ni els ids
+        self._exclosos = {f.name for f in self.model._meta.fields if f.is_relation or f.primary_key}
+        self.files = 0
+        self.creats = 0
+        self.actualitzats = 0
+        self.exemplars = 0
+        self.errors = []
+        self.ids = set()
+        self._noms = {model: {} for model in (*self.relacions.values(), Categoria)}
+
+    def procesa(self, files):
+        lot = []
+        for linia, fila, error in files:
+            if error:
+                self.files += 1
+                self.errors.append({"linia": linia, "error": error, "fila": {}})
+                continue
+            lot.append((linia, fila))
+            if len(lot) >= self.mida_lot:
+                self.procesa_lot(lot)
+                lot = []
+        if lot:
+            self.procesa_lot(lot)
+        return self
+
+    def procesa_lot(self, lot):
+        """Valida i escriu, en una transacció, un lot de parelles (línia, fila)."""
+        self.files += len(lot)
+        llegides = []
+        for linia, fila in lot:
+            if not isinstance(fila, dict):
+                self.errors.append({"linia": linia, "error": "La fila no és un objecte", "fila": {}})
+                continue
+            desconeguts = set(fila) - self.permesos
+            if desconeguts:
+                self.errors.append({"linia": linia, "error": f"Camps desconeguts: {', '.join(sorted(desconeguts))}",
+                                    "fila": fila})
+                continue
+            llegides.append((linia, fila))
+        if not llegides:
+            self._avisa()
+            return
+
+        with transaction.atomic():
+            existents = self._existents(llegides)
+            registres = {}
+            for linia, fila in llegides:
+                try:
+                    obj, nou = self._valida(fila, existents)
+                except ValidationError as e:
+                    self.errors.append({"linia": linia, "error": missatge(e), "fila": fila})
+                    continue
+                # un registre repetit dins del lot és el mateix objecte
+                registres.setdefault(id(obj), [obj, nou, []])[2].append((linia, fila))
+            self._escriu(list(registres.values()))
+        self._avisa()
+
+    def _avisa(self):
+        if self.progres:
+            self.progres(self)
+
+    def _existents(self, llegides):
+        """{clau: objecte} dels registres del lot que ja són al catàleg (una consulta)."""
+        if self.clau is None:
+            return {}
+        claus = {normalitza_clau(self.clau, str(fila.get(self.clau) or "")) for _, fila in llegides} - {None}
+        existents = {}
+        for trozo in en_trozos(claus):
+            for obj in self.model.objects.filter(**{f"{self.clau}__in": trozo}):
+                existents[getattr(obj, self.clau)] = obj
+        return existents
+
+    def _valida(self, fila, existents):
+        valors = {}
+        for nom in self.camps.keys() & fila.keys():
+            valor = fila[nom]
+            if isinstance(valor, str):
+                valor = valor.strip()
+            if valor in ("", None):
+                valor = None if self.camps[nom].null else ""
+            valors[nom] = valor
+        clau = None
+        if self.clau and valors.get(self.clau) is not None:
+            clau = valors[self.clau] = normalitza_clau(self.clau, str(valors[self.clau]))
+        tags = fila.get("tags")
+        if tags is not None and not (isinstance(tags, list) and all(isinstance(t, str) for t in tags)):
+            raise ValidationError({"tags": "Ha de ser una llista de noms de categoria."})
+        for nom in self.relacions.keys() & fila.keys():
+            if fila[nom] is not None and not isinstance(fila[nom], str):
+                raise ValidationError({nom: "Ha de ser un nom."})
+        exemplars = fila.get("exemplars")
+        if exemplars is not None and not isinstance(exemplars, list):
+            raise ValidationError({"exemplars": "Ha de ser una llista de registres d'exemplar."})
+        for exemplar in exemplars or ():
+            registre = exemplar.get("registre") if isinstance(exemplar, dict) else exemplar
+            if not isinstance(registre, str) or not registre.strip() or len(registre.strip()) > 100:
+                raise ValidationError({"exemplars": "Cada exemplar necessita un registre (com a molt 100 caràcters)."})
+
+        desti = existents.get(clau) if clau else None
+        provisional = self.model(**valors)
+        if desti is None:
+            # registre nou: tots els camps, també els obligatoris que no hi són
+            provisional.clean_fields(exclude=self._exclosos)
+            if clau:
+                existents[clau] = provisional
+            return provisional, True
+        # registre existent (o repetit al lot): només els camps de la fila
+        provisional.clean_fields(exclude=self._exclosos | (set(self.camps) - set(valors)))
+        for nom in valors:
+            setattr(desti, nom, getattr(provisional, nom))
+        return desti, desti.pk is None
+
+    def _escriu(self, registres):
+        if not registres:
+            return
+        self._resol_noms(registres)
+        camps_actualitzats = set()
+        for obj, nou, files in registres:
+            for _, fila in files:
+                for nom in self.relacions.keys() & fila.keys():
+                    setattr(obj, f"{nom}_id", self._noms[self.relacions[nom]].get((fila[nom] or "").strip() or None))
+                if not nou:
+                    camps_actualitzats.update((self.camps.keys() | self.relacions.keys()) & fila.keys())
+
+        nous = [obj for obj, nou, _ in registres if nou]
+        crea_subtipus(self.model, nous, self.mida_lot)
+        actualitzats = [obj for obj, nou, _ in registres if not nou]
+        if actualitzats and camps_actualitzats:
+            self.model.objects.bulk_update(actualitzats, sorted(camps_actualitzats), batch_size=self.mida_lot)
+
+        # etiquetes: les de la fila substitueixen les que tenia el registre
+        amb_tags = {}
+        for obj, _, files in registres:
+            for _, fila in files:
+                if "tags" in fila:
+                    amb_tags[obj.pk] = fila["tags"]
+        if amb_tags:
+            Etiqueta = Cataleg.tags.through
+            for trozo in en_trozos(obj.pk for obj, nou, _ in registres if not nou and obj.pk in amb_tags):
+                Etiqueta.objects.filter(cataleg_id__in=trozo).delete()
+            categories = self._noms[Categoria]
+            crea_etiquetes((pk, categories[nom]) for pk, noms in amb_tags.items() for nom in noms)
+
+        self._crea_exemplars([
+            (obj.pk, linia, fila, exemplar)
+            for obj, _, files in registres for linia, fila in files for exemplar in fila.get("exemplars") or ()
+        ])
+
+        self.creats += len(nous)
+        self.actualitzats += sum(len(files) for _, _, files in registres) - len(nous)
+        self.ids.update(obj.pk for obj, _, _ in registres)
+
+    def _crea_exemplars(self, exemplars):
+        nous = {}
+        # registre: [(cataleg_id, linia, fila)] de totes les files que el porten
+        origens = {}
+        for cataleg_id, linia, fila, exemplar in exemplars:
+            if not isinstance(exemplar, dict):
+                exemplar = {"registre": exemplar}
+            registre = exemplar["registre"].strip()
+            estat = {camp: bool(exemplar[camp]) for camp in ("exclos_prestec", "baixa") if camp in exemplar}
+            nous.setdefault(registre, Exemplar(cataleg_id=cataleg_id, registre=registre, **estat))
+            origens.setdefault(registre, []).append((cataleg_id, linia, fila))
+        if not nous:
+            return
+        propietaris = {registre: exemplar.cataleg_id for registre, exemplar in nous.items()}
+        for trozo in en_trozos(nous):
+            for registre, cataleg_id in Exemplar.objects.filter(registre__in=trozo).values_list("registre", "cataleg_id"):
+                del nous[registre]
+                propietaris[registre] = cataleg_id
+        # el mateix registre per a un altre element del catàleg (ja desat o abans al lot): no es crea
+        for registre, files in origens.items():
+            for cataleg_id, linia, fila in files:
+                if cataleg_id != propietaris[registre]:
+                    self.errors.append({"linia": linia, "error": (
+                        f"exemplars: el registre {registre} ja és d'un altre element del catàleg "
+                        f"(id {propietaris[registre]})"), "fila": fila})
+        Exemplar.objects.bulk_create(nous.values(), batch_size=self.mida_lot)
+        # bulk_create no passa pels senyals que mantenen els comptadors
+        for trozo in en_trozos({exemplar.cataleg_id for exemplar in nous.values()}):
+            comptadors.recompta(trozo)
+        self.exemplars += len(nous)
+
+    def _resol_noms(self, registres):
+        files = [fila for _, _, files in registres for _, fila in files]
+        for nom, model in self.relacions.items():
+            noms = {(fila.get(nom) or "").strip() for fila in files} - {""}
+            resuelve_nombres(model, self._noms[model], noms)
+        noms_categories = {nom for fila in files for nom in fila.get("tags") or ()}
+        faltan = resuelve_nombres(Categoria, self._noms[Categoria], noms_categories, crear=False)
+        for nom in sorted(faltan):
+            # save() i no bulk_create: la categoria ha de calcular el seu camí
+            categoria = Categoria(nom=nom)
+            categoria.save()
+            self._noms[Categoria][nom] = categoria.pk
+
+    def finalitza(self):
+        """Versió del catàleg i índex de cerca dels registres importats (bulk_create no envia senyals)."""
+        self.errors.sort(key=lambda error: error["linia"])
+        if not self.ids:
+            return
+        versio.canvia()
+        if cerca.indexacio_automatica():
+            cerca.indexa_lot(self.ids)
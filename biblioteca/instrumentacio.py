@@ -0,0 +1,238 @@
+"""
+Instrumentació de les peticions.
+
+InstrumentacioSQL (middleware) compta les consultes SQL de cada petició,
+el temps a la BD, les consultes repetides amb la mateixa forma (el
+símptoma d'un N+1) i el temps de serialització de les respostes de
+l'API. Les xifres surten a la capçalera Server-Timing, que mostren les
+eines de desenvolupament del navegador, i s'acumulen en un resum en
+memòria per endpoint (GET /api/instrumentacio, només bibliotecaris).
+
+Només es mesura una fracció INSTRUMENTACIO_MOSTREIG de les peticions
+(0 ho desactiva; per defecte, totes amb DEBUG i cap sense); les altres
+no paguen res. El resum guarda les últimes
+INSTRUMENTACIO_FINESTRA mostres de cada endpoint i és de cada procés.
+
+La serialització va des que la vista de l'API retorna fins que la
+resposta és JSON: validació de l'esquema de sortida i codificació, sense
+les consultes que s'hi facin (que compten com a BD). A les respostes de
+sortida directa (sortida.py) només hi ha la codificació.
+"""
+import functools
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+from .sortida import RendererRapid
+
+
+logger = logging.getLogger("biblioteca.sql")
+
+_mesura_actual = ContextVar("mesura_sql", default=None)
+
+RE_CADENA = re.compile(r"'(?:[^']|'')*'")
+RE_NOMBRE = re.compile(r"\b\d+(?:\.\d+)?\b")
+RE_LLISTA = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+RE_ESPAIS = re.compile(r"\s+")
+
+
+def taxa_mostreig():
+    return getattr(settings, "INSTRUMENTACIO_MOSTREIG", 0.0)
+
+
+def forma(sql):
+    """SQL sense valors: les consultes que només canvien de paràmetres tenen la mateixa forma."""
+    sql = RE_CADENA.sub("?", sql)
+    sql = RE_NOMBRE.sub("?", sql)
+    sql = RE_LLISTA.sub("(...)", sql)
+    return RE_ESPAIS.sub(" ", sql).strip()
+
+
+class Mesura:
+    """Mesures d'una petició. És també l'execute_wrapper de les connexions."""
+
+    def __init__(self):
+        self.inici = time.perf_counter()
+        self.consultes = 0
+        self.temps_bd = 0.0
+        self.formes = Counter()
+        self.fi_vista = None
+        self.bd_fi_vista = 0.0
+        self.serialitzacio = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.temps_bd += time.perf_counter() - t0
+            self.consultes += 1
+            self.formes[forma(sql)] += 1
+
+    @property
+    def repetides(self):
+        # consultes de més respecte a fer-ne una per forma
+        return sum(n - 1 for n in self.formes.values() if n > 1)
+
+    def server_timing(self, total):
+        metriques = [
+            f"total;dur={total * 1000:.1f}",
+            f'db;dur={self.temps_bd * 1000:.1f};desc="{self.consultes} consultes"',
+        ]
+        if self.fi_vista is not None:
+            metriques.append(f"ser;dur={self.serialitzacio * 1000:.1f}")
+        if self.repetides:
+            metriques.append(f'n1;desc="{self.repetides} consultes repetides"')
+        return ", ".join(metriques)
+
+
+class ResumEndpoint:
+    def __init__(self, finestra):
+        self.mostres = deque(maxlen=finestra)
+        self.peticions = 0
+        self.formes_repetides = Counter()
+
+    def afegeix(self, total, mesura):
+        self.peticions += 1
+        self.mostres.append((total, mesura.temps_bd, mesura.consultes, mesura.repetides, mesura.serialitzacio))
+        for sql, n in mesura.formes.items():
+            if n > 1:
+                self.formes_repetides[sql] += n - 1
+        if len(self.formes_repetides) > 50:
+            # només ens interessen les pitjors
+            self.formes_repetides = Counter(dict(self.formes_repetides.most_common(20)))
+
+    def resum(self):
+        n = len(self.mostres)
+        totals = sorted(m[0] for m in self.mostres)
+        mitjana = lambda i: sum(m[i] for m in self.mostres) / n
+        return {
+            "peticions": self.peticions,
+            "mostres": n,
+            "p50_ms": round(totals[n // 2] * 1000, 2),
+            "p95_ms": round(totals[min(n - 1, int(n * 0.95))] * 1000, 2),
+            "bd_ms": round(mitjana(1) * 1000, 2),
+            "serialitzacio_ms": round(mitjana(4) * 1000, 2),
+            "consultes": round(mitjana(2), 1),
+            "consultes_max": max(m[2] for m in self.mostres),
+            "repetides": round(mitjana(3), 1),
+            "formes_repetides": [{"sql": sql, "repeticions": r} for sql, r in self.formes_repetides.most_common(5)],
+        }
+
+
+class Resum:
+    """Resum en memòria de les peticions mesurades, per endpoint."""
+
+    def __init__(self, finestra=200):
+        self.finestra = finestra
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def afegeix(self, endpoint, total, mesura):
+        with self._lock:
+            resum = self._endpoints.get(endpoint)
+            if resum is None:
+                resum = self._endpoints[endpoint] = ResumEndpoint(self.finestra)
+            resum.afegeix(total, mesura)
+
+    def buida(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def estadistiques(self):
+        with self._lock:
+            return {endpoint: resum.resum() for endpoint, resum in sorted(self._endpoints.items())}
+
+
+resum = Resum(finestra=getattr(settings, "INSTRUMENTACIO_FINESTRA", 200))
+
+
+def nom_endpoint(request):
+    # la ruta de l'URLconf (api/reserves/<int:reserva_id>), no el camí: pocs valors diferents
+    match = getattr(request, "resolver_match", None)
+    ruta = match.route if match is not None else "(sense ruta)"
+    return f"{request.method} /{ruta}"
+
+
+class InstrumentacioSQL:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        taxa = taxa_mostreig()
+        if taxa <= 0 or (taxa < 1 and random.random() >= taxa):
+            return self.get_response(request)
+
+        mesura = Mesura()
+        testimoni = _mesura_actual.set(mesura)
+        try:
+            with ExitStack() as pila:
+                for alias in connections:
+                    pila.enter_context(connections[alias].execute_wrapper(mesura))
+                response = self.get_response(request)
+        finally:
+            _mesura_actual.reset(testimoni)
+        total = time.perf_counter() - mesura.inici
+
+        response["Server-Timing"] = mesura.server_timing(total)
+        endpoint = nom_endpoint(request)
+        resum.afegeix(endpoint, total, mesura)
+        llindar = getattr(settings, "INSTRUMENTACIO_LLINDAR_REPETIDES", 10)
+        if mesura.repetides >= llindar:
+            sql, n = mesura.formes.most_common(1)[0]
+            logger.warning("%s: %d consultes repetides (possible N+1). La més repetida (%d cops): %s",
+                           endpoint, mesura.repetides, n, sql)
+        return response
+
+
+def cronometra_vista(vista):
+    """Marca quan acaba la vista: a partir d'aquí és serialització."""
+    @functools.wraps(vista)
+    def embolcall(*args, **kwargs):
+        try:
+            return vista(*args, **kwargs)
+        finally:
+            mesura = _mesura_actual.get()
+            if mesura is not None:
+                mesura.fi_vista = time.perf_counter()
+                mesura.bd_fi_vista = mesura.temps_bd
+    return embolcall
+
+
+def operacions(api):
+    """Totes les operacions de l'API (quan ja s'hi han afegit tots els routers)."""
+    for _, router in api._routers:
+        for path_view in router.path_operations.values():
+            yield from path_view.operations
+
+
+def instrumenta_api(api):
+    """Cronometra la serialització de totes les operacions de l'API (cal cridar-la al final de api.py)."""
+    for operacio in operacions(api):
+        operacio.view_func = cronometra_vista(operacio.view_func)
+
+
+def compta_serialitzacio(durada):
+    """Per a les respostes que la vista ja retorna codificades (sortida.resposta_directa)."""
+    mesura = _mesura_actual.get()
+    if mesura is not None:
+        mesura.serialitzacio += durada
+
+
+class RendererInstrumentat(RendererRapid):
+    def render(self, request, data, *, response_status):
+        contingut = super().render(request, data, response_status=response_status)
+        mesura = _mesura_actual.get()
+        if mesura is not None and mesura.fi_vista is not None:
+            # sense el temps de les consultes fetes mentre es validava l'esquema
+            durada = time.perf_counter() - mesura.fi_vista
+            mesura.serialitzacio = durada - (mesura.temps_bd - mesura.bd_fi_vista)
+        return contingut
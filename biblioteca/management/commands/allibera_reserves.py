@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca.prestecs import allibera_caducades, ofereix_lliures
+
+
+class Command(BaseCommand):
+    help = ("Allibera els exemplars apartats per reserves que no s'han recollit a temps "
+            "i els aparta per al següent de la cua (per executar cada dia des de cron). "
+            "També aparta per a la cua els exemplars lliures que hi hagi (p. ex. importats)")
+
+    def handle(self, *args, **options):
+        total = allibera_caducades()
+        self.stdout.write(self.style.SUCCESS(f"Reserves caducades: {total}"))
+        oferts = ofereix_lliures()
+        self.stdout.write(self.style.SUCCESS(f"Exemplars lliures apartats per a la cua: {oferts}"))
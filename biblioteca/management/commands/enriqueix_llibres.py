@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import enriquiment
+from biblioteca.models import Llibre, normalitza_isbn
+
+
+class Command(BaseCommand):
+    help = "Completa l'editorial, les pàgines, la data d'edició i els enllaços dels llibres amb les dades d'OpenLibrary"
+
+    def add_arguments(self, parser):
+        parser.add_argument("isbns", nargs="*", help="ISBN dels llibres a enriquir (per defecte, tots)")
+        parser.add_argument("--sobreescriu", action="store_true",
+                            help="substitueix també els camps que ja tenen valor")
+        parser.add_argument("--refresca", action="store_true",
+                            help="torna a consultar OpenLibrary encara que la resposta sigui a la memòria cau")
+        parser.add_argument("--concurrencia", type=int, help="peticions simultànies a OpenLibrary")
+
+    def handle(self, *args, **options):
+        def progres(enriquidor):
+            self.stdout.write(f"{enriquidor.llibres} llibres, {enriquidor.actualitzats} actualitzats")
+
+        llibres = Llibre.objects.all()
+        if options["isbns"]:
+            llibres = llibres.filter(ISBN__in=[normalitza_isbn(isbn) for isbn in options["isbns"]])
+        enriquidor = enriquiment.Enriquidor(sobreescriu=options["sobreescriu"], refresca=options["refresca"],
+                                            concurrencia=options["concurrencia"], progres=progres)
+        enriquidor.enriqueix(llibres)
+
+        if enriquidor.errors:
+            self.stdout.write(self.style.WARNING(
+                f"No s'han pogut consultar {len(enriquidor.errors)} ISBN (es tornaran a provar): "
+                + ", ".join(enriquidor.errors[:20]) + (" ..." if len(enriquidor.errors) > 20 else "")
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f"Enriquiment acabat: {enriquidor.llibres} llibres, {enriquidor.trobats} trobats a OpenLibrary, "
+            f"{enriquidor.actualitzats} actualitzats ({enriquidor.consultats} ISBN consultats, "
+            f"{enriquidor.de_cache} de la memòria cau)"
+        ))
@@ -0,0 +1,112 @@
+import re
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from biblioteca.models import (
+    Categoria, Exemplar, ImportacioCSV, Llibre, PostingCerca, Prestec, Reserva, TermeCerca, Usuari,
+)
+from biblioteca.paginacio import filtre_keyset
+
+
+def consultes():
+    """
+    (nom, queryset, taula_petita) de les consultes calentes de l'API i de
+    l'admin. Els valors dels filtres són d'exemple: el pla no en depèn.
+    A les taules petites un recorregut sencer és acceptable.
+    """
+    avui = date.today()
+    return [
+        ("api llibres per id", Llibre.objects.filter(filtre_keyset(("id",), [1000])).order_by("id")[:101], False),
+        ("api llibres per títol",
+         Llibre.objects.filter(filtre_keyset(("titol", "id"), ["M", 1000])).order_by("titol", "id")[:101], False),
+        ("api token (BD)", Usuari.objects.filter(auth_token="0" * 32, is_active=True), False),
+        ("préstec per registre", Exemplar.objects.filter(registre="000001"), False),
+        ("llibre per ISBN", Llibre.objects.filter(ISBN="9788400000000"), False),
+        ("exemplars prestables d'un registre",
+         Exemplar.objects.filter(cataleg_id=1, baixa=False, exclos_prestec=False), False),
+        ("préstec obert d'un exemplar", Prestec.objects.filter(exemplar_id=1, data_retorn__isnull=True), False),
+        ("api préstecs vençuts",
+         Prestec.objects.filter(data_retorn__isnull=True, data_venciment__lt=avui)
+         .order_by("data_venciment", "id")[:101], False),
+        ("marca préstecs vençuts",
+         Prestec.objects.filter(data_retorn__isnull=True, data_venciment__lt=avui, vencut=False), False),
+        ("següent de la cua de reserves", Reserva.objects.filter(cataleg_id=1, estat="espera", posicio=1), False),
+        ("api reserves d'un usuari",
+         Reserva.objects.filter(usuari_id=1, estat__in=Reserva.ESTATS_ACTIUS).order_by("data", "id"), False),
+        ("reserves caducades",
+         Reserva.objects.filter(estat="assignada", data_limit__lt=avui).order_by("data_limit", "pk")[:500], False),
+        ("cerca: termes", TermeCerca.objects.filter(terme__in=["historia", "catalunya"]), False),
+        ("cerca: millors postings", PostingCerca.objects.filter(terme_id=1).order_by("-pes")[:1000], False),
+        ("admin exemplars (prefix de registre)",
+         Exemplar.objects.filter(registre__startswith="0001").order_by("registre")[:100], False),
+        ("admin usuaris (prefix)", Usuari.objects.filter(username__startswith="anna").order_by("-pk")[:100], False),
+        ("subarbre de categories", Categoria.objects.filter(cami__startswith="00000001"), True),
+        ("importacions reclamables",
+         ImportacioCSV.objects.filter(Q(estat="pendent") | Q(estat="processant", data_batec__lt=timezone.now()))
+         .order_by("pk")[:10], True),
+    ]
+
+
+def pla(qs):
+    """Retorna (línies del pla, recorreguts sencers, avisos) segons el motor de BD."""
+    sql, params = qs.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            linies = [fila[-1] for fila in cursor.fetchall()]
+            # "SCAN taula" sense índex; "SCAN taula USING INDEX" és un recorregut ordenat per índex
+            sencers = [l for l in linies if re.match(r"SCAN \w+$", l) and "CONSTANT ROW" not in l]
+            avisos = [l for l in linies if "TEMP B-TREE" in l]
+        elif connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql, params)
+            columnes = [c[0].lower() for c in cursor.description]
+            files = [dict(zip(columnes, fila)) for fila in cursor.fetchall()]
+            linies = [
+                f"{f.get('table')}: type={f.get('type')} key={f.get('key')} rows={f.get('rows')} {f.get('extra') or ''}"
+                for f in files
+            ]
+            sencers = [l for l, f in zip(linies, files) if f.get("type") == "ALL"]
+            avisos = [l for l, f in zip(linies, files)
+                      if f.get("type") == "index" or "filesort" in (f.get("extra") or "")]
+        elif connection.vendor == "postgresql":
+            cursor.execute("EXPLAIN " + sql, params)
+            linies = [fila[0] for fila in cursor.fetchall()]
+            sencers = [l for l in linies if "Seq Scan" in l]
+            avisos = [l for l in linies if "Sort" in l]
+        else:
+            raise CommandError(f"Motor de BD no suportat: {connection.vendor}")
+    return linies, sencers, avisos
+
+
+class Command(BaseCommand):
+    help = ("Executa EXPLAIN per a les consultes calentes de l'API i l'admin (SQLite, MySQL, PostgreSQL) "
+            "i marca les que recorren taules senceres. Amb dades reals o del seeder: amb taules "
+            "gairebé buides l'optimitzador pot triar un recorregut sencer igualment.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--estricte", action="store_true",
+                            help="acaba amb error si alguna consulta recorre una taula sencera")
+        parser.add_argument("--detall", action="store_true", help="mostra el pla de totes les consultes")
+
+    def handle(self, *args, **options):
+        problemes = 0
+        for nom, qs, petita in consultes():
+            linies, sencers, avisos = pla(qs)
+            if sencers and not petita:
+                problemes += 1
+                self.stdout.write(self.style.ERROR(f"RECORREGUT SENCER  {nom}"))
+            elif sencers:
+                self.stdout.write(self.style.WARNING(f"taula petita       {nom}"))
+            elif avisos:
+                self.stdout.write(self.style.WARNING(f"ordenació extra    {nom}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"ok                 {nom}"))
+            if options["detall"] or sencers or avisos:
+                for linia in linies:
+                    self.stdout.write(f"    {linia}")
+        if problemes and options["estricte"]:
+            raise CommandError(f"{problemes} consultes recorren taules senceres")
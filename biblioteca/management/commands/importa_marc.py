@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from biblioteca import marc
+from biblioteca.massiu import MIDA_LOT
+
+
+class Command(BaseCommand):
+    help = "Importa al catàleg un fitxer MARC21 (ISO 2709 o MARCXML), amb els seus exemplars"
+
+    def add_arguments(self, parser):
+        parser.add_argument("fitxer")
+        parser.add_argument("--format", choices=["auto", "iso2709", "marcxml"], default="auto")
+        parser.add_argument("--des-de", type=int, default=0,
+                            help="posició des d'on reprendre una importació interrompuda "
+                                 "(byte a ISO 2709, número de registre a MARCXML)")
+        parser.add_argument("--mida-lot", type=int, default=MIDA_LOT)
+        parser.add_argument("--errors", type=int, default=20, help="errors a mostrar (0: cap)")
+
+    def handle(self, *args, **options):
+        def progres(importador):
+            self.stdout.write(f"{importador.registres} registres llegits, {importador.creats} creats, "
+                              f"{importador.actualitzats} actualitzats; per reprendre: --des-de {importador.posicio}")
+
+        importador = marc.ImportadorMARC(mida_lot=options["mida_lot"], progres=progres)
+        try:
+            with open(options["fitxer"], "rb") as fitxer:
+                importador.procesa(marc.lector(fitxer, options["format"], options["des_de"]))
+        except OSError as e:
+            raise CommandError(str(e))
+        finally:
+            importador.finalitza()
+
+        errors = importador.errors
+        for error in errors[:options["errors"]]:
+            self.stdout.write(self.style.WARNING(f"{error['linia']}: {error['error']}"))
+        if len(errors) > options["errors"]:
+            self.stdout.write(self.style.WARNING(f"... i {len(errors) - options['errors']} errors més"))
+        for tipus, xifres in importador.per_tipus().items():
+            self.stdout.write(f"{tipus}: {xifres['creats']} creats, {xifres['actualitzats']} actualitzats, "
+                              f"{xifres['exemplars']} exemplars")
+        self.stdout.write(self.style.SUCCESS(
+            f"Importació acabada: {importador.registres} registres, {importador.creats} creats, "
+            f"{importador.actualitzats} actualitzats, {importador.exemplars} exemplars, {len(errors)} errors"
+        ))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from biblioteca.importacio import procesa_importacio, reclama_importacio
+
+
+class Command(BaseCommand):
+    help = "Processa les importacions de CSV d'usuaris pendents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=2.0,
+                            help="segons d'espera quan no hi ha feina")
+        parser.add_argument("--una-vegada", action="store_true",
+                            help="processa les pendents i acaba")
+
+    def handle(self, *args, **options):
+        while True:
+            importacio = reclama_importacio()
+            if importacio is None:
+                if options["una_vegada"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+            self.stdout.write(f"Processant importació {importacio.pk} ({importacio.nom_fitxer})...")
+            procesa_importacio(importacio)
+            importacio.refresh_from_db()
+            self.stdout.write(f"Importació {importacio.pk}: {importacio.estat}, "
+                              f"{importacio.usuaris_creats} usuaris creats")
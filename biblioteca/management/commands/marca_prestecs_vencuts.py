@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from biblioteca.prestecs import marca_vencuts
+
+
+class Command(BaseCommand):
+    help = "Marca com a vençuts els préstecs oberts amb la data de venciment passada (per executar cada nit)"
+
+    def handle(self, *args, **options):
+        inici = time.perf_counter()
+        marcats, desmarcats = marca_vencuts()
+        self.stdout.write(self.style.SUCCESS(
+            f"Préstecs vençuts nous: {marcats}, ja no vençuts: {desmarcats} "
+            f"({time.perf_counter() - inici:.2f} s)"
+        ))
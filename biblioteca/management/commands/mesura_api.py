@@ -0,0 +1,268 @@
+import base64
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from biblioteca.models import Centre, Cicle, Exemplar, Llibre, Prestec, Usuari
+
+
+# Mides de les bases de dades de mesura (--sembra), en exemplars
+ESCALES = {
+    "10k": dict(libros=2_000, ejemplares=10_000, otros=200, usuarios=500, prestamos=10_000, reservas=500),
+    "100k": dict(libros=20_000, ejemplares=100_000, otros=2_000, usuarios=5_000, prestamos=100_000, reservas=5_000),
+    "1m": dict(libros=200_000, ejemplares=1_000_000, otros=20_000, usuarios=50_000, prestamos=1_000_000,
+               reservas=50_000),
+}
+SEMILLA = 1234
+SEEDER = Path(settings.BASE_DIR) / "seeder" / "seeder.py"
+DOMINI_CSV = "mesura-api.invalid"
+NOM_CSV = "Mesura API"
+FILES_CSV = 10
+
+
+def percentil(ordenats, p):
+    if not ordenats:
+        return None
+    return ordenats[min(len(ordenats) - 1, int(len(ordenats) * p))]
+
+
+def rss_actual_kb():
+    # Linux; a la resta de sistemes només tenim el pic del procés
+    try:
+        with open("/proc/self/status") as f:
+            for linia in f:
+                if linia.startswith("VmRSS:"):
+                    return int(linia.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MonitorRSS(threading.Thread):
+    """Mostreja la memòria del procés mentre dura la mesura d'un endpoint."""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.pic = rss_actual_kb()
+        self.atura = threading.Event()
+
+    def run(self):
+        while not self.atura.wait(self.interval):
+            self.pic = max(self.pic, rss_actual_kb())
+
+
+class Command(BaseCommand):
+    help = ("Mesura la latència (p50/p95/p99), el rendiment, les consultes SQL i la memòria de "
+            "l'API i de l'admin amb diversos clients en paral·lel, i en desa el resultat en JSON "
+            "per comparar execucions. Amb --sembra omple abans una base de dades buida amb el seeder.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sembra", choices=ESCALES,
+                            help="omple la base de dades (ha d'estar buida) amb aquesta quantitat d'exemplars")
+        parser.add_argument("--clients", type=int, default=4)
+        parser.add_argument("--peticions", type=int, default=25, help="peticions per client i endpoint")
+        parser.add_argument("--escalfament", type=int, default=2,
+                            help="peticions per client que no es compten, abans de cada endpoint")
+        parser.add_argument("--endpoints", help="llista separada per comes (per defecte, tots)")
+        parser.add_argument("--sortida", help="fitxer JSON de resultats (per defecte, per pantalla)")
+
+    def handle(self, *args, **options):
+        if options["sembra"]:
+            self.sembra(options["sembra"])
+        self.host = next((h for h in settings.ALLOWED_HOSTS if h != "*" and not h.startswith(".")),
+                         "localhost")
+        self.marca = uuid.uuid4().hex[:8]
+        self.comptador_csv = 0
+        self.lock = threading.Lock()
+
+        endpoints = self.endpoints()
+        if options["endpoints"]:
+            noms = options["endpoints"].split(",")
+            desconeguts = set(noms) - set(endpoints)
+            if desconeguts:
+                raise CommandError(f"Endpoints desconeguts: {', '.join(sorted(desconeguts))}. "
+                                   f"Disponibles: {', '.join(endpoints)}")
+            endpoints = {nom: endpoints[nom] for nom in noms}
+
+        self.password = uuid.uuid4().hex
+        self.usuari = Usuari.objects.create_superuser(
+            username=f"mesura-api-{self.marca}", email="", password=self.password,
+        )
+        centres = set(Centre.objects.filter(nom=NOM_CSV).values_list("pk", flat=True))
+        cicles = set(Cicle.objects.filter(nom=NOM_CSV).values_list("pk", flat=True))
+        resultats = []
+        try:
+            for nom, peticio in endpoints.items():
+                resultat = self.mesura(nom, peticio, options)
+                resultats.append(resultat)
+                self.stderr.write(
+                    f"{nom:18} p50 {resultat['p50_ms']} ms  p95 {resultat['p95_ms']} ms  "
+                    f"p99 {resultat['p99_ms']} ms  {resultat['peticions_per_segon']} pet/s  "
+                    f"{resultat['consultes_mitjana']} consultes  errors {resultat['errors']}"
+                )
+        finally:
+            # usuaris i centres creats per la mesura
+            Usuari.objects.filter(email__endswith="@" + DOMINI_CSV).delete()
+            Centre.objects.filter(nom=NOM_CSV).exclude(pk__in=centres).delete()
+            Cicle.objects.filter(nom=NOM_CSV).exclude(pk__in=cicles).delete()
+            self.usuari.delete()
+
+        informe = {
+            "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "bd": connection.vendor,
+            "python": sys.version.split()[0],
+            "clients": options["clients"],
+            "peticions_per_client": options["peticions"],
+            "dades": {
+                "llibres": Llibre.objects.count(),
+                "exemplars": Exemplar.objects.count(),
+                "usuaris": Usuari.objects.count(),
+                "prestecs": Prestec.objects.count(),
+            },
+            "rss_pic_proces_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "endpoints": resultats,
+        }
+        text = json.dumps(informe, indent=2, ensure_ascii=False)
+        if options["sortida"]:
+            Path(options["sortida"]).write_text(text + "\n", encoding="utf-8")
+        else:
+            self.stdout.write(text)
+
+    def sembra(self, escala):
+        if Exemplar.objects.exists() or Usuari.objects.exists():
+            raise CommandError("--sembra necessita una base de dades buida (migrada i sense dades)")
+        ordre = [sys.executable, str(SEEDER), "--semilla", str(SEMILLA)]
+        for clau, valor in ESCALES[escala].items():
+            ordre += [f"--{clau}", str(valor)]
+        self.stderr.write(f"Sembrant {escala} exemplars: {' '.join(ordre[1:])}")
+        # en un altre procés, amb el mateix entorn (DATABASE_URL...)
+        connection.close()
+        if subprocess.run(ordre, cwd=settings.BASE_DIR).returncode:
+            raise CommandError("El seeder ha fallat")
+
+    def endpoints(self):
+        """{nom: funció(client) -> resposta}"""
+        def get(ruta, **extra):
+            return lambda client: client.get(ruta, **extra)
+
+        return {
+            "llibres": get("/api/llibres?limit=100"),
+            "llibres-titol": get("/api/llibres?limit=100&ordre=titol"),
+            "exemplars": get("/api/exemplars"),
+            "token": lambda client: client.get("/api/token", HTTP_AUTHORIZATION=self.basic_auth()),
+            "login": lambda client: client.post(
+                "/api/login", {"username": self.usuari.username, "password": self.password},
+                content_type="application/json",
+            ),
+            "subir-documento": lambda client: client.post("/api/subir-documento/", {"archivo": self.csv()}),
+            "admin-llibres": get("/admin/biblioteca/llibre/"),
+            "admin-exemplars": get("/admin/biblioteca/exemplar/"),
+            "admin-prestecs": get("/admin/biblioteca/prestec/"),
+            "admin-reserves": get("/admin/biblioteca/reserva/"),
+            "admin-usuaris": get("/admin/biblioteca/usuari/"),
+        }
+
+    def basic_auth(self):
+        credencials = f"{self.usuari.username}:{self.password}".encode()
+        return "Basic " + base64.b64encode(credencials).decode()
+
+    def csv(self):
+        # cada pujada crea usuaris nous: correus únics, esborrats en acabar
+        with self.lock:
+            self.comptador_csv += 1
+            n = self.comptador_csv
+        files = ["nom,cognom1,cognom2,email,telefon,centre,grup"]
+        files += [f"Mesura,Api,Prova,u{self.marca}.{n}.{i}@{DOMINI_CSV},600000000,{NOM_CSV},{NOM_CSV}"
+                  for i in range(FILES_CSV)]
+        return SimpleUploadedFile("mesura.csv", "\n".join(files).encode(), content_type="text/csv")
+
+    def mesura(self, nom, peticio, options):
+        latencies = []
+        consultes = []
+        resultats = {"errors": 0, "estats": {}}
+        lock = threading.Lock()
+        inici = threading.Barrier(options["clients"] + 1)
+
+        def client():
+            navegador = Client(HTTP_HOST=self.host)
+            navegador.force_login(self.usuari)
+            comptador = [0]
+
+            def compta(execute, sql, params, many, context):
+                comptador[0] += 1
+                return execute(sql, params, many, context)
+
+            temps, nombres, estats, errors = [], [], {}, 0
+            try:
+                with connection.execute_wrapper(compta):
+                    try:
+                        for _ in range(options["escalfament"]):
+                            peticio(navegador)
+                    finally:
+                        inici.wait()
+                    for _ in range(options["peticions"]):
+                        comptador[0] = 0
+                        t0 = time.perf_counter()
+                        try:
+                            resposta = peticio(navegador)
+                            estat = resposta.status_code
+                            if hasattr(resposta, "streaming_content"):
+                                b"".join(resposta.streaming_content)
+                        except Exception:
+                            estat = "excepcio"
+                        temps.append(time.perf_counter() - t0)
+                        nombres.append(comptador[0])
+                        estats[estat] = estats.get(estat, 0) + 1
+                        if estat == "excepcio" or estat >= 400:
+                            errors += 1
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(temps)
+                consultes.extend(nombres)
+                resultats["errors"] += errors
+                for estat, n in estats.items():
+                    resultats["estats"][str(estat)] = resultats["estats"].get(str(estat), 0) + n
+
+        fils = [threading.Thread(target=client) for _ in range(options["clients"])]
+        for fil in fils:
+            fil.start()
+        monitor = MonitorRSS()
+        inici.wait()
+        monitor.start()
+        t0 = time.perf_counter()
+        for fil in fils:
+            fil.join()
+        durada = time.perf_counter() - t0
+        monitor.atura.set()
+        monitor.join()
+
+        latencies.sort()
+        ms = lambda segons: None if segons is None else round(segons * 1000, 2)
+        return {
+            "endpoint": nom,
+            "peticions": len(latencies),
+            "errors": resultats["errors"],
+            "estats": resultats["estats"],
+            "durada_s": round(durada, 3),
+            "peticions_per_segon": round(len(latencies) / durada, 1) if durada else None,
+            "p50_ms": ms(percentil(latencies, 0.50)),
+            "p95_ms": ms(percentil(latencies, 0.95)),
+            "p99_ms": ms(percentil(latencies, 0.99)),
+            "max_ms": ms(latencies[-1] if latencies else None),
+            "consultes_mitjana": round(sum(consultes) / len(consultes), 1) if consultes else None,
+            "consultes_max": max(consultes, default=None),
+            "rss_pic_kb": monitor.pic,
+        }
@@ -0,0 +1,100 @@
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from biblioteca import prestecs
+from biblioteca.models import Exemplar, Prestec, Usuari
+
+
+class Command(BaseCommand):
+    help = ("Mesura el rendiment de préstec/retorn amb diversos clients en paral·lel. "
+            "Fa préstecs reals sobre exemplars lliures i en acabar els esborra.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8)
+        parser.add_argument("--operacions", type=int, default=100,
+                            help="cicles préstec + retorn per client")
+        parser.add_argument("--exemplars", type=int, default=50,
+                            help="nombre d'exemplars lliures que es fan servir")
+        parser.add_argument("--contencio", action="store_true",
+                            help="tots els clients competeixen pels mateixos exemplars")
+        parser.add_argument("--conserva", action="store_true",
+                            help="no esborra els préstecs creats")
+
+    def handle(self, *args, **options):
+        usuari = Usuari.objects.filter(is_active=True).order_by("pk").first()
+        lliures = list(
+            Exemplar.objects.filter(baixa=False, exclos_prestec=False)
+            .exclude(pk__in=Prestec.objects.filter(data_retorn__isnull=True).values("exemplar_id"))
+            .order_by("pk").values_list("pk", flat=True)[:options["exemplars"]]
+        )
+        if usuari is None or not lliures:
+            raise CommandError("Calen almenys un usuari actiu i un exemplar prestable lliure")
+        if not options["contencio"] and len(lliures) < options["clients"]:
+            raise CommandError("Sense --contencio cal almenys un exemplar per client")
+
+        inici_id = Prestec.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+        latencies = []
+        resultats = {"ok": 0, "conflictes": 0, "errors": 0}
+        lock = threading.Lock()
+
+        def client(n):
+            propis = lliures if options["contencio"] else lliures[n::options["clients"]]
+            aleatori = random.Random(n)
+            locals_ = {"ok": 0, "conflictes": 0, "errors": 0}
+            temps = []
+            try:
+                for _ in range(options["operacions"]):
+                    exemplar_id = aleatori.choice(propis)
+                    for operacio in (
+                        lambda: prestecs.checkout(exemplar_id=exemplar_id, usuari_id=usuari.pk),
+                        lambda: prestecs.checkin(exemplar_id=exemplar_id),
+                    ):
+                        t0 = time.perf_counter()
+                        try:
+                            operacio()
+                            locals_["ok"] += 1
+                        except prestecs.ErrorPrestec:
+                            locals_["conflictes"] += 1
+                        except Exception:
+                            locals_["errors"] += 1
+                        temps.append(time.perf_counter() - t0)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(temps)
+                for clau, valor in locals_.items():
+                    resultats[clau] += valor
+
+        fils = [threading.Thread(target=client, args=(n,)) for n in range(options["clients"])]
+        t0 = time.perf_counter()
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+        durada = time.perf_counter() - t0
+
+        oberts = Prestec.objects.filter(pk__gt=inici_id, data_retorn__isnull=True).count()
+        if not options["conserva"]:
+            for prestec in Prestec.objects.filter(pk__gt=inici_id):
+                # un per un perquè els senyals mantinguin els comptadors
+                prestec.delete()
+
+        latencies.sort()
+        total = len(latencies)
+        self.stdout.write(f"Clients: {options['clients']}, operacions: {total}, durada: {durada:.2f} s")
+        self.stdout.write(f"Rendiment: {total / durada:.1f} op/s")
+        self.stdout.write(f"Correctes: {resultats['ok']}, conflictes (409/404): {resultats['conflictes']}, "
+                          f"errors de BD: {resultats['errors']}")
+        if total:
+            self.stdout.write(
+                f"Latència ms: mitjana {statistics.mean(latencies) * 1000:.1f}, "
+                f"p50 {latencies[total // 2] * 1000:.1f}, "
+                f"p95 {latencies[min(total - 1, int(total * 0.95))] * 1000:.1f}, "
+                f"màx {latencies[-1] * 1000:.1f}"
+            )
+        self.stdout.write(f"Préstecs oberts en acabar: {oberts}")
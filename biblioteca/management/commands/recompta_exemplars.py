@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import comptadors
+
+
+class Command(BaseCommand):
+    help = "Recalcula els comptadors d'exemplars, préstecs i reserves del catàleg"
+
+    def add_arguments(self, parser):
+        parser.add_argument("catalegs", nargs="*", type=int,
+                            help="ids del catàleg a recomptar (per defecte, tots)")
+
+    def handle(self, *args, **options):
+        total = comptadors.recompta(options["catalegs"] or None)
+        self.stdout.write(self.style.SUCCESS(f"Comptadors recalculats: {total} registres"))
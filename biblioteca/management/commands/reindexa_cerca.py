@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import cerca
+
+
+class Command(BaseCommand):
+    help = "Reconstrueix l'índex de cerca del catàleg"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mida-bloc", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        total = cerca.reindexa_tot(options["mida_bloc"], sortida=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f"Índex reconstruït: {total} documents"))
@@ -0,0 +1,417 @@
+"""
+Importació de registres MARC21 (ISO 2709 o MARCXML).
+
+Els fitxers es llegeixen registre a registre (ISO 2709) o amb iterparse
+(MARCXML), de manera que la memòria no depèn de la mida del fitxer. Cada
+registre es converteix en una fila d'importacio_cataleg segons el tipus
+de registre de la capçalera (llibre, revista, cd, dvd o br) i s'importa
+amb el mateix motor: lots, upsert per ISBN/ISSN i informe d'errors (amb
+la posició del registre com a línia). Els exemplars surten dels camps de
+fons 852 i 952 (Koha): el registre ($p) i, al 952, exclòs de préstec
+($7) i baixa ($0, $1).
+
+La posició d'un registre és el byte on comença (ISO 2709) o el seu
+ordinal (MARCXML). Després de cada lot, `ImportadorMARC.posicio` és la
+del registre següent: si la importació s'interromp, es reprèn des d'allà
+(`des_de`) sense tornar a llegir ni escriure el que ja s'ha confirmat.
+
+Els registres que no declaren UTF-8 (capçalera, posició 9) solen ser
+MARC-8: es llegeixen com a UTF-8 si ho són i, si no, com a Latin-1, i
+els caràcters combinats de MARC-8 es poden perdre.
+"""
+import re
+from datetime import date
+from xml.etree import ElementTree
+
+from .importacio_cataleg import TIPUS, ImportadorCataleg
+from .massiu import MIDA_LOT
+
+
+FI_CAMP = b"\x1e"
+FI_REGISTRE = b"\x1d"
+SUBCAMP = "\x1f"
+# la longitud del registre (5 xifres) inclou la capçalera de 24 bytes
+LONGITUD_MINIMA = 24
+LONGITUD_MAXIMA = 99999
+
+# codis MARC de llengua (041, 008/35-37) -> nom de Llengua
+LLENGUES = {
+    "cat": "Català",
+    "spa": "Castellà",
+    "eng": "Anglès",
+    "fre": "Francès",
+    "ger": "Alemany",
+    "ita": "Italià",
+    "por": "Portuguès",
+    "glg": "Gallec",
+    "baq": "Basc",
+    "oci": "Occità",
+    "ara": "Àrab",
+    "chi": "Xinès",
+    "lat": "Llatí",
+}
+# per als camps obligatoris de CD, DVD i BR que el registre no porta
+DESCONEGUT = "Desconegut"
+
+
+class ErrorMARC(ValueError):
+    pass
+
+
+class Registre:
+    """Capçalera i camps d'un registre: (etiqueta, text) de control o (etiqueta, [(codi, valor)])."""
+
+    def __init__(self, capcalera, camps):
+        self.capcalera = capcalera
+        self.camps = camps
+
+    def control(self, etiqueta):
+        for tag, valor in self.camps:
+            if tag == etiqueta and isinstance(valor, str):
+                return valor
+        return ""
+
+    def dades(self, *etiquetes):
+        return [valor for tag, valor in self.camps if tag in etiquetes and not isinstance(valor, str)]
+
+    def subcamps(self, etiqueta, codi):
+        return [valor for subcamps in self.dades(etiqueta) for c, valor in subcamps if c == codi]
+
+    def primer(self, etiquetes, codi):
+        for etiqueta in etiquetes.split():
+            for valor in self.subcamps(etiqueta, codi):
+                if valor.strip():
+                    return valor.strip()
+        return None
+
+
+# Lectura
+
+def descodifica(dades, utf8):
+    try:
+        return dades.decode("utf-8")
+    except UnicodeDecodeError:
+        if utf8:
+            return dades.decode("utf-8", "replace")
+        return dades.decode("latin-1")
+
+
+def registre_iso2709(dades):
+    capcalera = dades[:24].decode("ascii", "replace")
+    try:
+        base = int(capcalera[12:17])
+    except ValueError:
+        raise ErrorMARC("Capçalera no vàlida")
+    directori = dades[24:base].rstrip(FI_CAMP)
+    if len(directori) % 12:
+        raise ErrorMARC("Directori no vàlid")
+    utf8 = capcalera[9] == "a"
+    camps = []
+    for i in range(0, len(directori), 12):
+        entrada = directori[i:i + 12].decode("ascii", "replace")
+        etiqueta = entrada[:3]
+        try:
+            llargada, inici = int(entrada[3:7]), int(entrada[7:12])
+        except ValueError:
+            raise ErrorMARC(f"Entrada de directori no vàlida: {entrada}")
+        text = descodifica(dades[base + inici:base + inici + llargada].rstrip(FI_CAMP + FI_REGISTRE), utf8)
+        if etiqueta < "010":
+            camps.append((etiqueta, text))
+        else:
+            camps.append((etiqueta, [(part[:1], part[1:]) for part in text[2:].split(SUBCAMP)[1:] if part]))
+    return Registre(capcalera, camps)
+
+
+class LectorISO2709:
+    """
+    Itera (posició, registre, error) d'un fitxer binari ISO 2709 a partir
+    del byte `des_de`. `posicio` és, en cada moment, la del registre següent.
+    """
+
+    def __init__(self, fitxer, des_de=0):
+        self.fitxer = fitxer
+        self.posicio = des_de
+        if des_de:
+            fitxer.seek(des_de)
+
+    def __iter__(self):
+        while True:
+            capcalera = self.fitxer.read(5)
+            # salts de línia entre registres
+            while capcalera[:1] in (b"\n", b"\r", b" "):
+                self.posicio += 1
+                capcalera = capcalera[1:] + self.fitxer.read(1)
+            if not capcalera:
+                return
+            posicio = self.posicio
+            if len(capcalera) < 5 or not capcalera.isdigit():
+                raise ErrorMARC(f"No hi ha cap registre ISO 2709 a la posició {posicio}")
+            longitud = int(capcalera)
+            if not LONGITUD_MINIMA <= longitud <= LONGITUD_MAXIMA:
+                # no se sap on acaba: no es pot saltar per continuar amb el següent
+                raise ErrorMARC(f"Longitud de registre no vàlida ({longitud}) a la posició {posicio}")
+            resta = self.fitxer.read(longitud - 5)
+            if len(resta) < longitud - 5:
+                raise ErrorMARC(f"Registre incomplet a la posició {posicio}")
+            self.posicio += longitud
+            try:
+                registre, error = registre_iso2709(capcalera + resta), None
+            except ErrorMARC as e:
+                registre, error = None, str(e)
+            yield posicio, registre, error
+
+
+def nom_local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def registre_xml(element):
+    capcalera, camps = "", []
+    for fill in element:
+        nom = nom_local(fill.tag)
+        if nom == "leader":
+            capcalera = fill.text or ""
+        elif nom == "controlfield":
+            camps.append((fill.get("tag", ""), fill.text or ""))
+        elif nom == "datafield":
+            camps.append((fill.get("tag", ""), [(s.get("code", ""), s.text or "") for s in fill
+                                                if nom_local(s.tag) == "subfield"]))
+    return Registre(capcalera.ljust(24), camps)
+
+
+class LectorMARCXML:
+    """Itera (ordinal, registre, error) d'un MARCXML a partir del registre `des_de`."""
+
+    def __init__(self, fitxer, des_de=0):
+        self.fitxer = fitxer
+        self.des_de = des_de
+        self.posicio = des_de
+
+    def __iter__(self):
+        arrel = None
+        ordinal = 0
+        try:
+            for esdeveniment, element in ElementTree.iterparse(self.fitxer, events=("start", "end")):
+                if esdeveniment == "start":
+                    if arrel is None:
+                        arrel = element
+                    continue
+                if nom_local(element.tag) != "record":
+                    continue
+                if ordinal >= self.des_de:
+                    self.posicio = ordinal + 1
+                    yield ordinal, registre_xml(element), None
+                ordinal += 1
+                # els registres ja llegits no es queden a l'arbre
+                arrel.clear()
+        except ElementTree.ParseError as e:
+            raise ErrorMARC(f"XML no vàlid després del registre {ordinal}: {e}")
+
+
+def detecta_format(fitxer):
+    """"marcxml" o "iso2709" segons el començament del fitxer (que ha de ser seekable)."""
+    inici = fitxer.read(64)
+    fitxer.seek(0)
+    return "marcxml" if inici.lstrip(b"\xef\xbb\xbf \r\n\t").startswith(b"<") else "iso2709"
+
+
+def lector(fitxer, format="auto", des_de=0):
+    if format == "auto":
+        format = detecta_format(fitxer)
+    return (LectorMARCXML if format == "marcxml" else LectorISO2709)(fitxer, des_de)
+
+
+# Correspondència MARC -> catàleg
+
+RE_ANY = re.compile(r"(?<!\d)(1[5-9]\d\d|20\d\d)(?!\d)")
+RE_NOMBRE = re.compile(r"\d+")
+RE_MINUTS = re.compile(r"(\d+)\s*min")
+
+
+def neteja(text):
+    # puntuació ISBD final ("Títol :", "Autor,", "Editorial ;")
+    return text.strip().rstrip(" /:;,=").strip() if text else text
+
+
+def tipus_registre(registre):
+    tipus, nivell = registre.capcalera[6], registre.capcalera[7]
+    if tipus in "at":
+        return "revista" if nivell == "s" else "llibre"
+    if tipus in "ij":
+        return "cd"
+    if tipus == "g":
+        descripcio = " ".join(valor for subcamps in registre.dades("300", "338", "538")
+                              for _, valor in subcamps).lower()
+        return "br" if "blu-ray" in descripcio or "bluray" in descripcio else "dvd"
+    return None
+
+
+def duracio(registre):
+    # 306 $a: hhmmss
+    text = registre.primer("306", "a")
+    if text and text.isdigit() and len(text) == 6:
+        return f"{text[:2]}:{text[2:4]}:{text[4:]}"
+    minuts = RE_MINUTS.search(registre.primer("300", "a") or "")
+    if minuts:
+        minuts = min(int(minuts.group(1)), 24 * 60 - 1)
+        return f"{minuts // 60:02d}:{minuts % 60:02d}:00"
+    return "00:00:00"
+
+
+def exemplars(registre):
+    resultat = []
+    for subcamps in registre.dades("852", "952"):
+        valors = dict(subcamps)
+        if not (valors.get("p") or "").strip():
+            continue
+        # sense $7 l'exemplar es podia prestar
+        exemplar = {"registre": valors["p"].strip(), "exclos_prestec": (valors.get("7") or "0").strip() not in ("", "0")}
+        if "0" in valors or "1" in valors:
+            exemplar["baixa"] = any((valors.get(c) or "0").strip() not in ("", "0") for c in "01")
+        resultat.append(exemplar)
+    return resultat
+
+
+def fila_marc(registre):
+    """(tipus, fila d'importacio_cataleg) d'un registre MARC."""
+    tipus = tipus_registre(registre)
+    if tipus is None:
+        raise ErrorMARC(f"Tipus de registre no suportat: {registre.capcalera[6:8]!r}")
+    model = TIPUS[tipus]
+    camp_titol = (registre.dades("245") or [[]])[0]
+    fila = {
+        "titol": " ".join(neteja(valor) for codi, valor in camp_titol if codi in "abnp" and valor.strip()),
+        "titol_original": neteja(registre.primer("240 130", "a")),
+        "autor": neteja(registre.primer("100 110 111 700 710", "a")),
+        "CDU": registre.primer("080", "a"),
+        "signatura": registre.primer("852", "h") or registre.primer("952", "o"),
+        "resum": "\n".join(v.strip() for v in registre.subcamps("520", "a")) or None,
+        "anotacions": "\n".join(v.strip() for v in registre.subcamps("500", "a")) or None,
+        "mides": neteja(registre.primer("300", "c")),
+        "tags": sorted({neteja(v).rstrip(".") for v in registre.subcamps("650", "a") if neteja(v)}),
+        "exemplars": exemplars(registre),
+    }
+    any_edicio = RE_ANY.search(registre.primer("264 260", "c") or registre.control("008")[7:11])
+    if any_edicio:
+        fila["data_edicio"] = date(int(any_edicio.group(1)), 1, 1).isoformat()
+    editorial = neteja(registre.primer("264 260", "b"))
+    codi_llengua = (registre.primer("041", "a") or registre.control("008")[35:38]).strip().lower()
+
+    if tipus in ("llibre", "revista"):
+        fila["editorial"] = editorial
+        fila["lloc"] = neteja(registre.primer("264 260", "a"))
+        fila["llengua"] = LLENGUES.get(codi_llengua)
+        pagines = RE_NOMBRE.search(registre.primer("300", "a") or "")
+        fila["pagines"] = int(pagines.group()) if pagines else None
+    if tipus == "llibre":
+        isbn = registre.primer("020", "a")
+        fila["ISBN"] = isbn.split()[0] if isbn else None
+        fila["colleccio"] = neteja(registre.primer("490 830", "a"))
+    elif tipus == "revista":
+        issn = registre.primer("022", "a")
+        fila["ISSN"] = issn.split()[0] if issn else None
+    elif tipus == "cd":
+        fila["discografica"] = neteja(registre.primer("028", "b")) or editorial or DESCONEGUT
+        fila["estil"] = neteja(registre.primer("655 650", "a")) or DESCONEGUT
+        fila["duracio"] = duracio(registre)
+    else:
+        fila["productora"] = editorial or neteja(registre.primer("508", "a")) or DESCONEGUT
+        fila["duracio"] = duracio(registre)
+
+    # els textos llargs es retallen a la mida del camp en lloc de rebutjar el
+    # registre (menys els identificadors, que encara s'han de normalitzar)
+    for nom, valor in fila.items():
+        if isinstance(valor, str) and nom not in ("ISBN", "ISSN"):
+            maxim = model._meta.get_field(nom).max_length
+            if maxim:
+                fila[nom] = valor[:maxim]
+    return tipus, {nom: valor for nom, valor in fila.items() if valor not in (None, "", [])}
+
+
+class ImportadorMARC:
+    """
+    Ús:
+        importador = ImportadorMARC()
+        importador.procesa(lector(fitxer, des_de=posicio))
+        importador.finalitza()
+        importador.creats, importador.actualitzats, importador.errors, importador.posicio
+
+    Cada lot de registres es reparteix per tipus entre els importadors
+    d'importacio_cataleg. `progres`, si s'indica, es crida després de cada
+    lot, quan `posicio` ja és la del registre següent.
+    """
+
+    def __init__(self, mida_lot=MIDA_LOT, progres=None):
+        self.mida_lot = mida_lot
+        self.progres = progres
+        self.importadors = {}
+        self.registres = 0
+        self.posicio = None
+        self._errors = []
+
+    def procesa(self, lector):
+        self.posicio = lector.posicio
+        lot = []
+        try:
+            for posicio, registre, error in lector:
+                self.registres += 1
+                if error is None:
+                    try:
+                        lot.append((posicio, *fila_marc(registre)))
+                    except ErrorMARC as e:
+                        error = str(e)
+                if error is not None:
+                    self._errors.append({"linia": posicio, "error": error, "fila": {}})
+                if len(lot) >= self.mida_lot:
+                    self._procesa_lot(lot)
+                    lot = []
+                    self.posicio = lector.posicio
+                    self._avisa()
+        except ErrorMARC as e:
+            # el fitxer no es pot continuar llegint: s'importa el que ja s'ha llegit
+            self._errors.append({"linia": lector.posicio, "error": str(e), "fila": {}})
+        if lot:
+            self._procesa_lot(lot)
+        self.posicio = lector.posicio
+        self._avisa()
+        return self
+
+    def _procesa_lot(self, lot):
+        per_tipus = {}
+        for posicio, tipus, fila in lot:
+            per_tipus.setdefault(tipus, []).append((posicio, fila))
+        for tipus, files in per_tipus.items():
+            if tipus not in self.importadors:
+                self.importadors[tipus] = ImportadorCataleg(tipus, self.mida_lot)
+            self.importadors[tipus].procesa_lot(files)
+
+    def _avisa(self):
+        if self.progres:
+            self.progres(self)
+
+    def finalitza(self):
+        for importador in self.importadors.values():
+            importador.finalitza()
+
+    @property
+    def creats(self):
+        return sum(i.creats for i in self.importadors.values())
+
+    @property
+    def actualitzats(self):
+        return sum(i.actualitzats for i in self.importadors.values())
+
+    @property
+    def exemplars(self):
+        return sum(i.exemplars for i in self.importadors.values())
+
+    @property
+    def errors(self):
+        errors = self._errors + [e for i in self.importadors.values() for e in i.errors]
+        return sorted(errors, key=lambda error: error["linia"])
+
+    def per_tipus(self):
+        return {
+            tipus: {"creats": i.creats, "actualitzats": i.actualitzats, "exemplars": i.exemplars}
+            for tipus, i in sorted(self.importadors.items())
+        }
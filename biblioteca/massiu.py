@@ -0,0 +1,83 @@
+"""
+Insercions massives.
+
+bulk_create no admet els subtipus del catàleg (Llibre, Revista, CD...)
+perquè hereten de Cataleg amb herència multitaula. `crea_subtipus` hi
+dona la volta: primer insereix les files de Cataleg amb bulk_create i
+després les del subtipus, amb el mateix id, amb un INSERT múltiple per
+lot. Com bulk_create, no crida save() ni envia senyals: després cal
+recomptar els comptadors (comptadors.recompta) i reindexar la cerca
+(cerca.reindexa_tot).
+
+MySQL no retorna els ids d'un INSERT múltiple. Amb exclusiu=True (el
+seeder, que té la BD per a ell sol) es reserven a partir de Max(pk); si
+no, les files de Cataleg s'insereixen una a una i cada INSERT dona el
+seu id, de manera que les insercions concurrents (admin, API) no hi
+topen. PostgreSQL i SQLite sempre les insereixen per lots.
+"""
+from django.db import connections, router
+from django.db.models import Max
+
+
+MIDA_LOT = 2000
+
+
+def lots(llista, mida):
+    for i in range(0, len(llista), mida):
+        yield llista[i:i + mida]
+
+
+def crea_subtipus(model, objs, mida_lot=MIDA_LOT, exclusiu=False):
+    """
+    Insereix `objs` (instàncies noves d'un subtipus de Cataleg) i els
+    deixa el pk assignat. Cal cridar-la dins d'una transacció. exclusiu:
+    ningú més insereix al catàleg mentrestant.
+    """
+    if not objs:
+        return objs
+    pares = model._meta.get_parent_list()
+    if len(pares) != 1:
+        raise ValueError(f"{model.__name__} no és un subtipus directe")
+    pare = pares[0]
+    enllac = model._meta.parents[pare]
+    db = router.db_for_write(model)
+    connection = connections[db]
+
+    camps_pare = [f for f in pare._meta.concrete_fields if not f.primary_key]
+    files_pare = [pare(**{f.attname: getattr(obj, f.attname) for f in camps_pare}) for obj in objs]
+    if connection.features.can_return_rows_from_bulk_insert:
+        pare.objects.using(db).bulk_create(files_pare, batch_size=mida_lot)
+    elif exclusiu:
+        # MySQL no retorna els ids de bulk_create: els reservem nosaltres
+        inici = (pare.objects.using(db).aggregate(maxim=Max("pk"))["maxim"] or 0) + 1
+        for i, fila in enumerate(files_pare):
+            fila.pk = inici + i
+        pare.objects.using(db).bulk_create(files_pare, batch_size=mida_lot)
+    else:
+        # un INSERT per fila: l'id el dona la BD (LAST_INSERT_ID), sense senyals
+        for fila in files_pare:
+            (fila.pk,), = pare._base_manager.using(db)._insert(
+                [fila], fields=camps_pare, returning_fields=pare._meta.db_returning_fields, using=db,
+            )
+
+    for obj, fila in zip(objs, files_pare):
+        setattr(obj, enllac.attname, fila.pk)
+        setattr(obj, pare._meta.pk.attname, fila.pk)
+        obj._state.adding = False
+        obj._state.db = db
+
+    camps = model._meta.local_concrete_fields
+    mida = max(1, min(mida_lot, connection.ops.bulk_batch_size(camps, objs)))
+    for lot in lots(objs, mida):
+        model._base_manager.using(db)._insert(lot, fields=camps, using=db)
+    return objs
+
+
+def crea_etiquetes(parelles, mida_lot=MIDA_LOT):
+    """Insereix les parelles (cataleg_id, categoria_id) de Cataleg.tags d'un cop."""
+    from .models import Cataleg
+    Etiqueta = Cataleg.tags.through
+    Etiqueta.objects.bulk_create(
+        [Etiqueta(cataleg_id=c, categoria_id=t) for c, t in parelles],
+        batch_size=mida_lot, ignore_conflicts=True,
+    )
@@ -0,0 +1,349 @@
+"""
+Mètriques de funcionament en format Prometheus (GET /metrics).
+
+Cada procés (workers del servidor, importacions_worker...) compta en
+memòria i, si hi ha METRIQUES_DIR, en desa una instantània a
+METRIQUES_DIR/<pid>-<inici>.json com a molt cada METRIQUES_INTERVAL
+segons (i en acabar). L'inici del procés forma part del nom perquè un
+procés nou amb un pid reutilitzat no trepitgi la instantània d'un de
+mort. /metrics suma les instantànies de tots els processos, de manera
+que el resultat no depèn del worker que respon. Els indicadors
+(peticions en curs) només compten els processos vius. Els comptadors i
+histogrames dels processos que ja no existeixen es continuen sumant (un
+comptador no pot baixar): /metrics els acumula a morts.json i n'esborra
+les instantànies, de manera que el directori no creix. Sense
+METRIQUES_DIR només es veu el procés que respon.
+
+/metrics només respon a les adreces de METRIQUES_XARXES, i mai a
+peticions que arriben a través d'un proxy (amb X-Forwarded-For).
+"""
+import atexit
+import fcntl
+import functools
+import ipaddress
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+logger = logging.getLogger("biblioteca.metriques")
+
+LIMITS_DURADA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# nom: (tipus, descripció)
+METRIQUES = {
+    "biblioteca_api_peticions_total": ("counter", "Peticions a l'API per operació i codi d'estat"),
+    "biblioteca_api_errors_total": ("counter", "Peticions a l'API acabades amb un error del servidor (5xx)"),
+    "biblioteca_api_durada_segons": ("histogram", "Durada de les peticions a l'API per operació"),
+    "biblioteca_api_peticions_en_curs": ("gauge", "Peticions a l'API que s'estan atenent"),
+    "biblioteca_cache_respostes_total": ("counter", "Consultes a la memòria cau de respostes del catàleg"),
+    "biblioteca_autenticacions_total": ("counter", "Intents d'autenticació per mètode i resultat"),
+    "biblioteca_importacio_files_total": ("counter", "Files de CSV d'usuaris processades"),
+    "biblioteca_importacio_errors_total": ("counter", "Files de CSV d'usuaris rebutjades"),
+    "biblioteca_importacio_usuaris_total": ("counter", "Usuaris creats per importacions de CSV"),
+}
+
+
+def directori():
+    return getattr(settings, "METRIQUES_DIR", None)
+
+
+# comptadors i histogrames acumulats dels processos que ja no hi són
+FITXER_MORTS = "morts.json"
+
+
+def escriu_json(cami, dades):
+    # reemplaçament atòmic: qui llegeix no veu mai un fitxer a mitges. Cada
+    # escriptura té el seu temporal, de manera que no n'hi ha dues que en comparteixin
+    descriptor, temporal = tempfile.mkstemp(dir=cami.parent, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as fitxer:
+            json.dump(dades, fitxer)
+        os.replace(temporal, cami)
+    except BaseException:
+        Path(temporal).unlink(missing_ok=True)
+        raise
+
+
+def llegeix_json(cami):
+    try:
+        return json.loads(cami.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def acumula(totals, dades, viu=False):
+    """Suma una instantània a totals = (comptadors, indicadors, histogrames)."""
+    comptadors, indicadors, histogrames = totals
+    for nom, etiquetes, valor in dades["comptadors"]:
+        clau = (nom, tuple(map(tuple, etiquetes)))
+        comptadors[clau] = comptadors.get(clau, 0) + valor
+    if viu:
+        for nom, etiquetes, valor in dades["indicadors"]:
+            clau = (nom, tuple(map(tuple, etiquetes)))
+            indicadors[clau] = indicadors.get(clau, 0) + valor
+    for nom, etiquetes, cubetes in dades["histogrames"]:
+        clau = (nom, tuple(map(tuple, etiquetes)))
+        total = histogrames.setdefault(clau, [0] * len(cubetes))
+        for i, valor in enumerate(cubetes):
+            total[i] += valor
+    return totals
+
+
+def proces_viu(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registre:
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._lock_desa = threading.Lock()
+        self._buida()
+
+    def _buida(self):
+        # {(nom, ((etiqueta, valor), ...)): valor}
+        self.comptadors = {}
+        self.indicadors = {}
+        # {clau: [comptes per límit..., +Inf, suma]}
+        self.histogrames = {}
+        self._desat = 0.0
+        self.pid = os.getpid()
+        self.inici = time.time_ns()
+
+    def despres_de_fork(self):
+        # el procés fill comença de zero: el que hi ha en memòria és del pare
+        self._lock = threading.Lock()
+        self._lock_desa = threading.Lock()
+        self._buida()
+
+    def incrementa(self, nom, valor=1, **etiquetes):
+        clau = (nom, tuple(sorted(etiquetes.items())))
+        with self._lock:
+            self.comptadors[clau] = self.comptadors.get(clau, 0) + valor
+
+    def suma_indicador(self, nom, valor, **etiquetes):
+        clau = (nom, tuple(sorted(etiquetes.items())))
+        with self._lock:
+            self.indicadors[clau] = self.indicadors.get(clau, 0) + valor
+
+    def observa(self, nom, valor, **etiquetes):
+        clau = (nom, tuple(sorted(etiquetes.items())))
+        with self._lock:
+            cubetes = self.histogrames.get(clau)
+            if cubetes is None:
+                cubetes = self.histogrames[clau] = [0] * (len(LIMITS_DURADA) + 2)
+            for i, limit in enumerate(LIMITS_DURADA):
+                if valor <= limit:
+                    cubetes[i] += 1
+                    break
+            else:
+                cubetes[len(LIMITS_DURADA)] += 1
+            cubetes[-1] += valor
+
+    def instantania(self):
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "inici": self.inici,
+                "comptadors": [[nom, etiquetes, valor] for (nom, etiquetes), valor in self.comptadors.items()],
+                "indicadors": [[nom, etiquetes, valor] for (nom, etiquetes), valor in self.indicadors.items()],
+                "histogrames": [[nom, etiquetes, cubetes] for (nom, etiquetes), cubetes in self.histogrames.items()],
+            }
+
+    def desa(self, forca=False):
+        carpeta = directori()
+        if not carpeta:
+            return
+        # un sol fil desa alhora; els altres no s'esperen (ja desarà el següent)
+        if not self._lock_desa.acquire(blocking=forca):
+            return
+        try:
+            if not forca and time.monotonic() - self._desat < self.interval:
+                return
+            self._desat = time.monotonic()
+            carpeta = Path(carpeta)
+            carpeta.mkdir(parents=True, exist_ok=True)
+            escriu_json(carpeta / f"{self.pid}-{self.inici}.json", self.instantania())
+        except OSError:
+            # les mètriques no han de fer fallar la petició
+            logger.warning("No s'han pogut desar les mètriques a %s", carpeta, exc_info=True)
+        finally:
+            self._lock_desa.release()
+
+    def instantanies(self):
+        """[(instantània, viu)] d'aquest procés, dels altres i dels morts (acumulats)."""
+        propia = self.instantania()
+        carpeta = directori()
+        if not carpeta or not os.path.isdir(carpeta):
+            return [(propia, True)]
+        carpeta = Path(carpeta)
+        altres = []
+        for fitxer in carpeta.glob("*.json"):
+            dades = llegeix_json(fitxer) if fitxer.name != FITXER_MORTS else None
+            if dades is not None:
+                dades.setdefault("inici", 0)
+                if (dades["pid"], dades["inici"]) != (self.pid, self.inici):
+                    altres.append((fitxer, dades))
+        # d'un pid només pot ser viu el procés que ha començat més tard
+        darrer = {self.pid: self.inici}
+        for _, dades in altres:
+            darrer[dades["pid"]] = max(darrer.get(dades["pid"], 0), dades["inici"])
+        resultat, morts = [(propia, True)], []
+        for fitxer, dades in altres:
+            if dades["inici"] == darrer[dades["pid"]] and proces_viu(dades["pid"]):
+                resultat.append((dades, True))
+            else:
+                morts.append(fitxer)
+        if morts:
+            self.consolida(carpeta, morts)
+        acumulats = llegeix_json(carpeta / FITXER_MORTS)
+        if acumulats is not None:
+            resultat.append((acumulats, False))
+        return resultat
+
+    def consolida(self, carpeta, morts):
+        """Suma les instantànies dels processos morts a FITXER_MORTS i les esborra."""
+        try:
+            with open(carpeta / ".lock", "a") as bloqueig:
+                # entre processos: dos /metrics alhora no han de sumar dues vegades el mateix fitxer
+                fcntl.flock(bloqueig, fcntl.LOCK_EX)
+                acumulats = llegeix_json(carpeta / FITXER_MORTS)
+                totals = ({}, {}, {})
+                if acumulats is not None:
+                    acumula(totals, acumulats)
+                pendents = []
+                for fitxer in morts:
+                    dades = llegeix_json(fitxer)
+                    if dades is not None:
+                        acumula(totals, dades)
+                        pendents.append(fitxer)
+                if not pendents:
+                    return
+                comptadors, _, histogrames = totals
+                escriu_json(carpeta / FITXER_MORTS, {
+                    "comptadors": [[nom, etiquetes, valor] for (nom, etiquetes), valor in comptadors.items()],
+                    "indicadors": [],
+                    "histogrames": [[nom, etiquetes, cubetes] for (nom, etiquetes), cubetes in histogrames.items()],
+                })
+                for fitxer in pendents:
+                    fitxer.unlink(missing_ok=True)
+        except OSError:
+            logger.warning("No s'han pogut consolidar les mètriques de %s", carpeta, exc_info=True)
+
+    def agrega(self):
+        totals = ({}, {}, {})
+        for dades, viu in self.instantanies():
+            acumula(totals, dades, viu)
+        return totals
+
+
+def etiquetes_text(etiquetes, extra=()):
+    parelles = list(etiquetes) + list(extra)
+    if not parelles:
+        return ""
+    escapa = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escapa(v)}"' for k, v in parelles) + "}"
+
+
+def format_prometheus(comptadors, indicadors, histogrames):
+    linies = []
+    for nom, (tipus, descripcio) in METRIQUES.items():
+        linies.append(f"# HELP {nom} {descripcio}")
+        linies.append(f"# TYPE {nom} {tipus}")
+        if tipus == "histogram":
+            for (n, etiquetes), cubetes in sorted(histogrames.items()):
+                if n != nom:
+                    continue
+                acumulat = 0
+                for limit, compte in zip(LIMITS_DURADA + ("+Inf",), cubetes):
+                    acumulat += compte
+                    linies.append(f"{nom}_bucket{etiquetes_text(etiquetes, [('le', limit)])} {acumulat}")
+                linies.append(f"{nom}_sum{etiquetes_text(etiquetes)} {cubetes[-1]}")
+                linies.append(f"{nom}_count{etiquetes_text(etiquetes)} {acumulat}")
+        else:
+            valors = comptadors if tipus == "counter" else indicadors
+            for (n, etiquetes), valor in sorted(valors.items()):
+                if n == nom:
+                    linies.append(f"{nom}{etiquetes_text(etiquetes)} {valor}")
+    return "\n".join(linies) + "\n"
+
+
+registre = Registre(interval=getattr(settings, "METRIQUES_INTERVAL", 5))
+os.register_at_fork(after_in_child=registre.despres_de_fork)
+atexit.register(registre.desa, forca=True)
+
+
+# Punts de mesura
+
+def autenticacio(metode, correcta):
+    registre.incrementa("biblioteca_autenticacions_total", metode=metode, resultat="ok" if correcta else "error")
+    registre.desa()
+
+
+def importacio(files, errors, usuaris):
+    registre.incrementa("biblioteca_importacio_files_total", files)
+    registre.incrementa("biblioteca_importacio_errors_total", errors)
+    registre.incrementa("biblioteca_importacio_usuaris_total", usuaris)
+    registre.desa()
+
+
+def mesura_operacio(run, operacio):
+    @functools.wraps(run)
+    def embolcall(request, *args, **kwargs):
+        registre.suma_indicador("biblioteca_api_peticions_en_curs", 1, operacio=operacio)
+        t0 = time.perf_counter()
+        estat = 500
+        try:
+            resposta = run(request, *args, **kwargs)
+            estat = resposta.status_code
+            return resposta
+        finally:
+            registre.observa("biblioteca_api_durada_segons", time.perf_counter() - t0, operacio=operacio)
+            registre.incrementa("biblioteca_api_peticions_total", operacio=operacio, estat=str(estat))
+            if estat >= 500:
+                registre.incrementa("biblioteca_api_errors_total", operacio=operacio)
+            registre.suma_indicador("biblioteca_api_peticions_en_curs", -1, operacio=operacio)
+            registre.desa()
+    return embolcall
+
+
+def instrumenta_api(api):
+    """Mesura totes les operacions de l'API, etiquetades amb l'operation id de l'OpenAPI."""
+    from .instrumentacio import operacions
+    for operacio in operacions(api):
+        operacio.run = mesura_operacio(operacio.run, operacio.operation_id or api.get_openapi_operation_id(operacio))
+
+
+# Vista
+
+def adreca_interna(request):
+    if request.META.get("HTTP_X_FORWARDED_FOR"):
+        return False
+    try:
+        adreca = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    xarxes = getattr(settings, "METRIQUES_XARXES", ["127.0.0.0/8", "::1/128"])
+    return any(adreca in ipaddress.ip_network(xarxa) for xarxa in xarxes)
+
+
+def vista_metriques(request):
+    if not adreca_interna(request):
+        return HttpResponseForbidden("Només des de la xarxa interna")
+    registre.desa(forca=True)
+    return HttpResponse(format_prometheus(*registre.agrega()),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
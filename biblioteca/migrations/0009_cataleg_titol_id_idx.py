@@ -0,0 +1,17 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0008_usuari_telefon'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cataleg',
+            index=models.Index(fields=['titol', 'id'], name='cataleg_titol_id_idx'),
+        ),
+    ]
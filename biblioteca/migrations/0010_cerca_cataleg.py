@@ -0,0 +1,46 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0009_cataleg_titol_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentCerca',
+            fields=[
+                ('cataleg', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='biblioteca.cataleg')),
+                ('longitud', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TermeCerca',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('terme', models.CharField(max_length=100, unique=True)),
+                ('documents', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PostingCerca',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frequencia', models.PositiveIntegerField()),
+                ('pes', models.FloatField()),
+                ('cataleg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.cataleg')),
+                ('terme', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.termecerca')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['terme', '-pes'], name='posting_terme_pes_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='postingcerca',
+            constraint=models.UniqueConstraint(fields=('terme', 'cataleg'), name='posting_terme_cataleg_unic'),
+        ),
+    ]
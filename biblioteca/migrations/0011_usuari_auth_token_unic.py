@@ -0,0 +1,29 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def neteja_tokens_duplicats(apps, schema_editor):
+    # abans de l'índex únic: els tokens buits o repetits deixen de ser vàlids
+    Usuari = apps.get_model('biblioteca', 'Usuari')
+    Usuari.objects.filter(auth_token='').update(auth_token=None)
+    repetits = (Usuari.objects.exclude(auth_token=None).values('auth_token')
+                .annotate(n=Count('id')).filter(n__gt=1).values_list('auth_token', flat=True))
+    Usuari.objects.filter(auth_token__in=list(repetits)).update(auth_token=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0010_cerca_cataleg'),
+    ]
+
+    operations = [
+        migrations.RunPython(neteja_tokens_duplicats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='usuari',
+            name='auth_token',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
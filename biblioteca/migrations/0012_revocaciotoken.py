@@ -0,0 +1,25 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0011_usuari_auth_token_unic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevocacioToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(blank=True, max_length=32, null=True, unique=True)),
+                ('emesos_fins_a', models.FloatField(blank=True, null=True)),
+                ('expira', models.DateTimeField(db_index=True)),
+                ('usuari', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0012_revocaciotoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportacioCSV',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nom_fitxer', models.CharField(max_length=255)),
+                ('fitxer', models.FileField(blank=True, upload_to='importacions/')),
+                ('estat', models.CharField(choices=[('pendent', 'Pendent'), ('processant', 'Processant'), ('acabada', 'Acabada'), ('error', 'Error')], db_index=True, default='pendent', max_length=10)),
+                ('files_processades', models.PositiveIntegerField(default=0)),
+                ('usuaris_creats', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('registres', models.JSONField(blank=True, default=list)),
+                ('resultat', models.JSONField(blank=True, null=True)),
+                ('data_creacio', models.DateTimeField(auto_now_add=True)),
+                ('data_inici', models.DateTimeField(blank=True, null=True)),
+                ('data_fi', models.DateTimeField(blank=True, null=True)),
+                ('data_batec', models.DateTimeField(blank=True, null=True)),
+                ('intents', models.PositiveIntegerField(default=0, editable=False)),
+                ('usuari', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Importacions CSV',
+            },
+        ),
+    ]
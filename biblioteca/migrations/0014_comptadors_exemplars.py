@@ -0,0 +1,64 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:05
+
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def recompta(apps, schema_editor):
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    Reserva = apps.get_model('biblioteca', 'Reserva')
+
+    def compte(qs):
+        subconsulta = qs.values('c').annotate(n=Count('pk')).values('n')
+        return Coalesce(Subquery(subconsulta, output_field=IntegerField()), Value(0))
+
+    exemplars = Exemplar.objects.filter(cataleg=OuterRef('pk')).annotate(c=F('cataleg_id'))
+    prestecs = Prestec.objects.filter(exemplar__cataleg=OuterRef('pk'), data_retorn__isnull=True) \
+        .annotate(c=F('exemplar__cataleg_id'))
+    reserves = Reserva.objects.filter(exemplar__cataleg=OuterRef('pk')).annotate(c=F('exemplar__cataleg_id'))
+    Cataleg.objects.update(
+        exemplars_total=compte(exemplars),
+        exemplars_actius=compte(exemplars.filter(baixa=False)),
+        exemplars_prestables=compte(exemplars.filter(baixa=False, exclos_prestec=False)),
+        exemplars_prestats=compte(prestecs),
+        exemplars_reservats=compte(reserves),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0013_importaciocsv'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cataleg',
+            name='exemplars_actius',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='exemplars_prestables',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='exemplars_prestats',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='exemplars_reservats',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='exemplars_total',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(recompta, migrations.RunPython.noop),
+    ]
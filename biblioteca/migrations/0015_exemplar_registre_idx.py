@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0014_comptadors_exemplars'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exemplar',
+            name='registre',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+    ]
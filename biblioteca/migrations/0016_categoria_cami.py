@@ -0,0 +1,47 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+def calcula_camins(apps, schema_editor):
+    # recorregut per nivells: cada nivell es calcula a partir de l'anterior
+    Categoria = apps.get_model('biblioteca', 'Categoria')
+    pares = {None: ('', -1)}
+    pendents = list(Categoria.objects.values_list('pk', 'parent_id'))
+    while pendents:
+        seguents = []
+        for pk, parent_id in pendents:
+            if parent_id not in pares:
+                seguents.append((pk, parent_id))
+                continue
+            cami_parent, nivell_parent = pares[parent_id]
+            cami = cami_parent + str(pk).zfill(8) + '/'
+            pares[pk] = (cami, nivell_parent + 1)
+            Categoria.objects.filter(pk=pk).update(cami=cami, nivell=nivell_parent + 1)
+        if len(seguents) == len(pendents):
+            # cicle a les dades: el primer node passa a ser una arrel
+            pk, _ = seguents.pop(0)
+            pares[pk] = (str(pk).zfill(8) + '/', 0)
+            Categoria.objects.filter(pk=pk).update(parent=None, cami=pares[pk][0], nivell=0)
+        pendents = seguents
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0015_exemplar_registre_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='cami',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='categoria',
+            name='nivell',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(calcula_camins, migrations.RunPython.noop),
+    ]
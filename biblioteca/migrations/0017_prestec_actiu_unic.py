@@ -0,0 +1,36 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:08
+
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def tanca_prestecs_duplicats(apps, schema_editor):
+    # abans de la restricció: si un exemplar té diversos préstecs oberts,
+    # els anteriors es donen per retornats el dia que va començar el següent
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    oberts = Prestec.objects.filter(data_retorn__isnull=True)
+    repetits = oberts.values('exemplar_id').annotate(n=Count('id')).filter(n__gt=1)
+    for exemplar_id in list(repetits.values_list('exemplar_id', flat=True)):
+        prestecs = list(oberts.filter(exemplar_id=exemplar_id).order_by('data_prestec', 'id'))
+        for anterior, seguent in zip(prestecs, prestecs[1:]):
+            anterior.data_retorn = seguent.data_prestec
+            anterior.save(update_fields=['data_retorn'])
+        # el comptador de prestats compta préstecs oberts
+        Cataleg.objects.filter(exemplar__pk=exemplar_id).update(
+            exemplars_prestats=F('exemplars_prestats') - (len(prestecs) - 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0016_categoria_cami'),
+    ]
+
+    operations = [
+        migrations.RunPython(tanca_prestecs_duplicats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='prestec',
+            constraint=models.UniqueConstraint(condition=models.Q(('data_retorn__isnull', True)), fields=('exemplar',), name='prestec_actiu_unic'),
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def crea_cues(apps, schema_editor):
+    # les reserves existents (per exemplar) passen a la cua del seu registre
+    # per ordre d'arribada; les repetides d'un mateix usuari es cancel·len
+    Reserva = apps.get_model('biblioteca', 'Reserva')
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    cues = {}
+    vistos = set()
+    for reserva in Reserva.objects.select_related('exemplar').order_by('data', 'id'):
+        cataleg_id = reserva.exemplar.cataleg_id
+        reserva.cataleg_id = cataleg_id
+        reserva.exemplar = None
+        if (reserva.usuari_id, cataleg_id) in vistos:
+            reserva.estat = 'cancelada'
+        else:
+            vistos.add((reserva.usuari_id, cataleg_id))
+            cues[cataleg_id] = cues.get(cataleg_id, 0) + 1
+            reserva.posicio = cues[cataleg_id]
+        reserva.save(update_fields=['cataleg', 'exemplar', 'estat', 'posicio'])
+    for cataleg_id, final in cues.items():
+        Cataleg.objects.filter(pk=cataleg_id).update(cua_final=final, exemplars_reservats=final)
+    Cataleg.objects.exclude(pk__in=list(cues)).update(exemplars_reservats=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0017_prestec_actiu_unic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cataleg',
+            name='cua_final',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='cua_inici',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='cataleg',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='biblioteca.cataleg'),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='data_assignacio',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='data_limit',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='estat',
+            field=models.CharField(choices=[('espera', 'En espera'), ('assignada', 'Exemplar apartat'), ('servida', 'Servida'), ('cancelada', 'Cancel·lada'), ('caducada', 'Caducada')], default='espera', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='posicio',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='reserva',
+            name='exemplar',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='biblioteca.exemplar'),
+        ),
+        migrations.RunPython(crea_cues, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='reserva',
+            name='cataleg',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.cataleg'),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['cataleg', 'estat', 'posicio'], name='reserva_cua_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['estat', 'data_limit'], name='reserva_caducitat_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='reserva',
+            constraint=models.UniqueConstraint(condition=models.Q(('estat__in', ('espera', 'assignada'))), fields=('usuari', 'cataleg'), name='reserva_activa_unica'),
+        ),
+    ]
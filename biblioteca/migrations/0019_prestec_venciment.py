@@ -0,0 +1,40 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:15
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+
+
+def calcula_venciments(apps, schema_editor):
+    # un sol UPDATE per a tot l'històric
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    dies = getattr(settings, 'PRESTEC_DIES', 30)
+    Prestec.objects.filter(data_venciment__isnull=True).update(data_venciment=ExpressionWrapper(
+        F('data_prestec') + timedelta(days=dies), output_field=models.DateField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0018_cua_reserves'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prestec',
+            name='data_venciment',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='prestec',
+            name='vencut',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(calcula_venciments, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(fields=['data_retorn', 'data_venciment', 'id'], name='prestec_obert_venc_idx'),
+        ),
+    ]
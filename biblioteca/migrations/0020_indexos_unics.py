@@ -0,0 +1,79 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:35
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def normalitza_isbn(isbn):
+    isbn = "".join(c for c in (isbn or "") if c not in "- ").upper()
+    return isbn or None
+
+
+def registre_lliure(Exemplar, registre, pk):
+    # registre-<id>, o registre-<id>-2, -3... si algun exemplar ja es diu així
+    intent = 1
+    while True:
+        sufix = f"-{pk}" if intent == 1 else f"-{pk}-{intent}"
+        candidat = f"{registre[:100 - len(sufix)]}{sufix}"
+        if not Exemplar.objects.filter(registre=candidat).exists():
+            return candidat
+        intent += 1
+
+
+def elimina_duplicats(apps, schema_editor):
+    # abans dels índexs únics: buits -> NULL i duplicats resolts
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    Llibre = apps.get_model('biblioteca', 'Llibre')
+
+    Exemplar.objects.filter(registre='').update(registre=None)
+    repetits = (Exemplar.objects.exclude(registre=None).values('registre')
+                .annotate(n=Count('id')).filter(n__gt=1).values_list('registre', flat=True))
+    for registre in list(repetits):
+        # el primer conserva el registre; els altres hi porten l'id al darrere
+        for exemplar in Exemplar.objects.filter(registre=registre).order_by('id')[1:]:
+            exemplar.registre = registre_lliure(Exemplar, registre, exemplar.pk)
+            exemplar.save(update_fields=['registre'])
+
+    for llibre in Llibre.objects.exclude(ISBN=None).only('pk', 'ISBN').iterator():
+        isbn = normalitza_isbn(llibre.ISBN)
+        if isbn != llibre.ISBN:
+            Llibre.objects.filter(pk=llibre.pk).update(ISBN=isbn)
+    repetits = (Llibre.objects.exclude(ISBN=None).values('ISBN')
+                .annotate(n=Count('pk')).filter(n__gt=1).values_list('ISBN', flat=True))
+    for isbn in list(repetits):
+        # l'ISBN es queda al registre més antic; als altres es deixa anotat
+        llibres = list(Llibre.objects.filter(ISBN=isbn).order_by('pk'))
+        for llibre in llibres[1:]:
+            nota = f"ISBN {isbn} duplicat del registre {llibres[0].pk}"
+            llibre.anotacions = f"{llibre.anotacions}\n{nota}" if llibre.anotacions else nota
+            llibre.ISBN = None
+            llibre.save(update_fields=['ISBN', 'anotacions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0019_prestec_venciment'),
+    ]
+
+    operations = [
+        migrations.RunPython(elimina_duplicats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='exemplar',
+            name='registre',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='llibre',
+            name='ISBN',
+            field=models.CharField(blank=True, max_length=13, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='exemplar',
+            index=models.Index(fields=['cataleg', 'baixa', 'exclos_prestec'], name='exemplar_estat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(fields=['exemplar', 'data_retorn'], name='prestec_exemplar_retorn_idx'),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:10
+
+from django.db import migrations
+from django.db.models import Count, F
+
+
+# MySQL no té índexs parcials i Django no hi crea les restriccions úniques amb
+# condició (prestec_actiu_unic, reserva_activa_unica). Hi fem el mateix amb una
+# columna generada que només té valor quan la fila és activa: un índex únic
+# admet tants NULL com calgui.
+SQL_MYSQL = [
+    "ALTER TABLE biblioteca_prestec ADD COLUMN exemplar_obert_id bigint "
+    "GENERATED ALWAYS AS (CASE WHEN data_retorn IS NULL THEN exemplar_id END) VIRTUAL",
+    "CREATE UNIQUE INDEX prestec_actiu_unic_mysql ON biblioteca_prestec (exemplar_obert_id)",
+    "ALTER TABLE biblioteca_reserva ADD COLUMN usuari_actiu_id bigint "
+    "GENERATED ALWAYS AS (CASE WHEN estat IN ('espera', 'assignada') THEN usuari_id END) VIRTUAL",
+    "CREATE UNIQUE INDEX reserva_activa_unica_mysql ON biblioteca_reserva (usuari_actiu_id, cataleg_id)",
+]
+SQL_MYSQL_DESFES = [
+    "DROP INDEX reserva_activa_unica_mysql ON biblioteca_reserva",
+    "ALTER TABLE biblioteca_reserva DROP COLUMN usuari_actiu_id",
+    "DROP INDEX prestec_actiu_unic_mysql ON biblioteca_prestec",
+    "ALTER TABLE biblioteca_prestec DROP COLUMN exemplar_obert_id",
+]
+
+
+def tanca_prestecs_duplicats(apps):
+    # com a 0017: els préstecs oberts anteriors es donen per retornats
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    oberts = Prestec.objects.filter(data_retorn__isnull=True)
+    repetits = oberts.values('exemplar_id').annotate(n=Count('id')).filter(n__gt=1)
+    for exemplar_id in list(repetits.values_list('exemplar_id', flat=True)):
+        prestecs = list(oberts.filter(exemplar_id=exemplar_id).order_by('data_prestec', 'id'))
+        for anterior, seguent in zip(prestecs, prestecs[1:]):
+            anterior.data_retorn = seguent.data_prestec
+            anterior.save(update_fields=['data_retorn'])
+        Cataleg.objects.filter(exemplar__pk=exemplar_id).update(
+            exemplars_prestats=F('exemplars_prestats') - (len(prestecs) - 1))
+
+
+def cancella_reserves_duplicades(apps):
+    # es queda la reserva apartada o, si no n'hi ha, la més antiga; després es
+    # tornen a numerar els torns de la cua perquè no hi quedin forats
+    Reserva = apps.get_model('biblioteca', 'Reserva')
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    actives = Reserva.objects.filter(estat__in=('espera', 'assignada'))
+    repetits = actives.values('usuari_id', 'cataleg_id').annotate(n=Count('id')).filter(n__gt=1)
+    cues = set()
+    for usuari_id, cataleg_id in list(repetits.values_list('usuari_id', 'cataleg_id')):
+        reserves = sorted(actives.filter(usuari_id=usuari_id, cataleg_id=cataleg_id),
+                          key=lambda reserva: (reserva.estat != 'assignada', reserva.id))
+        for reserva in reserves[1:]:
+            reserva.estat = 'cancelada'
+            reserva.save(update_fields=['estat'])
+        Cataleg.objects.filter(pk=cataleg_id).update(
+            exemplars_reservats=F('exemplars_reservats') - (len(reserves) - 1))
+        cues.add(cataleg_id)
+    for cataleg in Cataleg.objects.filter(pk__in=cues):
+        en_espera = Reserva.objects.filter(cataleg_id=cataleg.pk, estat='espera').order_by('posicio', 'id')
+        for posicio, reserva in enumerate(en_espera, cataleg.cua_inici + 1):
+            if reserva.posicio != posicio:
+                reserva.posicio = posicio
+                reserva.save(update_fields=['posicio'])
+        cataleg.cua_final = cataleg.cua_inici + en_espera.count()
+        cataleg.save(update_fields=['cua_final'])
+
+
+def crea_restriccions_mysql(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    # fins ara MySQL no impedia els duplicats
+    tanca_prestecs_duplicats(apps)
+    cancella_reserves_duplicades(apps)
+    for sql in SQL_MYSQL:
+        schema_editor.execute(sql)
+
+
+def elimina_restriccions_mysql(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for sql in SQL_MYSQL_DESFES:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0020_indexos_unics'),
+    ]
+
+    operations = [
+        migrations.RunPython(crea_restriccions_mysql, elimina_restriccions_mysql),
+    ]
@@ -1,6 +1,12 @@
-from django.db import models
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Substr
+from django.core.exceptions import ValidationError
 from django.contrib.auth.models import AbstractUser, Group
-from django.utils.timezone import now
+from django.utils.timezone import localdate, now
 from django.contrib.auth.hashers import make_password
 
 
@@ -9,9 +15,52 @@ class Categoria(models.Model):
         verbose_name_plural = "Categories"
     nom = models.CharField(max_length=100)
     parent = models.ForeignKey('self',on_delete=models.CASCADE,null=True,blank=True)
+    # camí materialitzat: ids dels avantpassats i el propi, "00000001/00000007/"
+    cami = models.CharField(max_length=255, db_index=True, editable=False, default='')
+    nivell = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    AMPLADA_CAMI = 8
+
     def __str__(self):
         return self.nom
 
+    def clean(self):
+        if self.pk and self.parent_id:
+            cami_parent = Categoria.objects.filter(pk=self.parent_id).values_list('cami', flat=True).first() or ''
+            if self.parent_id == self.pk or (self.cami and cami_parent.startswith(self.cami)):
+                raise ValidationError({'parent': "Una categoria no pot penjar d'ella mateixa ni d'una subcategoria seva."})
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            anterior = None
+            if self.pk:
+                anterior = Categoria.objects.filter(pk=self.pk).values_list('cami', 'nivell').first()
+            super().save(*args, **kwargs)
+            cami, nivell = '', 0
+            if self.parent_id:
+                cami, nivell = Categoria.objects.filter(pk=self.parent_id).values_list('cami', 'nivell').get()
+                nivell += 1
+            if anterior and anterior[0] and cami.startswith(anterior[0]):
+                raise ValidationError("Una categoria no pot penjar d'una subcategoria seva.")
+            cami += str(self.pk).zfill(self.AMPLADA_CAMI) + '/'
+            if anterior is None or anterior[0] != cami:
+                Categoria.objects.filter(pk=self.pk).update(cami=cami, nivell=nivell)
+                if anterior and anterior[0]:
+                    # moviment: es reescriu tot el subarbre amb un sol UPDATE
+                    Categoria.objects.filter(cami__startswith=anterior[0]).exclude(pk=self.pk).update(
+                        cami=Concat(Value(cami), Substr('cami', len(anterior[0]) + 1)),
+                        nivell=F('nivell') + (nivell - anterior[1]),
+                    )
+            self.cami, self.nivell = cami, nivell
+
+    def descendents(self, incloure_propia=True):
+        qs = Categoria.objects.filter(cami__startswith=self.cami)
+        return qs if incloure_propia else qs.exclude(pk=self.pk)
+
+    def avantpassats(self):
+        ids = [int(pk) for pk in self.cami.split('/')[:-2]]
+        return Categoria.objects.filter(pk__in=ids).order_by('nivell')
+
 class Pais(models.Model):
     class Meta:
         verbose_name_plural = "Països"
@@ -27,6 +76,11 @@ class Llengua(models.Model):
         return self.nom
 
 class Cataleg(models.Model):
+    class Meta:
+        indexes = [
+            # ordenació estable per a la paginació per cursor de l'API
+            models.Index(fields=['titol','id'], name='cataleg_titol_id_idx'),
+        ]
     titol = models.CharField(max_length=200)
     titol_original = models.CharField(max_length=200, blank=True, null=True)
     autor = models.CharField(max_length=200, blank=True, null=True)
@@ -37,12 +91,38 @@ class Cataleg(models.Model):
     anotacions = models.TextField(blank=True,null=True)
     mides = models.CharField(max_length=100,null=True,blank=True)
     tags = models.ManyToManyField(Categoria,blank=True)
+    # comptadors d'exemplars mantinguts des de signals.py (manage.py recompta_exemplars els repara)
+    exemplars_total = models.IntegerField(default=0, editable=False)
+    exemplars_actius = models.IntegerField(default=0, editable=False)
+    exemplars_prestables = models.IntegerField(default=0, editable=False)
+    exemplars_prestats = models.IntegerField(default=0, editable=False)
+    exemplars_reservats = models.IntegerField(default=0, editable=False)
+    CAMPS_COMPTADORS = ('exemplars_total','exemplars_actius','exemplars_prestables','exemplars_prestats','exemplars_reservats')
+    # cua de reserves: torns ja servits i últim torn donat (vegeu Reserva)
+    cua_inici = models.IntegerField(default=0, editable=False)
+    cua_final = models.IntegerField(default=0, editable=False)
+    CAMPS_CUA = ('cua_inici','cua_final')
+    def save(self, *args, **kwargs):
+        # els comptadors només canvien amb UPDATE atòmics: desar un registre
+        # carregat fa estona (p.ex. des de l'admin) no els ha de trepitjar
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.CAMPS_COMPTADORS + self.CAMPS_CUA]
+        super().save(*args, **kwargs)
     def exemplars(self):
-    	return 0
+    	return self.exemplars_total
+    @property
+    def exemplars_disponibles(self):
+        return max(self.exemplars_prestables - self.exemplars_prestats, 0)
+
 
+def normalitza_isbn(isbn):
+    # sense guions ni espais; buit -> NULL perquè l'índex únic admeti molts llibres sense ISBN
+    isbn = "".join(c for c in (isbn or "") if c not in "- ").upper()
+    return isbn or None
 
 class Llibre(Cataleg):
-    ISBN = models.CharField(max_length=13, blank=True, null=True)
+    ISBN = models.CharField(max_length=13, blank=True, null=True, unique=True)
     editorial = models.CharField(max_length=100, blank=True, null=True)
     colleccio = models.CharField(max_length=100, blank=True, null=True)
     lloc = models.CharField(max_length=100, blank=True, null=True)
@@ -54,6 +134,9 @@ class Llibre(Cataleg):
     info_url = models.CharField(max_length=200,blank=True,null=True)
     preview_url = models.CharField(max_length=200,blank=True,null=True)
     thumbnail_url = models.CharField(max_length=200,blank=True,null=True)
+    def save(self, *args, **kwargs):
+        self.ISBN = normalitza_isbn(self.ISBN)
+        super().save(*args, **kwargs)
 
 class Revista(Cataleg):
     class Meta:
@@ -85,10 +168,20 @@ class Dispositiu(Cataleg):
     model = models.CharField(max_length=100,null=True,blank=True)
 
 class Exemplar(models.Model):
+    class Meta:
+        indexes = [
+            # exemplars actius / prestables d'un registre (comptadors, reserves, admin)
+            models.Index(fields=['cataleg','baixa','exclos_prestec'], name='exemplar_estat_idx'),
+        ]
     cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
-    registre = models.CharField(max_length=100,null=True,blank=True)
+    registre = models.CharField(max_length=100,null=True,blank=True,unique=True)
     exclos_prestec = models.BooleanField(default=True)
     baixa = models.BooleanField(default=False)
+    def save(self, *args, **kwargs):
+        self.registre = (self.registre or "").strip() or None
+        # els comptadors del catàleg s'actualitzen dins la mateixa transacció
+        with transaction.atomic():
+            super().save(*args, **kwargs)
     def __str__(self):
         return "REG:{} - {}".format(self.registre,self.cataleg.titol)
 
@@ -115,7 +208,7 @@ class Usuari(AbstractUser):
     centre = models.ForeignKey(Centre,on_delete=models.SET_NULL,null=True,blank=True)
     cicle = models.ForeignKey(Cicle,on_delete=models.SET_NULL,null=True,blank=True)
     imatge = models.ImageField(upload_to='usuaris/',null=True,blank=True)
-    auth_token = models.CharField(max_length=32,blank=True,null=True)
+    auth_token = models.CharField(max_length=32,blank=True,null=True,unique=True)
     telefon = models.CharField(max_length=20,blank=True,null=True)
     def save(self, *args, **kwargs):
         # Si el usuario no tiene ID (se está creando)
@@ -127,25 +220,80 @@ class Usuari(AbstractUser):
         # Si es nuevo, añadimos el usuario al grupo "usuarios"
         if is_new:
             group, created = Group.objects.get_or_create(name='usuari')
+            # Un usuario recién creado no tiene tokens que revocar (signals.py)
+            self._grupo_inicial = True
             self.groups.add(group)
+            self._grupo_inicial = False
     def __str__(self):
         return self.username
 
 class Reserva(models.Model):
+    # Cua FIFO per registre del catàleg: `posicio` és el número de torn dins
+    # la cua del registre i el lloc actual és posicio - cataleg.cua_inici.
+    # Quan torna un exemplar s'assigna a la reserva de posicio cua_inici + 1.
+    ESTATS = (
+        ('espera', 'En espera'),
+        ('assignada', 'Exemplar apartat'),
+        ('servida', 'Servida'),
+        ('cancelada', 'Cancel·lada'),
+        ('caducada', 'Caducada'),
+    )
+    ESTATS_ACTIUS = ('espera', 'assignada')
     class Meta:
         verbose_name_plural = "Reserves"
+        indexes = [
+            models.Index(fields=['cataleg','estat','posicio'], name='reserva_cua_idx'),
+            models.Index(fields=['estat','data_limit'], name='reserva_caducitat_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['usuari','cataleg'], condition=models.Q(estat__in=('espera','assignada')),
+                                    name='reserva_activa_unica'),
+        ]
     usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
-    exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE)
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
+    # exemplar apartat per a l'usuari mentre la reserva està assignada
+    exemplar = models.ForeignKey(Exemplar, on_delete=models.SET_NULL, null=True, blank=True)
+    posicio = models.PositiveIntegerField(default=0, editable=False)
+    estat = models.CharField(max_length=10, choices=ESTATS, default='espera')
     data = models.DateField(auto_now_add=True)
+    data_assignacio = models.DateField(null=True, blank=True)
+    data_limit = models.DateField(null=True, blank=True)
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+    def __str__(self):
+        return f"{self.cataleg} ({self.usuari})"
 
 class Prestec(models.Model):
     class Meta:
         verbose_name_plural = "Préstecs"
+        constraints = [
+            # un sol préstec obert per exemplar
+            models.UniqueConstraint(fields=["exemplar"], condition=models.Q(data_retorn__isnull=True),
+                                    name="prestec_actiu_unic"),
+        ]
+        indexes = [
+            # préstecs oberts per data de venciment: data_retorn IS NULL és el
+            # prefix de l'índex, i els retornats (la gran majoria) queden fora del rang
+            models.Index(fields=["data_retorn","data_venciment","id"], name="prestec_obert_venc_idx"),
+            # préstec obert d'un exemplar i historial. MySQL no té restriccions parcials:
+            # prestec_actiu_unic i reserva_activa_unica s'hi creen a la migració 0021
+            models.Index(fields=["exemplar","data_retorn"], name="prestec_exemplar_retorn_idx"),
+        ]
     usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
     exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE)
     data_prestec = models.DateField(auto_now_add=True)
+    data_venciment = models.DateField(null=True, blank=True)
     data_retorn = models.DateField(null=True, blank=True)
+    # l'actualitza cada nit `manage.py marca_prestecs_vencuts`
+    vencut = models.BooleanField(default=False, editable=False)
     anotacions = models.TextField(blank=True,null=True)
+    def save(self, *args, **kwargs):
+        if self.data_venciment is None:
+            dies = getattr(settings, "PRESTEC_DIES", 30)
+            self.data_venciment = (self.data_prestec or localdate()) + timedelta(days=dies)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
     def __str__(self):
         return str(self.exemplar)
 
@@ -178,3 +326,70 @@ class Log(models.Model):
 class Documento(models.Model):
     archivo = models.FileField(upload_to="documentos/")
     fecha_subida = models.DateTimeField(auto_now_add=True)
+
+
+# Cerca al catàleg: índex invertit mantingut des de biblioteca/cerca.py
+
+class TermeCerca(models.Model):
+    terme = models.CharField(max_length=100, unique=True)
+    documents = models.PositiveIntegerField(default=0)
+    def __str__(self):
+        return self.terme
+
+class DocumentCerca(models.Model):
+    cataleg = models.OneToOneField(Cataleg, on_delete=models.CASCADE, primary_key=True)
+    longitud = models.PositiveIntegerField(default=0)
+
+class PostingCerca(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['terme','cataleg'], name='posting_terme_cataleg_unic'),
+        ]
+        indexes = [
+            # llista de documents de cada terme ordenada per impacte
+            models.Index(fields=['terme','-pes'], name='posting_terme_pes_idx'),
+        ]
+    terme = models.ForeignKey(TermeCerca, on_delete=models.CASCADE)
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
+    frequencia = models.PositiveIntegerField()
+    # component BM25 del terme dins del document (sense l'idf)
+    pes = models.FloatField()
+
+# Llista de revocació dels tokens signats de l'API. Cada fila revoca un
+# token concret (jti) o tots els tokens d'un usuari emesos abans d'un moment.
+class RevocacioToken(models.Model):
+    jti = models.CharField(max_length=32, unique=True, null=True, blank=True)
+    usuari = models.OneToOneField(Usuari, on_delete=models.CASCADE, null=True, blank=True)
+    emesos_fins_a = models.FloatField(null=True, blank=True)
+    expira = models.DateTimeField(db_index=True)
+
+# Importacions de CSV d'usuaris en segon pla (vegeu la comanda importacions_worker)
+class ImportacioCSV(models.Model):
+    class Meta:
+        verbose_name_plural = "Importacions CSV"
+    ESTATS = (
+        ('pendent', 'Pendent'),
+        ('processant', 'Processant'),
+        ('acabada', 'Acabada'),
+        ('error', 'Error'),
+    )
+    usuari = models.ForeignKey(Usuari, on_delete=models.SET_NULL, null=True, blank=True)
+    nom_fitxer = models.CharField(max_length=255)
+    # el CSV pujat, a default_storage fins que s'acaba la importació
+    fitxer = models.FileField(upload_to='importacions/', blank=True)
+    estat = models.CharField(max_length=10, choices=ESTATS, default='pendent', db_index=True)
+    files_processades = models.PositiveIntegerField(default=0)
+    usuaris_creats = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    # usuaris creats fins ara, per reprendre-la sense perdre'ls de l'informe final
+    registres = models.JSONField(default=list, blank=True)
+    resultat = models.JSONField(null=True, blank=True)
+    data_creacio = models.DateTimeField(auto_now_add=True)
+    data_inici = models.DateTimeField(null=True, blank=True)
+    data_fi = models.DateTimeField(null=True, blank=True)
+    # el worker l'actualitza a cada lot; si s'atura, una altra el pot reprendre
+    data_batec = models.DateTimeField(null=True, blank=True)
+    # vegades que s'ha reclamat: un worker que l'ha perduda ja no hi pot escriure
+    intents = models.PositiveIntegerField(default=0, editable=False)
+    def __str__(self):
+        return f"{self.nom_fitxer} ({self.estat})"
@@ -0,0 +1,110 @@
+import base64
+import json
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from ninja.errors import HttpError
+
+from .sortida import dumps
+
+
+LIMIT_PER_DEFECTE = 100
+LIMIT_MAXIM = 1000
+MIDA_BLOC_STREAM = 2000
+
+# Ordenacions estables permeses: sempre acaben amb l'id per desempatar
+ORDENACIONS = {
+    "id": ("id",),
+    "titol": ("titol", "id"),
+}
+
+
+def codifica_cursor(valors):
+    text = json.dumps(valors, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def descodifica_cursor(cursor, mida):
+    """Els `mida` valors del cursor; 400 si no és un cursor nostre."""
+    try:
+        farciment = "=" * (-len(cursor) % 4)
+        valors = json.loads(base64.urlsafe_b64decode(cursor + farciment))
+    except (ValueError, TypeError):
+        raise HttpError(400, "Cursor no vàlid")
+    if not isinstance(valors, list) or len(valors) != mida:
+        raise HttpError(400, "Cursor no vàlid")
+    return valors
+
+
+def valors_cursor(model, camps, cursor):
+    """Valors del cursor convertits al tipus de cada camp de `model`; 400 si no hi corresponen."""
+    valors = descodifica_cursor(cursor, len(camps))
+    convertits = []
+    for camp, valor in zip(camps, valors):
+        if valor is None or isinstance(valor, (list, dict)) or (isinstance(valor, int) and abs(valor) >= 2 ** 63):
+            raise HttpError(400, "Cursor no vàlid")
+        field = model._meta.get_field(camp)
+        try:
+            valor = field.to_python(valor)
+            field.run_validators(valor)
+        except (ValidationError, TypeError, ValueError):
+            raise HttpError(400, "Cursor no vàlid")
+        convertits.append(valor)
+    return convertits
+
+
+def filtre_keyset(camps, valors):
+    # (a, b) > (x, y)  =>  a > x OR (a = x AND b > y)
+    condicio = Q()
+    for i, camp in enumerate(camps):
+        iguals = {camps[j]: valors[j] for j in range(i)}
+        condicio |= Q(**iguals, **{f"{camp}__gt": valors[i]})
+    return condicio
+
+
+def pagina_keyset(qs, ordre="id", cursor=None, limit=LIMIT_PER_DEFECTE, ordenacions=ORDENACIONS):
+    """
+    Retorna (files, seguent_cursor) d'una pàgina ordenada per `ordre`.
+    Cada pàgina és una cerca per índex a partir de l'última fila vista,
+    de manera que el cost no depèn de la profunditat de la pàgina.
+    """
+    camps = ordenacions.get(ordre)
+    if camps is None:
+        raise HttpError(400, f"Ordenació no permesa: {ordre}")
+    limit = max(1, min(limit, LIMIT_MAXIM))
+
+    qs = qs.order_by(*camps)
+    if cursor:
+        qs = qs.filter(filtre_keyset(camps, valors_cursor(qs.model, camps, cursor)))
+
+    # demanem una fila de més per saber si hi ha pàgina següent
+    files = list(qs[: limit + 1])
+    seguent = None
+    if len(files) > limit:
+        files = files[:limit]
+        seguent = codifica_cursor([valor_camp(files[-1], camp) for camp in camps])
+    return files, seguent
+
+
+def valor_camp(fila, camp):
+    if isinstance(fila, dict):
+        return fila[camp]
+    return getattr(fila, camp)
+
+
+def resposta_ndjson(qs, serialitza, mida_bloc=MIDA_BLOC_STREAM):
+    """
+    Resposta NDJSON que recorre el queryset per blocs amb iterator(),
+    sense carregar tota la taula en memòria. `serialitza` rep cada bloc
+    (una llista) i en retorna les files serialitzades, de manera que pot
+    completar-les amb una sola consulta per bloc.
+    """
+    def linies():
+        files = qs.iterator(chunk_size=mida_bloc)
+        while bloc := list(islice(files, mida_bloc)):
+            for fila in serialitza(bloc):
+                yield dumps(fila) + b"\n"
+
+    return StreamingHttpResponse(linies(), content_type="application/x-ndjson")
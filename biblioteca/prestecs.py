@@ -0,0 +1,383 @@
+"""
+Circulació: préstec i retorn d'exemplars i cua de reserves.
+
+Cada operació és una transacció curta que bloqueja les files sempre en el
+mateix ordre: primer l'exemplar (SELECT ... FOR UPDATE), després el
+registre del catàleg (cua de reserves i comptadors) i finalment els
+préstecs i les reserves. Així dues taules de préstec que escanegen
+exemplars alhora s'esperen però no es bloquegen mútuament. La restricció
+única parcial `prestec_actiu_unic` (un sol préstec obert per exemplar) és
+la segona línia de defensa; a MySQL, que no té índexs parcials, la fa la
+migració 0021 amb una columna generada i un índex únic. Un cop bloquejat
+l'exemplar, els préstecs i apartats se'n comproven amb lectures que també
+bloquegen: a MySQL (REPEATABLE READ) una lectura normal veu la foto del
+començament de la transacció i no el que una altra acaba de confirmar.
+
+Si la BD avorta la transacció per un bloqueig (deadlock a MySQL,
+"database is locked" a SQLite) l'operació es torna a intentar unes
+quantes vegades abans de retornar l'error.
+
+Les reserves fan cua per registre del catàleg, no per exemplar. Cada
+reserva en espera té un número de torn (`posicio`) i el registre guarda
+el primer i l'últim torn (`cua_inici`, `cua_final`), de manera que el lloc
+a la cua és posicio - cua_inici i el següent de la cua és la reserva amb
+posicio = cua_inici + 1: es troba amb una cerca per índex, sense recórrer
+la cua. Quan es retorna un exemplar queda apartat per a aquesta reserva
+fins a `data_limit`; `manage.py allibera_reserves` allibera els apartats
+caducats i els passa al següent. Un exemplar lliure no s'ha de poder
+emportar ningú mentre hi ha gent a la cua: els exemplars nous o que tornen
+a ser prestables s'aparten per al primer (`ofereix`, des de signals.py, i
+`ofereix_lliures` per als creats amb bulk_create), i un préstec d'un
+exemplar lliure amb cua l'aparta per al primer en lloc de deixar passar
+davant qui el demana.
+"""
+import random
+import time
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils.timezone import localdate
+
+from .models import Cataleg, Exemplar, Prestec, Reserva, Usuari
+
+
+INTENTS = 5
+
+
+class ErrorPrestec(Exception):
+    def __init__(self, estat, missatge):
+        super().__init__(missatge)
+        self.estat = estat
+        self.missatge = missatge
+
+
+def reintenta(funcio):
+    @wraps(funcio)
+    def embolcall(*args, **kwargs):
+        for intent in range(INTENTS):
+            try:
+                return funcio(*args, **kwargs)
+            except OperationalError:
+                # dins d'una transacció exterior no es pot repetir només aquest tros
+                if connection.in_atomic_block or intent == INTENTS - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.01 * 2 ** intent))
+    return embolcall
+
+
+def filtre_exemplar(registre=None, exemplar_id=None):
+    if exemplar_id is not None:
+        return {"pk": exemplar_id}
+    if registre:
+        return {"registre": registre}
+    raise ErrorPrestec(400, "Cal indicar el registre o l'id de l'exemplar")
+
+
+def bloqueja_exemplar(registre=None, exemplar_id=None):
+    try:
+        return Exemplar.objects.select_for_update().get(**filtre_exemplar(registre, exemplar_id))
+    except Exemplar.DoesNotExist:
+        raise ErrorPrestec(404, "Exemplar inexistent")
+
+
+def bloqueja_cataleg(cataleg_id):
+    try:
+        return Cataleg.objects.select_for_update().only(
+            "pk", "cua_inici", "cua_final", "exemplars_prestables"
+        ).get(pk=cataleg_id)
+    except Cataleg.DoesNotExist:
+        raise ErrorPrestec(404, "Registre del catàleg inexistent")
+
+
+def bloquejant(qs):
+    """Si hi ha alguna fila, amb una lectura que la bloqueja (i veu l'última versió confirmada)."""
+    return bool(qs.select_for_update().values_list("pk", flat=True)[:1])
+
+
+def prestat(exemplar):
+    return bloquejant(Prestec.objects.filter(exemplar=exemplar, data_retorn__isnull=True))
+
+
+def lliure(exemplar):
+    """Amb l'exemplar ja bloquejat: prestable, sense préstec obert ni apartat."""
+    return (not exemplar.baixa and not exemplar.exclos_prestec and not prestat(exemplar)
+            and not bloquejant(Reserva.objects.filter(exemplar=exemplar, estat="assignada")))
+
+
+def obte_usuari(usuari_id=None, username=None):
+    filtre = {"pk": usuari_id} if usuari_id is not None else {"username": username}
+    if usuari_id is None and not username:
+        raise ErrorPrestec(400, "Cal indicar l'usuari")
+    try:
+        return Usuari.objects.only("pk", "is_active").get(**filtre)
+    except Usuari.DoesNotExist:
+        raise ErrorPrestec(404, "Usuari inexistent")
+
+
+@reintenta
+def checkout(registre=None, exemplar_id=None, usuari_id=None, username=None, anotacions=None):
+    usuari = obte_usuari(usuari_id, username)
+    if not usuari.is_active:
+        raise ErrorPrestec(409, "L'usuari està donat de baixa")
+    try:
+        with transaction.atomic():
+            exemplar = bloqueja_exemplar(registre, exemplar_id)
+            if exemplar.baixa:
+                raise ErrorPrestec(409, "L'exemplar està donat de baixa")
+            if exemplar.exclos_prestec:
+                raise ErrorPrestec(409, "L'exemplar està exclòs de préstec")
+            if prestat(exemplar):
+                raise ErrorPrestec(409, "L'exemplar ja està en préstec")
+            if serveix_reserva(exemplar, usuari.pk):
+                return Prestec.objects.create(exemplar=exemplar, usuari=usuari, anotacions=anotacions)
+            # l'exemplar és per a una altra reserva: es confirma l'apartat, si és nou
+    except IntegrityError:
+        # una altra transacció ha deixat anar el mateix exemplar just abans
+        raise ErrorPrestec(409, "L'exemplar ja està en préstec")
+    raise ErrorPrestec(409, "L'exemplar està apartat per a una altra reserva")
+
+
+@reintenta
+def checkin(registre=None, exemplar_id=None):
+    """
+    Tanca el préstec obert de l'exemplar. Si algú l'havia reservat, l'exemplar
+    queda apartat per al primer de la cua i la reserva es deixa a
+    `prestec.reserva_assignada`.
+    """
+    with transaction.atomic():
+        exemplar = bloqueja_exemplar(registre, exemplar_id)
+        cataleg = bloqueja_cataleg(exemplar.cataleg_id)
+        prestec = Prestec.objects.select_for_update().filter(exemplar=exemplar, data_retorn__isnull=True).first()
+        if prestec is None:
+            raise ErrorPrestec(409, "L'exemplar no està en préstec")
+        prestec.data_retorn = localdate()
+        prestec.save()
+        prestec.reserva_assignada = assigna_seguent(exemplar, cataleg)
+        return prestec
+
+
+def marca_vencuts(avui=None):
+    """
+    Actualitza el camp `vencut` de tots els préstecs oberts amb dos UPDATE.
+    Tots dos filtren per data_retorn IS NULL i un rang de data_venciment,
+    així que l'índex prestec_obert_venc_idx només recorre els préstecs
+    oberts, per gran que sigui l'històric. Retorna (marcats, desmarcats).
+    """
+    avui = avui or localdate()
+    oberts = Prestec.objects.filter(data_retorn__isnull=True)
+    marcats = oberts.filter(data_venciment__lt=avui, vencut=False).update(vencut=True)
+    # préstecs renovats: el venciment s'ha allargat
+    desmarcats = oberts.filter(data_venciment__gte=avui, vencut=True).update(vencut=False)
+    return marcats, desmarcats
+
+
+# Reserves
+
+def dies_recollida():
+    return getattr(settings, "RESERVA_DIES_RECOLLIDA", 3)
+
+
+def exemplar_lliure(cataleg_id, descartats=()):
+    """Un exemplar prestable del registre que no està prestat ni apartat (sense bloquejar-lo)."""
+    prestec = Prestec.objects.filter(exemplar=OuterRef("pk"), data_retorn__isnull=True)
+    apartat = Reserva.objects.filter(exemplar=OuterRef("pk"), estat="assignada")
+    return (
+        Exemplar.objects.filter(cataleg_id=cataleg_id, baixa=False, exclos_prestec=False)
+        .exclude(pk__in=descartats).exclude(Exists(prestec)).exclude(Exists(apartat))
+        .order_by("pk").first()
+    )
+
+
+def bloqueja_lliure(cataleg_id):
+    """Bloqueja i retorna un exemplar lliure del registre, o None. Va abans de bloquejar el registre."""
+    descartats = []
+    while (candidat := exemplar_lliure(cataleg_id, descartats)) is not None:
+        exemplar = bloqueja_exemplar(exemplar_id=candidat.pk)
+        # entre la consulta i el bloqueig, algú se l'ha pogut emportar
+        if lliure(exemplar):
+            return exemplar
+        descartats.append(exemplar.pk)
+    return None
+
+
+def aparta(reserva, exemplar):
+    avui = localdate()
+    reserva.estat = "assignada"
+    reserva.exemplar = exemplar
+    reserva.data_assignacio = avui
+    reserva.data_limit = avui + timedelta(days=dies_recollida())
+    reserva.save()
+
+
+def assigna_seguent(exemplar, cataleg):
+    """Aparta l'exemplar (ja bloquejat i lliure) per al primer de la cua del registre."""
+    if exemplar.baixa or exemplar.exclos_prestec or cataleg.cua_inici == cataleg.cua_final:
+        return None
+    seguent = Reserva.objects.filter(
+        cataleg_id=cataleg.pk, estat="espera", posicio=cataleg.cua_inici + 1
+    ).first()
+    if seguent is None:
+        return None
+    Cataleg.objects.filter(pk=cataleg.pk).update(cua_inici=F("cua_inici") + 1)
+    cataleg.cua_inici += 1
+    aparta(seguent, exemplar)
+    return seguent
+
+
+def treu_de_cua(reserva, cataleg, estat):
+    # els que anaven darrere avancen un lloc; només passa en cancel·lar o
+    # quan algú s'emporta un exemplar lliure abans que li arribi el torn
+    Reserva.objects.filter(
+        cataleg_id=cataleg.pk, estat="espera", posicio__gt=reserva.posicio
+    ).update(posicio=F("posicio") - 1)
+    Cataleg.objects.filter(pk=cataleg.pk).update(cua_final=F("cua_final") - 1)
+    cataleg.cua_final -= 1
+    reserva.estat = estat
+    reserva.save()
+
+
+def serveix_reserva(exemplar, usuari_id):
+    """
+    Dins del préstec: marca com a servida la reserva que el préstec satisfà.
+    Retorna False si l'exemplar és per a una altra reserva: si no estava
+    apartat i hi ha cua, queda apartat per al primer.
+    """
+    cataleg = bloqueja_cataleg(exemplar.cataleg_id)
+    apartada = Reserva.objects.select_for_update().filter(exemplar=exemplar, estat="assignada").first()
+    if apartada is None:
+        apartada = assigna_seguent(exemplar, cataleg)
+    if apartada is not None:
+        if apartada.usuari_id != usuari_id:
+            return False
+        apartada.estat = "servida"
+        apartada.save()
+        return True
+    # sense cua no hi pot haver reserves en espera; només si els torns no quadren
+    en_espera = Reserva.objects.filter(usuari_id=usuari_id, cataleg_id=cataleg.pk, estat="espera").first()
+    if en_espera is not None:
+        treu_de_cua(en_espera, cataleg, "servida")
+    return True
+
+
+@reintenta
+def reserva(usuari_id, cataleg_id):
+    """
+    Posa l'usuari a la cua del registre. Si no hi ha ningú esperant i queda
+    un exemplar lliure, l'hi aparta directament.
+    """
+    try:
+        with transaction.atomic():
+            # l'exemplar abans que el registre, com a la resta d'operacions
+            exemplar = bloqueja_lliure(cataleg_id)
+            cataleg = bloqueja_cataleg(cataleg_id)
+            if not cataleg.exemplars_prestables:
+                raise ErrorPrestec(409, "El registre no té exemplars prestables")
+            if Reserva.objects.filter(usuari_id=usuari_id, cataleg_id=cataleg_id,
+                                      estat__in=Reserva.ESTATS_ACTIUS).exists():
+                raise ErrorPrestec(409, "Ja tens una reserva activa d'aquest registre")
+            nova = Reserva(usuari_id=usuari_id, cataleg_id=cataleg_id)
+            if exemplar is not None:
+                if cataleg.cua_inici == cataleg.cua_final:
+                    aparta(nova, exemplar)
+                    return nova
+                # un exemplar lliure amb gent esperant és per al primer de la cua
+                assigna_seguent(exemplar, cataleg)
+            Cataleg.objects.filter(pk=cataleg_id).update(cua_final=F("cua_final") + 1)
+            nova.posicio = cataleg.cua_final + 1
+            nova.save()
+            return nova
+    except IntegrityError:
+        raise ErrorPrestec(409, "Ja tens una reserva activa d'aquest registre")
+
+
+@reintenta
+def ofereix(exemplar_id):
+    """Si l'exemplar està lliure i algú espera el registre, l'aparta per al primer de la cua."""
+    cataleg_id = Exemplar.objects.filter(pk=exemplar_id, cataleg__cua_inici__lt=F("cataleg__cua_final")) \
+        .values_list("cataleg_id", flat=True).first()
+    if cataleg_id is None:
+        # sense cua (el cas habitual), cap bloqueig
+        return None
+    with transaction.atomic():
+        exemplar = bloqueja_exemplar(exemplar_id=exemplar_id)
+        if not lliure(exemplar):
+            return None
+        return assigna_seguent(exemplar, bloqueja_cataleg(exemplar.cataleg_id))
+
+
+def ofereix_lliures():
+    """Aparta per a la cua els exemplars lliures dels registres amb reserves en espera. Retorna quants."""
+    oferts = 0
+    amb_cua = Cataleg.objects.filter(cua_inici__lt=F("cua_final")).order_by("pk").values_list("pk", flat=True)
+    for cataleg_id in list(amb_cua):
+        while (exemplar := exemplar_lliure(cataleg_id)) is not None and ofereix(exemplar.pk):
+            oferts += 1
+    return oferts
+
+
+def bloqueja_reserva(reserva_id):
+    fila = Reserva.objects.filter(pk=reserva_id).values_list("exemplar_id", "cataleg_id").first()
+    if fila is None:
+        raise ErrorPrestec(404, "Reserva inexistent")
+    exemplar_id, cataleg_id = fila
+    if exemplar_id is not None:
+        bloqueja_exemplar(exemplar_id=exemplar_id)
+    cataleg = bloqueja_cataleg(cataleg_id)
+    return Reserva.objects.select_for_update().select_related("exemplar").get(pk=reserva_id), cataleg
+
+
+def allibera(reserva, cataleg, estat):
+    # l'exemplar que tenia apartat passa al següent de la cua
+    exemplar = reserva.exemplar
+    reserva.estat = estat
+    reserva.save()
+    if exemplar is not None:
+        assigna_seguent(exemplar, cataleg)
+
+
+@reintenta
+def cancella(reserva_id):
+    with transaction.atomic():
+        reserva, cataleg = bloqueja_reserva(reserva_id)
+        if reserva.estat == "espera":
+            treu_de_cua(reserva, cataleg, "cancelada")
+        elif reserva.estat == "assignada":
+            allibera(reserva, cataleg, "cancelada")
+        else:
+            raise ErrorPrestec(409, "La reserva ja no està activa")
+        return reserva
+
+
+@reintenta
+def caduca(reserva_id, avui):
+    with transaction.atomic():
+        reserva, cataleg = bloqueja_reserva(reserva_id)
+        if reserva.estat != "assignada" or reserva.data_limit is None or reserva.data_limit >= avui:
+            return False
+        allibera(reserva, cataleg, "caducada")
+        return True
+
+
+def allibera_caducades(avui=None, mida_lot=500):
+    """Caduca els apartats amb data límit passada. Retorna quants n'ha alliberat."""
+    avui = avui or localdate()
+    alliberades = 0
+    while True:
+        lot = list(
+            Reserva.objects.filter(estat="assignada", data_limit__lt=avui)
+            .order_by("data_limit", "pk").values_list("pk", flat=True)[:mida_lot]
+        )
+        if not lot:
+            return alliberades
+        for pk in lot:
+            alliberades += caduca(pk, avui)
+
+
+def posicio_cua(reserva):
+    """Lloc a la cua (1 = el següent), amb `reserva.cataleg` ja carregat."""
+    if reserva.estat != "espera":
+        return None
+    return reserva.posicio - reserva.cataleg.cua_inici
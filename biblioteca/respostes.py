@@ -0,0 +1,111 @@
+"""
+Memòria cau de respostes de l'API del catàleg.
+
+Les respostes de les operacions decorades amb `en_cache` es desen a la
+memòria cau "cataleg" (CACHE_CATALEG_URL) ja comprimides: el JSON tal
+qual, en gzip i en brotli. Cada petició rep la variant que accepta el
+client (Accept-Encoding) sense tornar a consultar ni serialitzar res.
+
+La clau porta la versió del catàleg (versio.py): quan els senyals la
+canvien, les respostes anteriors deixen de servir-se i la memòria cau
+les acaba expulsant (MAX_ENTRIES i TIMEOUT de la configuració). Les
+respostes de més de RESPOSTES_MIDA_MAXIMA bytes no es desen.
+
+Com que la validesa depèn de la versió, només es fa servir quan la
+versió és fiable (versio.fiable). La memòria cau "cataleg" sí que pot
+ser de cada procés: les entrades d'una versió vella ja no es llegeixen.
+"""
+import functools
+import gzip
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from ninja.decorators import decorate_view
+
+import brotli
+
+from . import metriques
+from .versio import si_es_fiable, versio_peticio
+
+
+ALIAS = "cataleg"
+MIDA_MINIMA_COMPRESSIO = 200
+
+
+def mida_maxima():
+    return getattr(settings, "RESPOSTES_MIDA_MAXIMA", 5 * 1024 * 1024)
+
+
+def clau(request):
+    consulta = sorted((k, v) for k, valors in request.GET.lists() for v in valors)
+    text = f"{versio_peticio(request)['etag']}|{request.path}|{consulta}"
+    return "resposta:" + hashlib.md5(text.encode()).hexdigest()
+
+
+def comprimeix(contingut):
+    variants = {"identity": contingut}
+    if len(contingut) >= MIDA_MINIMA_COMPRESSIO:
+        variants["gzip"] = gzip.compress(contingut, compresslevel=6, mtime=0)
+        variants["br"] = brotli.compress(contingut, quality=6)
+    return variants
+
+
+def tria_codificacio(request, variants):
+    acceptades = set()
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        nom, _, parametres = part.partition(";")
+        if parametres.replace(" ", "").rstrip("0.") == "q=":
+            # q=0: explícitament no acceptada
+            continue
+        acceptades.add(nom.strip().lower())
+    for codificacio in ("br", "gzip"):
+        if codificacio in variants and codificacio in acceptades:
+            return codificacio
+    return "identity"
+
+
+def resposta(request, entrada):
+    codificacio = tria_codificacio(request, entrada["variants"])
+    response = HttpResponse(entrada["variants"][codificacio], content_type=entrada["content_type"],
+                            status=entrada["estat"])
+    if codificacio != "identity":
+        response["Content-Encoding"] = codificacio
+    if len(entrada["variants"]) > 1:
+        patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def desa_en_cache(run):
+    @functools.wraps(run)
+    def embolcall(request, *args, **kwargs):
+        if request.method != "GET":
+            return run(request, *args, **kwargs)
+        memoria = caches[ALIAS]
+        k = clau(request)
+        entrada = memoria.get(k)
+        if entrada is not None:
+            metriques.registre.incrementa("biblioteca_cache_respostes_total", resultat="encert")
+            return resposta(request, entrada)
+
+        metriques.registre.incrementa("biblioteca_cache_respostes_total", resultat="errada")
+        response = run(request, *args, **kwargs)
+        if response.status_code != 200 or response.streaming or response.has_header("Content-Encoding"):
+            return response
+        contingut = response.content
+        if len(contingut) > mida_maxima():
+            return response
+        entrada = {
+            "estat": response.status_code,
+            "content_type": response["Content-Type"],
+            "variants": comprimeix(contingut),
+        }
+        memoria.set(k, entrada)
+        return resposta(request, entrada)
+    return embolcall
+
+
+# A sota de @condicional: un 304 no arriba a consultar la memòria cau
+en_cache = decorate_view(si_es_fiable(desa_en_cache))
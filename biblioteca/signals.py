@@ -0,0 +1,143 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import cerca, comptadors, prestecs, versio
+from .autenticacio import cache_tokens, revocacions
+from .models import Cataleg, Categoria, Exemplar, Llengua, Pais, Prestec, Reserva, Usuari
+
+
+# Índex de cerca del catàleg
+
+@receiver(post_save)
+def indexa_cataleg(sender, instance, raw=False, **kwargs):
+    # post_save s'envia amb el subtipus (Llibre, Revista...), no amb Cataleg
+    if raw or not isinstance(instance, Cataleg) or not cerca.indexacio_automatica():
+        return
+    cerca.indexa(instance)
+
+@receiver(pre_delete, sender=Cataleg)
+def desindexa_cataleg(sender, instance, **kwargs):
+    # en esborrar un subtipus Django també esborra el Cataleg pare, i només
+    # volem actuar una vegada
+    if cerca.indexacio_automatica():
+        cerca.desindexa(instance.pk)
+
+
+# Versió del catàleg (ETag de /api/llibres, /api/exemplars...). Els préstecs i
+# les reserves en canvien la part de disponibilitat a comptadors.aplica.
+
+@receiver(post_save)
+# post_delete amb remitents explícits: un receptor per a tots els models
+# impediria a Django esborrar amb un sol DELETE (p. ex. l'índex de cerca).
+# En esborrar un subtipus, el Cataleg pare també envia post_delete.
+@receiver(post_delete, sender=Cataleg)
+@receiver(post_delete, sender=Exemplar)
+@receiver(post_delete, sender=Categoria)
+@receiver(post_delete, sender=Pais)
+@receiver(post_delete, sender=Llengua)
+def canvia_versio_cataleg(sender, instance, **kwargs):
+    # Pais i Llengua: surten a /api/llibres?expand=
+    if isinstance(instance, (Cataleg, Exemplar, Categoria, Pais, Llengua)):
+        versio.canvia()
+
+@receiver(m2m_changed, sender=Cataleg.tags.through)
+def canvia_versio_etiquetes(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        versio.canvia()
+
+
+# Memòria cau de tokens: qualsevol canvi a l'usuari (token nou, baixa,
+# permisos...) n'invalida les entrades
+
+@receiver(post_save, sender=Usuari)
+@receiver(post_delete, sender=Usuari)
+def invalida_tokens_usuari(sender, instance, **kwargs):
+    cache_tokens.invalida_usuari(instance.pk)
+
+# Els tokens signats no es poden esborrar i porten els permisos de quan es
+# van emetre: un usuari donat de baixa o a qui canvien els privilegis passa
+# a la llista de revocació. pre_save guarda els privilegis que tenia.
+
+PRIVILEGIS = ("is_active", "is_staff", "is_superuser")
+
+@receiver(pre_save, sender=Usuari)
+def guarda_privilegis_anteriors(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._privilegis_anteriors = None
+    if raw or instance.pk is None or (update_fields is not None and not set(PRIVILEGIS) & set(update_fields)):
+        return
+    instance._privilegis_anteriors = Usuari.objects.filter(pk=instance.pk).values_list(*PRIVILEGIS).first()
+
+@receiver(post_save, sender=Usuari)
+def revoca_tokens_usuari_inactiu(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    anteriors = getattr(instance, "_privilegis_anteriors", None)
+    instance._privilegis_anteriors = None
+    actuals = tuple(getattr(instance, camp) for camp in PRIVILEGIS)
+    if not instance.is_active or (anteriors is not None and anteriors != actuals):
+        revocacions.revoca_usuari(instance.pk)
+
+@receiver(m2m_changed, sender=Usuari.groups.through)
+@receiver(m2m_changed, sender=Usuari.user_permissions.through)
+def revoca_tokens_canvi_permisos(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear") or getattr(instance, "_grupo_inicial", False):
+        return
+    if not reverse:
+        revocacions.revoca_usuari(instance.pk)
+    elif action == "pre_clear":
+        # group.user_set.clear(): els usuaris afectats són els que encara hi ha
+        for usuari_id in instance.user_set.values_list("pk", flat=True):
+            revocacions.revoca_usuari(usuari_id)
+    else:
+        for usuari_id in pk_set:
+            revocacions.revoca_usuari(usuari_id)
+
+
+# Comptadors d'exemplars del catàleg. pre_save guarda l'aportació que tenia
+# la fila abans del canvi i post_save aplica la diferència.
+
+ESTATS = {
+    Exemplar: (comptadors.estat_exemplar, comptadors.estat_desat_exemplar),
+    Prestec: (comptadors.estat_prestec, comptadors.estat_desat_prestec),
+    Reserva: (comptadors.estat_reserva, comptadors.estat_desat_reserva),
+}
+
+@receiver(pre_save, sender=Exemplar)
+@receiver(pre_save, sender=Prestec)
+@receiver(pre_save, sender=Reserva)
+def guarda_aportacio_anterior(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _, estat_desat = ESTATS[sender]
+    instance._aportacio_anterior = estat_desat(instance.pk) if instance.pk else None
+
+@receiver(post_save, sender=Exemplar)
+@receiver(post_save, sender=Prestec)
+@receiver(post_save, sender=Reserva)
+def actualitza_comptadors(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    estat, _ = ESTATS[sender]
+    comptadors.aplica(getattr(instance, "_aportacio_anterior", None), estat(instance))
+    instance._aportacio_anterior = None
+
+@receiver(post_delete, sender=Exemplar)
+@receiver(post_delete, sender=Prestec)
+@receiver(post_delete, sender=Reserva)
+def descompta(sender, instance, **kwargs):
+    # l'esborrat (també en cascada) ja va dins d'una transacció
+    estat, _ = ESTATS[sender]
+    comptadors.aplica(estat(instance), None)
+
+
+# Cua de reserves: un exemplar nou o que torna a ser prestable és per al
+# primer que espera el registre. Quan es confirmi: prestecs.ofereix bloqueja
+# l'exemplar en una transacció pròpia.
+
+@receiver(post_save, sender=Exemplar)
+def ofereix_a_la_cua(sender, instance, raw=False, **kwargs):
+    if raw or instance.baixa or instance.exclos_prestec:
+        return
+    exemplar_id = instance.pk
+    transaction.on_commit(lambda: prestecs.ofereix(exemplar_id))
@@ -0,0 +1,88 @@
+"""
+Sortida JSON ràpida de l'API.
+
+RendererRapid codifica amb orjson (si no hi és, amb json de la llibreria
+estàndard i el codificador de Ninja).
+
+Sortida de confiança (API_SORTIDA_DIRECTA, activada per defecte): les
+llistes grans es construeixen amb .values() i es codifiquen directament,
+sense crear ni validar un esquema de pydantic per fila. Els esquemes de
+sortida continuen declarats a les operacions, de manera que l'OpenAPI no
+canvia, i `files_esquema` tria exactament els seus camps i en el seu
+ordre. Com que no hi ha validació, és responsabilitat de la vista que
+les dades ja tinguin la forma de l'esquema. Amb API_SORTIDA_DIRECTA=off
+les vistes tornen a passar per pydantic (útil per comprovar-ho).
+"""
+import json
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from ninja.errors import HttpError
+from ninja.renderers import JSONRenderer
+from ninja.responses import NinjaJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _per_defecte(obj):
+    # el que orjson no sap codificar (Decimal, esquemes...) com ho faria Ninja
+    return NinjaJSONEncoder().default(obj)
+
+
+def dumps(dades):
+    """JSON en bytes."""
+    if orjson is not None:
+        return orjson.dumps(dades, default=_per_defecte)
+    return json.dumps(dades, cls=NinjaJSONEncoder).encode()
+
+
+class RendererRapid(JSONRenderer):
+    def render(self, request, data, *, response_status):
+        return dumps(data)
+
+
+def directa():
+    return getattr(settings, "API_SORTIDA_DIRECTA", True)
+
+
+def resposta_directa(dades, status=200):
+    """Resposta ja codificada: Ninja la retorna tal qual, sense validar-la amb l'esquema."""
+    from .instrumentacio import compta_serialitzacio
+    inici = time.perf_counter()
+    contingut = dumps(dades)
+    compta_serialitzacio(time.perf_counter() - inici)
+    return HttpResponse(contingut, status=status, content_type=RendererRapid.media_type)
+
+
+def files_esquema(files, esquema, calculats=None, camps=None):
+    """
+    Dicts amb els camps de `esquema` (o només `camps`), en el seu ordre, a
+    partir de files de .values(). `calculats` dona els camps que no són
+    columnes: {camp: funció(fila)}.
+    """
+    calculats = calculats or {}
+    camps = list(camps or esquema.model_fields)
+    return [
+        {camp: calculats[camp](fila) if camp in calculats else fila[camp] for camp in camps}
+        for fila in files
+    ]
+
+
+def columnes_esquema(esquema, calculats=None, necessaries=(), camps=None):
+    """Camps de l'esquema (o només `camps`) que cal demanar a .values()."""
+    calculats = calculats or {}
+    columnes = [camp for camp in camps or esquema.model_fields if camp not in calculats]
+    return columnes + [camp for camp in necessaries if camp not in columnes]
+
+
+def llista_parametre(valor, permesos, nom):
+    """Valors d'un paràmetre separat per comes (?fields=id,titol), en l'ordre de `permesos`."""
+    demanats = {part.strip() for part in (valor or "").split(",") if part.strip()}
+    desconeguts = demanats - set(permesos)
+    if desconeguts:
+        raise HttpError(400, f"Valors no permesos a {nom}: {', '.join(sorted(desconeguts))}")
+    return [camp for camp in permesos if camp in demanats]
@@ -1,3 +1,1240 @@
-from django.test import TestCase
+import base64
+import csv
+import gzip
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import brotli
+
+from django.contrib.auth.models import Group
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.timezone import localdate
+
+from . import cerca, enriquiment, importacio, marc, massiu, metriques, prestecs, versio
+from .importacio import ImportadorUsuarios
+from .autenticacio import durada_token, emet_token_signat, revocacions
+from .models import DVD, Centre, Cicle, Exemplar, ImportacioCSV, Llibre, Prestec, Reserva, Usuari
+
+
+# el que retornaria OpenLibrary per a cada ISBN (jscmd=details)
+OPENLIBRARY = {
+    "9780140449136": {
+        "info_url": "https://openlibrary.org/books/OL1M/Crime_and_punishment",
+        "preview_url": "https://archive.org/details/crimeandpunishme00dost",
+        "thumbnail_url": "https://covers.openlibrary.org/b/id/1-S.jpg",
+        "details": {"publishers": ["Penguin Books"], "number_of_pages": 671, "publish_date": "March 3, 2003"},
+    },
+    "9788466331630": {
+        "info_url": "https://openlibrary.org/books/OL2M/Cien_anos_de_soledad",
+        "details": {"publishers": [{"name": "Debolsillo"}], "publish_date": "c2015"},
+    },
+}
+
+
+class OpenLibraryLocal(BaseHTTPRequestHandler):
+    """Fa el paper de l'API Books d'OpenLibrary. Els ISBN de `servidor.errors` responen 503."""
+
+    def do_GET(self):
+        servidor = self.server
+        with servidor.lock:
+            servidor.peticions.append(self.path)
+            servidor.en_curs += 1
+            servidor.maxim_en_curs = max(servidor.maxim_en_curs, servidor.en_curs)
+        time.sleep(servidor.retard)
+        # s'acaba abans d'enviar la resposta: un cop rebuda, el client ja pot fer la següent
+        with servidor.lock:
+            servidor.en_curs -= 1
+        claus = parse_qs(urlparse(self.path).query)["bibkeys"][0].split(",")
+        if any(clau.removeprefix("ISBN:") in servidor.errors for clau in claus):
+            self.send_response(503)
+            self.end_headers()
+            return
+        cos = json.dumps({
+            clau: OPENLIBRARY[clau.removeprefix("ISBN:")]
+            for clau in claus if clau.removeprefix("ISBN:") in OPENLIBRARY
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cos)))
+        self.end_headers()
+        self.wfile.write(cos)
+
+    def log_message(self, *args):
+        pass
+
+
+class EnriquimentTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.servidor = ThreadingHTTPServer(("127.0.0.1", 0), OpenLibraryLocal)
+        cls.servidor.lock = threading.Lock()
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.servidor.peticions = []
+        self.servidor.en_curs = 0
+        self.servidor.maxim_en_curs = 0
+        self.servidor.retard = 0
+        self.servidor.errors = set()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        configuracio = override_settings(
+            OPENLIBRARY_URL="http://127.0.0.1:%d" % self.servidor.server_address[1],
+            ENRIQUIMENT_CACHE_DIR=self.cache_dir,
+        )
+        configuracio.enable()
+        self.addCleanup(configuracio.disable)
+        self.crim = Llibre.objects.create(titol="Crim i càstig", ISBN="978-0-14-044913-6", editorial="Proa")
+        self.cent_anys = Llibre.objects.create(titol="Cent anys de solitud", ISBN="9788466331630")
+        self.desconegut = Llibre.objects.create(titol="Desconegut", ISBN="9780000000002")
+
+    def test_omple_els_camps_buits(self):
+        enriquidor = enriquiment.Enriquidor().enriqueix()
+        self.crim.refresh_from_db()
+        self.cent_anys.refresh_from_db()
+        self.assertEqual(self.crim.editorial, "Proa")
+        self.assertEqual(self.crim.pagines, 671)
+        self.assertEqual(self.crim.data_edicio, date(2003, 3, 3))
+        self.assertEqual(self.crim.thumbnail_url, "https://covers.openlibrary.org/b/id/1-S.jpg")
+        self.assertEqual(self.cent_anys.editorial, "Debolsillo")
+        self.assertEqual(self.cent_anys.data_edicio, date(2015, 1, 1))
+        self.assertIsNone(self.cent_anys.pagines)
+        self.assertEqual((enriquidor.trobats, enriquidor.actualitzats, enriquidor.errors), (2, 2, []))
+        # els tres ISBN en una sola petició
+        self.assertEqual(len(self.servidor.peticions), 1)
+
+    def test_sobreescriu(self):
+        enriquiment.Enriquidor(sobreescriu=True).enriqueix()
+        self.crim.refresh_from_db()
+        self.assertEqual(self.crim.editorial, "Penguin Books")
+
+    def test_memoria_cau(self):
+        enriquiment.Enriquidor().enriqueix()
+        Llibre.objects.filter(pk=self.crim.pk).update(pagines=None)
+        enriquidor = enriquiment.Enriquidor().enriqueix()
+        self.crim.refresh_from_db()
+        self.assertEqual(self.crim.pagines, 671)
+        self.assertEqual(len(self.servidor.peticions), 1)
+        self.assertEqual((enriquidor.consultats, enriquidor.de_cache), (0, 3))
+
+        enriquidor = enriquiment.Enriquidor(refresca=True).enriqueix()
+        self.assertEqual(len(self.servidor.peticions), 2)
+
+    def test_memoria_cau_negativa(self):
+        enriquiment.Enriquidor().enriqueix(Llibre.objects.filter(pk=self.desconegut.pk))
+        enriquidor = enriquiment.Enriquidor().enriqueix(Llibre.objects.filter(pk=self.desconegut.pk))
+        self.assertEqual(len(self.servidor.peticions), 1)
+        self.assertEqual((enriquidor.de_cache, enriquidor.trobats), (1, 0))
+
+        # caducada, es torna a consultar
+        with override_settings(ENRIQUIMENT_CADUCITAT_NEGATIVA_DIES=0):
+            enriquiment.Enriquidor().enriqueix(Llibre.objects.filter(pk=self.desconegut.pk))
+        self.assertEqual(len(self.servidor.peticions), 2)
+
+    @mock.patch.object(enriquiment, "ESPERA_REINTENT", 0)
+    def test_els_errors_no_es_desen(self):
+        self.servidor.errors = {"9780140449136"}
+        with self.assertLogs("biblioteca.enriquiment", "WARNING"):
+            enriquidor = enriquiment.Enriquidor(mida_lot=1).enriqueix()
+        self.assertEqual(enriquidor.errors, ["9780140449136"])
+        self.assertEqual(enriquidor.actualitzats, 1)
+        # els reintents, i res desat per a l'ISBN amb error
+        self.assertEqual(len(self.servidor.peticions), 2 + enriquiment.INTENTS)
+        self.assertFalse(os.path.exists(enriquidor.cache.cami("9780140449136")))
+
+        self.servidor.errors = set()
+        enriquidor = enriquiment.Enriquidor(mida_lot=1).enriqueix()
+        self.assertEqual((enriquidor.consultats, enriquidor.errors), (1, []))
+        self.crim.refresh_from_db()
+        self.assertEqual(self.crim.pagines, 671)
+
+    def test_concurrencia_limitada(self):
+        self.servidor.retard = 0.05
+        isbns = ["97800000%05d" % i for i in range(12)]
+        enriquidor = enriquiment.Enriquidor(concurrencia=3, mida_lot=1)
+        self.assertEqual(enriquidor.metadades(isbns), dict.fromkeys(isbns))
+        self.assertEqual(len(self.servidor.peticions), 12)
+        self.assertLessEqual(self.servidor.maxim_en_curs, 3)
+        self.assertGreater(self.servidor.maxim_en_curs, 1)
+
+    def test_data_publicacio(self):
+        self.assertEqual(enriquiment.data_publicacio("1998"), date(1998, 1, 1))
+        self.assertEqual(enriquiment.data_publicacio("March 1998"), date(1998, 3, 1))
+        self.assertEqual(enriquiment.data_publicacio("Mar 03, 1998"), date(1998, 3, 3))
+        self.assertEqual(enriquiment.data_publicacio("1998-03-03"), date(1998, 3, 3))
+        self.assertEqual(enriquiment.data_publicacio("[1998?]"), date(1998, 1, 1))
+        self.assertIsNone(enriquiment.data_publicacio("s.d."))
+        self.assertIsNone(enriquiment.data_publicacio(None))
+
+    def test_comanda(self):
+        sortida = StringIO()
+        call_command("enriqueix_llibres", "978-84-663-3163-0", stdout=sortida)
+        self.cent_anys.refresh_from_db()
+        self.crim.refresh_from_db()
+        self.assertEqual(self.cent_anys.editorial, "Debolsillo")
+        self.assertIsNone(self.crim.pagines)
+        self.assertIn("1 actualitzats", sortida.getvalue())
+
+    def test_accio_admin(self):
+        Usuari.objects.create_superuser("admin", "admin@example.com", "contrasenya")
+        self.client.login(username="admin", password="contrasenya")
+        resposta = self.client.post(reverse("admin:biblioteca_llibre_changelist"), {
+            "action": "enriqueix_openlibrary",
+            "_selected_action": [self.crim.pk, self.desconegut.pk],
+        }, follow=True)
+        self.assertContains(resposta, "1 llibres actualitzats")
+        self.crim.refresh_from_db()
+        self.cent_anys.refresh_from_db()
+        self.assertEqual(self.crim.pagines, 671)
+        self.assertIsNone(self.cent_anys.editorial)
+
+    @override_settings(ENRIQUIMENT_MAXIM_ADMIN=1)
+    def test_accio_admin_limita_la_seleccio(self):
+        Usuari.objects.create_superuser("admin", "admin@example.com", "contrasenya")
+        self.client.login(username="admin", password="contrasenya")
+        resposta = self.client.post(reverse("admin:biblioteca_llibre_changelist"), {
+            "action": "enriqueix_openlibrary",
+            "_selected_action": [self.crim.pk, self.desconegut.pk],
+        }, follow=True)
+        self.assertContains(resposta, "enriqueix_llibres")
+        self.assertEqual(self.servidor.peticions, [])
+        self.crim.refresh_from_db()
+        self.assertIsNone(self.crim.pagines)
+
+
+def capcalera_token(usuari):
+    return {"HTTP_AUTHORIZATION": f"Bearer {emet_token_signat(usuari)}"}
+
+
+CAPCALERA_USUARIS = "nom,cognom1,cognom2,email,telefon,centre,grup\n"
+
+
+def csv_usuaris(files):
+    return CAPCALERA_USUARIS + "".join(",".join(fila) + "\n" for fila in files)
+
+
+class ImportacioUsuarisTests(TestCase):
+    FILES = [
+        ("Anna", "Puig", "Soler", "Anna.Puig@Exemple.cat ", "600000001", "Institut Nou", "DAW1"),
+        ("Pau", "Vidal", "Roca", "pau@exemple.cat", "600000002", "Institut Nou", "DAW2"),
+        ("Pau", "Vidal", "Roca", "pau@exemple.cat", "600000002", "Institut Nou", "DAW2"),
+        ("Jordi", "Serra", "Mas", "", "600000003", "Institut Nou", "DAW1"),
+        ("Joan", "Ferrer", "", "joan@exemple.cat", "600000004", "Institut Nou", "DAW1"),
+        ("Marta2", "Pons", "Gil", "marta@exemple.cat", "600000005", "Institut Nou", "DAW1"),
+        ("Marta", "Pons", "Gil", "marta@exemple.cat", "6000-05", "Institut Nou", "DAW1"),
+        ("Laia", "Font", "Camps", "laia@exemple", "600000006", "Institut Nou", "DAW1"),
+        ("Èric", "Roig", "Pla", "existent@exemple.cat", "600000007", "Institut Nou", "DAW1"),
+        ("", "", "", "", "", "", ""),
+    ]
+    ERRORS = [
+        "El email pau@exemple.cat ya existe.",
+        "Email vacío",
+        "Faltan campos obligatorios.",
+        # el text de la ValidationError, tal com el desa l'importador
+        str(["El nombre 'Marta2' contiene caracteres no válidos."]),
+        str(["El teléfono '6000-05' debe contener solo números."]),
+        str(["El email 'laia@exemple' no tiene un formato válido."]),
+        "El email existent@exemple.cat ya existe.",
+    ]
+
+    def setUp(self):
+        Usuari.objects.create_user("existent@exemple.cat")
+
+    def importa(self, text, **opcions):
+        importador = ImportadorUsuarios(**opcions)
+        importador.procesa(csv.DictReader(StringIO(text)))
+        return importador
+
+    def comprova(self, importador):
+        self.assertEqual(importador.usuarios_creados, 2)
+        self.assertEqual([error["error"] for error in importador.errores], self.ERRORS)
+        anna = Usuari.objects.get(username="anna.puig@exemple.cat")
+        self.assertEqual((anna.first_name, anna.last_name, anna.telefon), ("Anna", "Puig Soler", "600000001"))
+        self.assertEqual((anna.centre.nom, anna.cicle.nom), ("Institut Nou", "DAW1"))
+        self.assertTrue(anna.check_password("1234"))
+        self.assertEqual(list(anna.groups.values_list("name", flat=True)), ["usuari"])
+        self.assertEqual(Centre.objects.count(), 1)
+        self.assertEqual(Cicle.objects.count(), 2)
+
+    def test_un_sol_lot(self):
+        self.comprova(self.importa(csv_usuaris(self.FILES)))
+
+    def test_per_lots(self):
+        # un duplicat en un lot posterior també es detecta
+        self.comprova(self.importa(csv_usuaris(self.FILES), mida_lot=2))
+
+    def test_consultes_per_lot(self):
+        files = [("Nom", "Cognom", "Segon", f"usuari{i}@exemple.cat", "600000000", f"Centre {i % 3}", "DAW1")
+                 for i in range(200)]
+        with CaptureQueriesContext(connection) as consultes:
+            importador = self.importa(csv_usuaris(files))
+        self.assertEqual(importador.usuarios_creados, 200)
+        # el nombre de consultes no depèn del nombre de files
+        self.assertLess(len(consultes), 20)
+        self.assertEqual(Usuari.groups.through.objects.filter(group__name="usuari").count(), 201)
+
+    def test_grup_amb_username_normalitzat(self):
+        # el username es desa en NFKC ("ﬁ" és "fi"): els ids s'han de tornar a llegir amb el mateix valor
+        importador = ImportadorUsuarios()
+        importador._crea_usuarios([{"nom": "Fina", "cognom1": "Puig", "cognom2": "Soler", "email": "\ufb01na@exemple.cat",
+                                    "telefon": "600000001", "centre": "Institut Nou", "grup": "DAW1"}])
+        fina = Usuari.objects.get(username="fina@exemple.cat")
+        self.assertEqual(list(fina.groups.values_list("name", flat=True)), ["usuari"])
+
+    def test_pujada(self):
+        fitxer = SimpleUploadedFile("usuaris.csv", csv_usuaris(self.FILES).encode())
+        resposta = self.client.post("/api/subir-documento/", {"archivo": fitxer})
+        self.assertEqual(resposta.status_code, 200)
+        dades = resposta.json()
+        self.assertEqual(dades["mensaje"], "✅ Archivo procesado. Usuarios creados: 2")
+        self.assertEqual([registre["email"] for registre in dades["registros"]],
+                         ["anna.puig@exemple.cat", "pau@exemple.cat"])
+        self.assertEqual([error["error"] for error in dades["errores"]], self.ERRORS)
+
+
+class TokensTests(TestCase):
+    def setUp(self):
+        # la llista de revocació és del procés: no ha de passar d'un test a l'altre
+        revocacions._jtis, revocacions._talls, revocacions._carregada = set(), {}, None
+        self.addCleanup(setattr, revocacions, "_talls", {})
+        self.usuari = Usuari.objects.create_user("lector", password="contrasenya")
+        self.bibliotecari = Usuari.objects.create_user("bibliotecari", password="contrasenya", is_staff=True)
+        self.grup = Group.objects.create(name="monitors")
+
+    def autenticat(self, capcalera):
+        # /api/token/cache és només per a bibliotecaris: 403 vol dir que el token és vàlid
+        return self.client.get("/api/token/cache", **capcalera).status_code != 401
+
+    def test_token_valid(self):
+        self.assertTrue(self.autenticat(capcalera_token(self.usuari)))
+        self.assertEqual(self.client.get("/api/token/cache", **capcalera_token(self.bibliotecari)).status_code, 200)
+        self.assertFalse(self.autenticat({"HTTP_AUTHORIZATION": "Bearer no:valid"}))
+
+    def test_token_caducat(self):
+        with mock.patch("time.time", return_value=time.time() - durada_token() - 10):
+            capcalera = capcalera_token(self.usuari)
+        self.assertFalse(self.autenticat(capcalera))
+
+    def test_logout(self):
+        capcalera, altre = capcalera_token(self.usuari), capcalera_token(self.usuari)
+        self.assertEqual(self.client.post("/api/logout", **capcalera).status_code, 200)
+        self.assertFalse(self.autenticat(capcalera))
+        self.assertTrue(self.autenticat(altre))
+
+    def test_revoca_tokens(self):
+        capcalera = capcalera_token(self.usuari)
+        url = f"/api/usuaris/{self.usuari.pk}/revoca-tokens"
+        self.assertEqual(self.client.post(url, **capcalera).status_code, 403)
+        self.assertEqual(self.client.post(url, **capcalera_token(self.bibliotecari)).status_code, 200)
+        self.assertFalse(self.autenticat(capcalera))
+        # la revocació és a la BD: també la veu un procés que no l'ha feta
+        revocacions._talls, revocacions._carregada = {}, None
+        self.assertFalse(self.autenticat(capcalera))
+
+    def test_token_emes_despres_de_revocar_dins_del_mateix_segon(self):
+        # "tanca totes les sessions" i tot seguit un login nou: el token nou val
+        segon = float(int(time.time()))
+        with mock.patch("time.time", return_value=segon + 0.2):
+            antic = capcalera_token(self.usuari)
+        with mock.patch("time.time", return_value=segon + 0.5):
+            revocacions.revoca_usuari(self.usuari.pk)
+        with mock.patch("time.time", return_value=segon + 0.8):
+            nou = capcalera_token(self.usuari)
+        self.assertFalse(self.autenticat(antic))
+        self.assertTrue(self.autenticat(nou))
+        revocacions._talls, revocacions._carregada = {}, None
+        self.assertFalse(self.autenticat(antic))
+        self.assertTrue(self.autenticat(nou))
+
+    def test_canvis_de_privilegis(self):
+        def desa(**camps):
+            def canvia(usuari):
+                for camp, valor in camps.items():
+                    setattr(usuari, camp, valor)
+                usuari.save()
+            return canvia
+
+        canvis = {
+            "is_staff": desa(is_staff=True),
+            "is_superuser": desa(is_superuser=True),
+            "is_active": desa(is_active=False),
+            "groups.add": lambda usuari: usuari.groups.add(self.grup),
+            "user_set.add": lambda usuari: self.grup.user_set.add(usuari),
+            "groups.clear": lambda usuari: usuari.groups.clear(),
+        }
+        for i, (nom, canvi) in enumerate(canvis.items()):
+            with self.subTest(nom):
+                usuari = Usuari.objects.create_user(f"usuari{i}", password="contrasenya")
+                capcalera = capcalera_token(usuari)
+                self.assertTrue(self.autenticat(capcalera))
+                canvi(usuari)
+                self.assertFalse(self.autenticat(capcalera))
+
+    def test_altres_canvis_no_revoquen(self):
+        capcalera = capcalera_token(self.usuari)
+        self.usuari.telefon = "600000000"
+        self.usuari.save()
+        self.usuari.is_staff = False
+        self.usuari.save(update_fields=["is_staff"])
+        self.assertTrue(self.autenticat(capcalera))
+
+
+class EstatImportacioTests(TestCase):
+    def setUp(self):
+        self.propietari = Usuari.objects.create_user("propietari", password="contrasenya")
+        self.altre = Usuari.objects.create_user("altre", password="contrasenya")
+        self.bibliotecari = Usuari.objects.create_user("bibliotecari", password="contrasenya", is_staff=True)
+        self.importacio = ImportacioCSV.objects.create(usuari=self.propietari, nom_fitxer="usuaris.csv")
+
+    def estat(self, usuari=None, importacio_id=None):
+        return self.client.get(f"/api/imports/{importacio_id or self.importacio.pk}",
+                               **(capcalera_token(usuari) if usuari else {}))
+
+    def test_nomes_el_propietari_i_els_bibliotecaris(self):
+        self.assertEqual(self.estat().status_code, 401)
+        self.assertEqual(self.estat(self.altre).status_code, 404)
+        self.assertEqual(self.estat(self.propietari).status_code, 200)
+        self.assertEqual(self.estat(self.bibliotecari).json()["nom_fitxer"], "usuaris.csv")
+        self.assertEqual(self.estat(self.propietari, self.importacio.pk + 1).status_code, 404)
+
+
+class ImportacionsSegonPlaTests(TestCase):
+    FILES = [("Anna", "Puig", "Soler", f"anna{i}@exemple.cat", "600000001", "Institut Nou", "DAW1") for i in range(3)]
+
+    def setUp(self):
+        directori = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directori, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=directori))
+        self.directori = os.path.join(directori, "importacions")
+        self.propietari = Usuari.objects.create_user("propietari")
+
+    def puja(self, contingut, usuari=None):
+        fitxer = SimpleUploadedFile("usuaris.csv", contingut)
+        return self.client.post("/api/subir-documento/?asincron=true", {"archivo": fitxer},
+                                **capcalera_token(usuari or self.propietari))
+
+    def test_el_fitxer_va_a_l_emmagatzematge(self):
+        resposta = self.puja(csv_usuaris(self.FILES).encode())
+        self.assertEqual(resposta.status_code, 202)
+        pujada = ImportacioCSV.objects.get(pk=resposta.json()["id"])
+        self.assertEqual(pujada.usuari, self.propietari)
+        self.assertEqual(os.listdir(self.directori), [os.path.basename(pujada.fitxer.name)])
+
+        call_command("importacions_worker", "--una-vegada", stdout=StringIO())
+        pujada.refresh_from_db()
+        self.assertEqual((pujada.estat, pujada.usuaris_creats, pujada.intents), ("acabada", 3, 1))
+        self.assertEqual(pujada.fitxer.name, "")
+        self.assertEqual(os.listdir(self.directori), [])
+        # qui l'ha pujada en pot seguir l'estat
+        resposta = self.client.get(f"/api/imports/{pujada.pk}", **capcalera_token(self.propietari))
+        self.assertEqual((resposta.status_code, resposta.json()["usuaris_creats"]), (200, 3))
+
+    def test_cal_token(self):
+        fitxer = SimpleUploadedFile("usuaris.csv", csv_usuaris(self.FILES).encode())
+        resposta = self.client.post("/api/subir-documento/?asincron=true", {"archivo": fitxer})
+        self.assertEqual(resposta.status_code, 401)
+        self.assertFalse(ImportacioCSV.objects.exists())
+
+    def test_no_utf8(self):
+        resposta = self.puja(csv_usuaris([("Núria", "Puig", "Soler", "nuria@exemple.cat", "6", "C", "G")]).encode("latin-1"))
+        self.assertEqual((resposta.status_code, resposta.json()["error"]), (500, "El archivo no está en UTF-8."))
+        self.assertFalse(ImportacioCSV.objects.exists())
+
+    def test_repren_les_importacions_abandonades(self):
+        importacio_id = self.puja(csv_usuaris(self.FILES).encode()).json()["id"]
+        # un worker l'havia reclamada i havia confirmat la primera fila abans d'aturar-se
+        Usuari.objects.create_user("anna0@exemple.cat")
+        fa_poc = timezone.now() - timedelta(seconds=60)
+        primera = dict(zip(("nom", "cognom1", "cognom2", "email", "telefon", "centre", "grup"), self.FILES[0]))
+        ImportacioCSV.objects.filter(pk=importacio_id).update(
+            estat="processant", intents=1, data_inici=fa_poc, data_batec=fa_poc,
+            files_processades=1, usuaris_creats=1, registres=[primera])
+        self.assertIsNone(importacio.reclama_importacio())
+
+        with override_settings(IMPORTACIONS_TIMEOUT=30):
+            reclamada = importacio.reclama_importacio()
+        self.assertEqual((reclamada.pk, reclamada.intents, reclamada.data_inici), (importacio_id, 2, fa_poc))
+        # el worker d'abans ja no hi pot confirmar cap lot
+        perduda = ImportacioCSV.objects.get(pk=importacio_id)
+        perduda.intents = 1
+        importacio.procesa_importacio(perduda)
+        self.assertEqual(ImportacioCSV.objects.get(pk=importacio_id).estat, "processant")
+        self.assertEqual(Usuari.objects.filter(username__startswith="anna").count(), 1)
+
+        importacio.procesa_importacio(reclamada)
+        reclamada.refresh_from_db()
+        self.assertEqual((reclamada.estat, reclamada.files_processades, reclamada.usuaris_creats), ("acabada", 3, 3))
+        self.assertEqual(reclamada.errors, [])
+        self.assertEqual(Usuari.objects.filter(username__startswith="anna").count(), 3)
+        # l'informe inclou també els usuaris creats abans de reprendre-la
+        self.assertEqual([registre["email"] for registre in reclamada.resultat["registros"]],
+                         [fila[3] for fila in self.FILES])
+
+    def test_error_inesperat(self):
+        importacio_id = self.puja(csv_usuaris(self.FILES).encode()).json()["id"]
+        reclamada = importacio.reclama_importacio()
+        with mock.patch.object(importacio.ImportadorUsuarios, "procesa", side_effect=RuntimeError("disc ple")), \
+                self.assertLogs("biblioteca.importacio", "ERROR") as registre:
+            importacio.procesa_importacio(reclamada)
+        self.assertIn("Error en la importación %d" % importacio_id, registre.output[0])
+        self.assertEqual(ImportacioCSV.objects.get(pk=importacio_id).resultat["error"], "disc ple")
+
+
+def buida_caches():
+    # dins d'un TestCase no es confirma res i versio.canvia() no arriba a canviar la versió:
+    # sense buidar-les, les respostes (i els ETag) d'un test es veurien a l'altre
+    for alias in ("default", "cataleg"):
+        caches[alias].clear()
+
+
+class VersioCatalegTests(TransactionTestCase):
+    # la versió canvia quan es confirma la transacció
+    def setUp(self):
+        for i in range(20):
+            Llibre.objects.create(titol=f"Llibre {i:02}", autor="Autor")
+
+    @override_settings(CACHE_UN_SOL_PROCES=False)
+    def test_sense_versio_fiable_no_hi_ha_etag(self):
+        resposta = self.client.get("/api/llibres")
+        self.assertEqual(resposta.status_code, 200)
+        self.assertFalse(resposta.has_header("ETag"))
+        self.assertFalse(resposta.has_header("Content-Encoding"))
+        self.assertEqual([avis.id for avis in versio.comprova_cache(None)], ["biblioteca.W001"])
+
+    @override_settings(CACHE_UN_SOL_PROCES=True)
+    def test_304_fins_que_canvia_el_cataleg(self):
+        self.assertEqual(versio.comprova_cache(None), [])
+        etag = self.client.get("/api/llibres")["ETag"]
+        self.assertEqual(self.client.get("/api/llibres", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Llibre.objects.create(titol="Nou")
+        resposta = self.client.get("/api/llibres", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertNotEqual(resposta["ETag"], etag)
+
+    @override_settings(CACHE_UN_SOL_PROCES=True)
+    def test_variants_comprimides(self):
+        identitat = self.client.get("/api/llibres").content
+        resposta = self.client.get("/api/llibres", HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(resposta["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(resposta.content), identitat)
+        resposta = self.client.get("/api/llibres", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(gzip.decompress(resposta.content), identitat)
+
+
+def cursor(valors):
+    return base64.urlsafe_b64encode(json.dumps(valors).encode()).decode().rstrip("=")
+
+
+class PaginacioLlibresTests(TestCase):
+    def setUp(self):
+        buida_caches()
+        # títols repetits: l'id desempata
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(25):
+                Llibre.objects.create(titol=f"Títol {(i * 7) % 10}")
+
+    def recorre(self, url):
+        ids, pagines = [], 0
+        while url:
+            resposta = self.client.get(url)
+            self.assertEqual(resposta.status_code, 200)
+            pagina = resposta.json()
+            ids += [llibre["id"] for llibre in pagina["items"]]
+            pagines += 1
+            url = pagina["next"] and f"{url.split('&cursor=')[0]}&cursor={pagina['next']}"
+        return ids, pagines
+
+    def test_recorregut_per_id(self):
+        ids, pagines = self.recorre("/api/llibres?limit=10")
+        self.assertEqual(ids, list(Llibre.objects.order_by("id").values_list("id", flat=True)))
+        self.assertEqual(pagines, 3)
+
+    def test_recorregut_per_titol(self):
+        ids, _ = self.recorre("/api/llibres?limit=4&ordre=titol")
+        self.assertEqual(ids, list(Llibre.objects.order_by("titol", "id").values_list("id", flat=True)))
+
+    def test_els_llibres_nous_no_desplacen_les_pagines(self):
+        primera = self.client.get("/api/llibres?limit=10").json()
+        with self.captureOnCommitCallbacks(execute=True):
+            Llibre.objects.create(titol="Nou")
+            Llibre.objects.filter(pk=primera["items"][0]["id"]).delete()
+        ids = [llibre["id"] for llibre in primera["items"]]
+        url = f"/api/llibres?limit=10&cursor={primera['next']}"
+        ids += self.recorre(url)[0]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), 26)
+
+    def test_ndjson(self):
+        for directa in (True, False):
+            with self.subTest(directa=directa), override_settings(API_SORTIDA_DIRECTA=directa):
+                resposta = self.client.get("/api/llibres?format=ndjson")
+                self.assertEqual(resposta["Content-Type"], "application/x-ndjson")
+                self.assertTrue(resposta.streaming)
+                llibres = [json.loads(linia) for linia in b"".join(resposta.streaming_content).splitlines()]
+                self.assertEqual([llibre["id"] for llibre in llibres],
+                                 list(Llibre.objects.order_by("id").values_list("id", flat=True)))
+                self.assertEqual(llibres[0], self.client.get("/api/llibres?limit=1").json()["items"][0])
+
+    def test_cursors_no_valids(self):
+        for url in (
+            "/api/llibres?cursor=!!!",
+            f"/api/llibres?cursor={cursor(['abc'])}",
+            f"/api/llibres?cursor={cursor([])}",
+            f"/api/llibres?cursor={cursor([1, 2])}",
+            f"/api/llibres?cursor={cursor([10 ** 30])}",
+            f"/api/llibres?cursor={cursor({'id': 1})}",
+            f"/api/llibres?cursor={cursor([None])}",
+            f"/api/llibres?ordre=titol&cursor={cursor(['Títol 1'])}",
+            f"/api/llibres?ordre=titol&cursor={cursor(['Títol 1', 'x'])}",
+            f"/api/cerca?q=titol&cursor={cursor([])}",
+            f"/api/cerca?q=titol&cursor={cursor(['abc'])}",
+            f"/api/cerca?q=titol&cursor={cursor([True])}",
+            f"/api/cerca?q=titol&cursor={cursor([-1])}",
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_sense_paginacio_es_una_llista(self):
+        # la forma d'abans de la paginació, la que espera el frontend
+        llibres = self.client.get("/api/llibres").json()
+        self.assertIsInstance(llibres, list)
+        self.assertEqual(len(llibres), 25)
+        self.assertEqual(set(self.client.get("/api/llibres?paginat=true").json()), {"items", "next"})
+        with override_settings(API_SORTIDA_DIRECTA=False):
+            self.assertEqual(self.client.get("/api/llibres?ordre=titol").json(),
+                             self.client.get("/api/llibres?ordre=titol&limit=1000").json()["items"])
+
+
+class CercaTests(TestCase):
+    def setUp(self):
+        # les estadístiques de l'índex (documents, longitud mitjana) també són a la memòria cau
+        buida_caches()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rodoreda = Llibre.objects.create(titol="La plaça del Diamant", autor="Mercè Rodoreda",
+                                                  ISBN="9788475883205")
+            self.sobre = Llibre.objects.create(titol="Vides de dones", autor="Anna Puig",
+                                               resum="Assaig sobre la Rodoreda i la seva plaça a la literatura")
+            self.col_leccio = Llibre.objects.create(titol="Col·lecció de contes", autor="Núria Àlvarez")
+
+    def cerca(self, q, **parametres):
+        resposta = self.client.get("/api/cerca", {"q": q, **parametres})
+        self.assertEqual(resposta.status_code, 200)
+        return resposta.json()
+
+    def ids(self, q):
+        return [resultat["id"] for resultat in self.cerca(q)["items"]]
+
+    def test_normalitzacio(self):
+        self.assertEqual(cerca.tokens("COL.LECCIÓ de la Núria"), ["colleccio", "nuria"])
+        for q in ("col·lecció", "COL.LECCIO", "colleccio", "alvarez", "ÀLVAREZ"):
+            with self.subTest(q=q):
+                self.assertEqual(self.ids(q), [self.col_leccio.pk])
+        self.assertEqual(self.cerca("de la i")["items"], [])
+
+    def test_ordenacio(self):
+        # l'autor pesa més que el resum
+        self.assertEqual(self.ids("rodoreda"), [self.rodoreda.pk, self.sobre.pk])
+        # el que té tots els termes va primer
+        self.assertEqual(self.ids("plaça diamant")[0], self.rodoreda.pk)
+        puntuacions = [resultat["puntuacio"] for resultat in self.cerca("plaça diamant")["items"]]
+        self.assertEqual(puntuacions, sorted(puntuacions, reverse=True))
+
+    def test_codis(self):
+        for q in ("978-84-7588-320-5", "9788475883205"):
+            with self.subTest(q=q):
+                self.assertEqual(self.ids(q), [self.rodoreda.pk])
+
+    def test_index_al_dia(self):
+        self.assertEqual(self.ids("colleccio"), [self.col_leccio.pk])
+        self.col_leccio.titol = "Rondalles"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.col_leccio.save()
+        self.assertEqual(self.ids("colleccio"), [])
+        self.assertEqual(self.ids("rondalles"), [self.col_leccio.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.col_leccio.delete()
+        self.assertEqual(self.ids("rondalles"), [])
+
+    def test_paginacio(self):
+        gats = [Llibre.objects.create(titol=f"Gat {'gat ' * i}").pk for i in range(5)]
+        ids, pagines, cursor = [], 0, None
+        while True:
+            pagina = self.cerca("gat", limit=2, **({"cursor": cursor} if cursor else {}))
+            ids += [resultat["id"] for resultat in pagina["items"]]
+            pagines += 1
+            cursor = pagina["next"]
+            if not cursor:
+                break
+        self.assertEqual(pagines, 3)
+        # com més vegades hi surt el terme, més amunt
+        self.assertEqual(ids, gats[::-1])
+
+
+class ImportacioCatalegTests(TestCase):
+    def setUp(self):
+        buida_caches()
+        self.bibliotecari = Usuari.objects.create_user("bibliotecari", is_staff=True)
+
+    def importa(self, text, usuari=None, **parametres):
+        fitxer = SimpleUploadedFile("cataleg", text if isinstance(text, bytes) else text.encode())
+        consulta = "&".join(f"{clau}={valor}" for clau, valor in parametres.items())
+        return self.client.post(f"/api/cataleg/importa?{consulta}", {"fitxer": fitxer},
+                                **capcalera_token(usuari or self.bibliotecari))
+
+    def test_ndjson(self):
+        files = [
+            {"titol": "La plaça del Diamant", "autor": "Mercè Rodoreda", "ISBN": "978-84-7588-320-5",
+             "pais": "Catalunya", "llengua": "Català", "tags": ["Novel·la", "Clàssics"],
+             "exemplars": ["R1", {"registre": "R2", "exclos_prestec": False}]},
+            "{no és json",
+            {"titol": "Sense camp", "color": "verd"},
+            {"titol": "Pàgines", "pagines": "moltes"},
+            {"ISBN": "9788475883205", "pagines": 256, "tags": ["Novel·la"]},
+            {"titol": "Sense ISBN"},
+        ]
+        text = "\n".join(fila if isinstance(fila, str) else json.dumps(fila) for fila in files) + "\n\n"
+        resposta = self.importa(text)
+        self.assertEqual(resposta.status_code, 200)
+        resultat = resposta.json()
+        self.assertEqual((resultat["files"], resultat["creats"], resultat["actualitzats"], resultat["exemplars"]),
+                         (6, 2, 1, 2))
+        self.assertEqual([error["linia"] for error in resultat["errors"]], [2, 3, 4])
+        self.assertTrue(resultat["errors"][0]["error"].startswith("JSON no vàlid"))
+        self.assertEqual(resultat["errors"][1]["error"], "Camps desconeguts: color")
+        self.assertTrue(resultat["errors"][2]["error"].startswith("pagines:"))
+
+        llibre = Llibre.objects.get(ISBN="9788475883205")
+        self.assertEqual((llibre.titol, llibre.pagines, llibre.pais.nom, llibre.llengua.nom),
+                         ("La plaça del Diamant", 256, "Catalunya", "Català"))
+        # les etiquetes de la darrera fila substitueixen les anteriors
+        self.assertEqual(list(llibre.tags.values_list("nom", flat=True)), ["Novel·la"])
+        self.assertEqual(list(llibre.exemplar_set.order_by("registre").values_list("registre", "exclos_prestec")),
+                         [("R1", True), ("R2", False)])
+        self.assertEqual((llibre.exemplars_total, llibre.exemplars_prestables), (2, 1))
+        # l'índex de cerca ja inclou els registres importats
+        trobats = self.client.get("/api/cerca?q=rodoreda").json()["items"]
+        self.assertEqual([resultat["id"] for resultat in trobats], [llibre.pk])
+
+    def test_torna_a_importar_nomes_canvia_els_camps_de_la_fila(self):
+        self.importa(json.dumps({"titol": "Mirall trencat", "ISBN": "9788475883205", "editorial": "Club",
+                                 "exemplars": ["R1"]}))
+        resultat = self.importa(json.dumps({"ISBN": "978-84-7588-320-5", "editorial": "Edicions 62",
+                                            "exemplars": ["R1", "R2"]})).json()
+        self.assertEqual((resultat["creats"], resultat["actualitzats"], resultat["exemplars"]), (0, 1, 1))
+        llibre = Llibre.objects.get()
+        self.assertEqual((llibre.titol, llibre.editorial, llibre.exemplars_total), ("Mirall trencat", "Edicions 62", 2))
+
+    def test_exemplars(self):
+        files = [
+            {"titol": "Mirall trencat", "exemplars": ["R1"]},
+            {"titol": "Sense llista", "exemplars": 5},
+            {"titol": "Text", "exemplars": "AB"},
+            {"titol": "Solitud", "exemplars": ["R1", "R2"]},
+        ]
+        resultat = self.importa("\n".join(json.dumps(fila) for fila in files)).json()
+        self.assertEqual((resultat["creats"], resultat["exemplars"]), (2, 2))
+        self.assertEqual([error["linia"] for error in resultat["errors"]], [2, 3, 4])
+        self.assertEqual(resultat["errors"][0]["error"], resultat["errors"][1]["error"])
+        self.assertTrue(resultat["errors"][0]["error"].startswith("exemplars:"))
+        mirall = Llibre.objects.get(titol="Mirall trencat")
+        self.assertIn(f"el registre R1 ja és d'un altre element del catàleg (id {mirall.pk})",
+                      resultat["errors"][2]["error"])
+        self.assertEqual(sorted(Exemplar.objects.values_list("registre", "cataleg__titol")),
+                         [("R1", "Mirall trencat"), ("R2", "Solitud")])
+        # i en un lot posterior, contra el que ja és desat
+        resultat = self.importa(json.dumps({"titol": "Altre", "exemplars": ["R2"]})).json()
+        self.assertEqual([error["linia"] for error in resultat["errors"]], [1])
+        self.assertEqual(Exemplar.objects.get(registre="R2").cataleg.titol, "Solitud")
+
+    def test_csv(self):
+        text = ("titol,productora,duracio,tags,exemplars\n"
+                "Pa negre,Massa d'Or,01:48:00,Drama|Postguerra,D1|D2\n"
+                "Sense durada,Massa d'Or,,,\n"
+                ",,,,\n")
+        resultat = self.importa(text, tipus="dvd", format="csv").json()
+        self.assertEqual((resultat["files"], resultat["creats"], resultat["exemplars"]), (2, 1, 2))
+        self.assertEqual([error["linia"] for error in resultat["errors"]], [3])
+        dvd = DVD.objects.get()
+        self.assertEqual(str(dvd.duracio), "01:48:00")
+        self.assertEqual(sorted(dvd.tags.values_list("nom", flat=True)), ["Drama", "Postguerra"])
+
+    def test_permisos_i_codificacio(self):
+        lector = Usuari.objects.create_user("lector")
+        self.assertEqual(self.importa('{"titol": "x"}', usuari=lector).status_code, 403)
+        self.assertEqual(self.importa('{"titol": "Caf\xe9"}'.encode("latin-1")).status_code, 400)
+        self.assertFalse(Llibre.objects.exists())
+
+
+class CreaSubtipusTests(TestCase):
+    def comprova(self, llibres):
+        for llibre in llibres:
+            self.assertEqual(Llibre.objects.get(pk=llibre.pk).titol, llibre.titol)
+
+    def test_per_lots(self):
+        self.comprova(massiu.crea_subtipus(Llibre, [Llibre(titol=f"Lot {i}") for i in range(5)]))
+
+    @mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert",
+                       new_callable=mock.PropertyMock, return_value=False)
+    def test_sense_ids_del_insert_multiple(self, _):
+        # com a MySQL: sense exclusiu, una fila per INSERT i l'id que dona la BD
+        existent = Llibre.objects.create(titol="Ja hi era")
+        llibres = massiu.crea_subtipus(Llibre, [Llibre(titol=f"Un a un {i}") for i in range(3)])
+        self.comprova(llibres)
+        self.assertTrue(all(llibre.pk > existent.pk for llibre in llibres))
+
+        llibres = massiu.crea_subtipus(Llibre, [Llibre(titol=f"Reservat {i}") for i in range(3)], exclusiu=True)
+        self.comprova(llibres)
+        self.assertEqual([llibre.pk for llibre in llibres], list(range(llibres[0].pk, llibres[0].pk + 3)))
+
+
+class MetriquesTests(TestCase):
+    def setUp(self):
+        self.directori = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directori, ignore_errors=True)
+        self.enterContext(override_settings(METRIQUES_DIR=self.directori))
+
+    def test_desa_des_de_diversos_fils(self):
+        registre = metriques.Registre(interval=0)
+        registre.incrementa("peticions_total")
+        fils = [threading.Thread(target=registre.desa, kwargs={"forca": True}) for _ in range(8)]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+        self.assertEqual(os.listdir(self.directori), [f"{registre.pid}-{registre.inici}.json"])
+
+    def test_els_processos_morts_es_consoliden(self):
+        mort = metriques.Registre()
+        mort.incrementa("peticions_total", 3)
+        mort.suma_indicador("peticions_en_curs", 1)
+        mort.desa(forca=True)
+        # el mateix pid, reutilitzat per un procés que ha començat després
+        viu = metriques.Registre()
+        viu.incrementa("peticions_total", 2)
+        viu.desa(forca=True)
+
+        comptadors, indicadors, _ = viu.agrega()
+        self.assertEqual(comptadors[("peticions_total", ())], 5)
+        self.assertEqual(indicadors, {})
+        self.assertEqual(sorted(os.listdir(self.directori)),
+                         sorted([".lock", metriques.FITXER_MORTS, f"{viu.pid}-{viu.inici}.json"]))
+        # tornar a agregar no suma dues vegades el que ja s'ha consolidat
+        self.assertEqual(viu.agrega()[0][("peticions_total", ())], 5)
+
+
+def registre_iso2709(camps, tipus="am"):
+    """Registre ISO 2709 (UTF-8) amb camps (etiqueta, text) de control o (etiqueta, [(codi, valor)])."""
+    directori, dades = b"", b""
+    for etiqueta, valor in camps:
+        if isinstance(valor, str):
+            camp = valor.encode() + marc.FI_CAMP
+        else:
+            camp = b"  " + b"".join(marc.SUBCAMP.encode() + codi.encode() + text.encode()
+                                    for codi, text in valor) + marc.FI_CAMP
+        directori += f"{etiqueta}{len(camp):04d}{len(dades):05d}".encode()
+        dades += camp
+    directori += marc.FI_CAMP
+    base = 24 + len(directori)
+    capcalera = f"{base + len(dades) + 1:05d}n{tipus} a22{base:05d}   4500"
+    return capcalera.encode() + directori + dades + marc.FI_REGISTRE
+
+
+LLIBRE_MARC = [
+    ("001", "1"),
+    ("020", [("a", "9780140449136 (rústica)")]),
+    ("100", [("a", "Dostoievski, Fiódor,")]),
+    ("245", [("a", "Crim i càstig /")]),
+    ("264", [("a", "Barcelona :"), ("b", "Proa,"), ("c", "2003")]),
+    ("300", [("a", "671 p. ;")]),
+    ("952", [("p", "R0001"), ("7", "0")]),
+]
+DVD_MARC = [
+    ("245", [("a", "Metropolis")]),
+    ("300", [("a", "1 disc (153 min)")]),
+    ("952", [("p", "R0002"), ("7", "1")]),
+]
+
+
+class ImportacioMARCTests(TestCase):
+    llibre = registre_iso2709(LLIBRE_MARC)
+    dvd = registre_iso2709(DVD_MARC, tipus="gm")
+
+    def importa(self, dades, **opcions):
+        importador = marc.ImportadorMARC()
+        importador.procesa(marc.lector(BytesIO(dades), **opcions))
+        importador.finalitza()
+        return importador
+
+    def test_iso2709(self):
+        importador = self.importa(self.llibre + b"\r\n" + self.dvd)
+        self.assertEqual((importador.registres, importador.creats, importador.exemplars), (2, 2, 2))
+        self.assertEqual(importador.errors, [])
+        self.assertEqual(importador.posicio, len(self.llibre) + 2 + len(self.dvd))
+        llibre = Llibre.objects.get(ISBN="9780140449136")
+        self.assertEqual((llibre.titol, llibre.autor, llibre.editorial, llibre.lloc, llibre.pagines),
+                         ("Crim i càstig", "Dostoievski, Fiódor", "Proa", "Barcelona", 671))
+        self.assertEqual(llibre.data_edicio, date(2003, 1, 1))
+        dvd = DVD.objects.get(titol="Metropolis")
+        self.assertEqual(str(dvd.duracio), "02:33:00")
+        self.assertEqual(list(Exemplar.objects.order_by("registre").values_list("registre", "exclos_prestec")),
+                         [("R0001", False), ("R0002", True)])
+
+    def test_torna_a_importar_actualitza(self):
+        self.importa(self.llibre)
+        importador = self.importa(self.llibre)
+        self.assertEqual((importador.creats, importador.actualitzats, importador.exemplars), (0, 1, 0))
+        self.assertEqual(Llibre.objects.count(), 1)
+
+    def test_marcxml(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <leader>00000nam a2200000   4500</leader>
+    <controlfield tag="001">1</controlfield>
+    <datafield tag="020" ind1=" " ind2=" "><subfield code="a">9780140449136</subfield></datafield>
+    <datafield tag="245" ind1="1" ind2="0"><subfield code="a">Crim i càstig /</subfield></datafield>
+    <datafield tag="952" ind1=" " ind2=" "><subfield code="p">R0001</subfield></datafield>
+  </record>
+  <record>
+    <leader>00000ngm a2200000   4500</leader>
+    <datafield tag="245" ind1="0" ind2="0"><subfield code="a">Metropolis</subfield></datafield>
+  </record>
+</collection>""".encode()
+        importador = self.importa(xml)
+        self.assertEqual((importador.creats, importador.posicio), (2, 2))
+        self.assertEqual(Llibre.objects.get(ISBN="9780140449136").titol, "Crim i càstig")
+        # es reprèn pel número de registre
+        self.assertEqual(self.importa(xml, des_de=1).registres, 1)
+
+    def test_repren_des_de_la_posicio(self):
+        importador = self.importa(self.llibre + b"\n" + self.dvd, des_de=len(self.llibre))
+        self.assertEqual(importador.registres, 1)
+        self.assertFalse(Llibre.objects.exists())
+        self.assertTrue(DVD.objects.filter(titol="Metropolis").exists())
+
+    def test_registre_no_valid(self):
+        # el directori no quadra: s'informa i es continua amb el següent
+        malmes = self.llibre[:12] + b"00030" + self.llibre[17:]
+        importador = self.importa(malmes + self.dvd)
+        self.assertEqual(importador.creats, 1)
+        self.assertEqual(importador.errors, [{"linia": 0, "error": "Directori no vàlid", "fila": {}}])
+
+    def test_longituds_no_valides(self):
+        for capcalera in (b"00000", b"00023", b"abcde", b"-0100", b"0100\x1d"):
+            with self.subTest(capcalera=capcalera):
+                fitxer = BytesIO(capcalera + b"x" * 200)
+                with self.assertRaises(marc.ErrorMARC):
+                    list(marc.LectorISO2709(fitxer))
+                # no s'ha llegit res més enllà de la longitud
+                self.assertEqual(fitxer.tell(), 5)
+
+        for final, error in ((b"00023" + b"x" * 18, "Longitud de registre no vàlida"),
+                             (b"abcde", "No hi ha cap registre"),
+                             (self.dvd[:-10], "Registre incomplet")):
+            with self.subTest(final=final[:5]):
+                # els registres anteriors s'importen i l'error porta la posició on s'ha aturat
+                importador = self.importa(self.llibre + final)
+                self.assertEqual(importador.creats + importador.actualitzats, 1)
+                self.assertEqual(importador.posicio, len(self.llibre))
+                [avis] = importador.errors
+                self.assertEqual(avis["linia"], len(self.llibre))
+                self.assertIn(error, avis["error"])
+
+
+class Circulacio:
+    """Un llibre amb dos exemplars prestables, un d'exclòs i un de baixa, i tres lectors."""
+
+    def setUp(self):
+        self.bibliotecari = Usuari.objects.create_user("bibliotecari", is_staff=True)
+        self.lectors = [Usuari.objects.create_user(f"lector{i}") for i in range(3)]
+        self.llibre = Llibre.objects.create(titol="Mirall trencat")
+        for registre, exclos, baixa in (("E1", False, False), ("E2", False, False),
+                                        ("E3", True, False), ("E4", False, True)):
+            Exemplar.objects.create(cataleg=self.llibre, registre=registre, exclos_prestec=exclos, baixa=baixa)
+
+    def post(self, url, dades, usuari=None):
+        return self.client.post(url, dades, content_type="application/json",
+                                **capcalera_token(usuari or self.bibliotecari))
+
+    def presta(self, registre, usuari):
+        return self.post("/api/prestecs/checkout", {"registre": registre, "usuari": usuari.pk})
+
+    def retorna(self, registre):
+        return self.post("/api/prestecs/checkin", {"registre": registre})
+
+    def comptadors(self):
+        self.llibre.refresh_from_db()
+        return {camp: getattr(self.llibre, camp) for camp in Llibre.CAMPS_COMPTADORS}
+
+
+class PrestecsTests(Circulacio, TestCase):
+    def setUp(self):
+        # a TestCase no es confirma res: la versió del catàleg ha de veure el fons inicial
+        with self.captureOnCommitCallbacks(execute=True):
+            super().setUp()
+
+    def test_prestec_i_retorn(self):
+        lector = self.lectors[0]
+        resposta = self.post("/api/prestecs/checkout", {"registre": "E1", "username": lector.username,
+                                                        "anotacions": "Tapa rascada"})
+        self.assertEqual(resposta.status_code, 201)
+        prestec = resposta.json()
+        self.assertEqual((prestec["registre"], prestec["usuari"]), ("E1", lector.pk))
+        self.assertEqual(prestec["data_venciment"], str(localdate() + timedelta(days=30)))
+        self.assertEqual(self.comptadors()["exemplars_prestats"], 1)
+        self.assertEqual(self.presta("E1", self.lectors[1]).json()["detail"], "L'exemplar ja està en préstec")
+
+        resposta = self.retorna("E1")
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual((resposta.json()["id"], resposta.json()["data_retorn"]), (prestec["id"], str(localdate())))
+        self.assertIsNone(resposta.json()["reserva_assignada"])
+        self.assertEqual(self.comptadors()["exemplars_prestats"], 0)
+        self.assertEqual(self.retorna("E1").status_code, 409)
+        # retornat, es pot tornar a prestar
+        self.assertEqual(self.presta("E1", self.lectors[1]).status_code, 201)
+
+    @override_settings(CACHE_UN_SOL_PROCES=True, DISPONIBILITAT_INTERVAL=60)
+    def test_la_circulacio_no_invalida_el_cataleg(self):
+        buida_caches()
+        etag = self.client.get("/api/llibres")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.presta("E1", self.lectors[0]).status_code, 201)
+        self.assertEqual(self.client.get("/api/llibres", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # passat l'interval, la disponibilitat nova
+        with mock.patch("biblioteca.versio.time.time", return_value=time.time() + 60):
+            resposta = self.client.get("/api/llibres", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.json()[0]["exemplars_prestats"], 1)
+        # un exemplar nou canvia la versió de seguida
+        with self.captureOnCommitCallbacks(execute=True):
+            Exemplar.objects.create(cataleg=self.llibre, registre="E5")
+        self.assertEqual(self.client.get("/api/llibres", HTTP_IF_NONE_MATCH=resposta["ETag"]).status_code, 200)
+
+    def test_errors(self):
+        lector = self.lectors[0]
+        inactiu = Usuari.objects.create_user("inactiu", is_active=False)
+        for dades, estat, missatge in (
+            ({"registre": "E3", "usuari": lector.pk}, 409, "L'exemplar està exclòs de préstec"),
+            ({"registre": "E4", "usuari": lector.pk}, 409, "L'exemplar està donat de baixa"),
+            ({"registre": "E9", "usuari": lector.pk}, 404, "Exemplar inexistent"),
+            ({"usuari": lector.pk}, 400, "Cal indicar el registre o l'id de l'exemplar"),
+            ({"registre": "E1"}, 400, "Cal indicar l'usuari"),
+            ({"registre": "E1", "username": "ningu"}, 404, "Usuari inexistent"),
+            ({"registre": "E1", "usuari": inactiu.pk}, 409, "L'usuari està donat de baixa"),
+        ):
+            with self.subTest(dades=dades):
+                resposta = self.post("/api/prestecs/checkout", dades)
+                self.assertEqual((resposta.status_code, resposta.json()["detail"]), (estat, missatge))
+        self.assertEqual(self.post("/api/prestecs/checkout", {"registre": "E1", "usuari": lector.pk},
+                                   usuari=lector).status_code, 403)
+        self.assertEqual(self.post("/api/prestecs/checkin", {"registre": "E1"}, usuari=lector).status_code, 403)
+        self.assertFalse(Prestec.objects.exists())
+
+    def test_vencuts(self):
+        prestec = Prestec.objects.create(exemplar=Exemplar.objects.get(registre="E1"), usuari=self.lectors[0],
+                                         data_venciment=localdate() - timedelta(days=3))
+        Prestec.objects.create(exemplar=Exemplar.objects.get(registre="E2"), usuari=self.lectors[1])
+        self.assertEqual(prestecs.marca_vencuts(), (1, 0))
+        resposta = self.client.get("/api/prestecs/vencuts", **capcalera_token(self.bibliotecari)).json()
+        self.assertEqual([(p["id"], p["dies_retard"]) for p in resposta["items"]], [(prestec.pk, 3)])
+        # renovat: deixa de ser vençut
+        Prestec.objects.filter(pk=prestec.pk).update(data_venciment=localdate() + timedelta(days=7))
+        self.assertEqual(prestecs.marca_vencuts(), (0, 1))
+
+
+class PrestecsConcurrentsTests(Circulacio, TransactionTestCase):
+    def test_un_sol_prestec_per_exemplar(self):
+        exemplar = Exemplar.objects.get(registre="E1")
+        resultats = []
+        barrera = threading.Barrier(len(self.lectors))
+
+        def presta(lector):
+            barrera.wait()
+            try:
+                resultats.append(prestecs.checkout(exemplar_id=exemplar.pk, usuari_id=lector.pk).usuari_id)
+            except prestecs.ErrorPrestec as e:
+                resultats.append(e.estat)
+            finally:
+                connection.close()
+
+        fils = [threading.Thread(target=presta, args=(lector,)) for lector in self.lectors]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+        self.assertEqual(Prestec.objects.filter(exemplar=exemplar, data_retorn__isnull=True).count(), 1)
+        self.assertEqual(sorted(resultats), sorted([409, 409, Prestec.objects.get().usuari_id]))
+        self.assertEqual(self.comptadors()["exemplars_prestats"], 1)
+
+
+class ReservesTests(Circulacio, TestCase):
+    def reserva(self, lector):
+        return self.post("/api/reserves", {"cataleg": self.llibre.pk}, usuari=lector)
+
+    def cua(self):
+        """{lector: (estat, lloc a la cua, registre apartat)} de les reserves actives."""
+        resultat = {}
+        for lector in self.lectors:
+            for reserva in self.client.get("/api/reserves", **capcalera_token(lector)).json():
+                resultat[lector.username] = (reserva["estat"], reserva["posicio"], reserva["registre"])
+        return resultat
+
+    def test_exemplar_lliure_es_reserva_directament(self):
+        resposta = self.reserva(self.lectors[0])
+        self.assertEqual(resposta.status_code, 201)
+        reserva = resposta.json()
+        self.assertEqual((reserva["estat"], reserva["registre"], reserva["posicio"]), ("assignada", "E1", None))
+        self.assertEqual(reserva["data_limit"], str(localdate() + timedelta(days=3)))
+        self.assertEqual(self.reserva(self.lectors[0]).json()["detail"],
+                         "Ja tens una reserva activa d'aquest registre")
+        # E1 és apartat: el següent s'emporta E2
+        self.assertEqual(self.reserva(self.lectors[1]).json()["registre"], "E2")
+        self.assertEqual(self.presta("E1", self.lectors[1]).json()["detail"],
+                         "L'exemplar està apartat per a una altra reserva")
+        self.assertEqual(self.presta("E1", self.lectors[0]).status_code, 201)
+        self.assertEqual(Reserva.objects.get(usuari=self.lectors[0]).estat, "servida")
+
+    def test_cua_fifo(self):
+        self.presta("E1", self.bibliotecari)
+        self.presta("E2", self.bibliotecari)
+        for lector in self.lectors:
+            self.assertEqual(self.reserva(lector).json()["estat"], "espera")
+        self.assertEqual(self.cua(), {"lector0": ("espera", 1, None), "lector1": ("espera", 2, None),
+                                      "lector2": ("espera", 3, None)})
+        self.assertEqual(self.comptadors()["exemplars_reservats"], 3)
+
+        # el retorn aparta l'exemplar per al primer de la cua i els altres avancen
+        retorn = self.retorna("E2").json()
+        self.assertEqual(retorn["reserva_assignada"], Reserva.objects.get(usuari=self.lectors[0]).pk)
+        self.assertEqual(self.cua(), {"lector0": ("assignada", None, "E2"), "lector1": ("espera", 1, None),
+                                      "lector2": ("espera", 2, None)})
+
+        # cancel·lar treu de la cua; només el propietari o un bibliotecari
+        reserva = Reserva.objects.get(usuari=self.lectors[1])
+        url = f"/api/reserves/{reserva.pk}"
+        self.assertEqual(self.client.delete(url, **capcalera_token(self.lectors[2])).status_code, 403)
+        self.assertEqual(self.client.delete(url, **capcalera_token(self.lectors[1])).json()["estat"], "cancelada")
+        self.assertEqual(self.client.delete(url, **capcalera_token(self.lectors[1])).status_code, 409)
+        self.assertEqual(self.cua(), {"lector0": ("assignada", None, "E2"), "lector2": ("espera", 1, None)})
+
+        # l'apartat que es cancel·la passa al següent
+        reserva = Reserva.objects.get(usuari=self.lectors[0])
+        self.client.delete(f"/api/reserves/{reserva.pk}", **capcalera_token(self.bibliotecari))
+        self.assertEqual(self.cua(), {"lector2": ("assignada", None, "E2")})
+        self.assertEqual(self.comptadors()["exemplars_reservats"], 1)
+
+    def test_caducitat(self):
+        self.presta("E1", self.bibliotecari)
+        self.presta("E2", self.bibliotecari)
+        for lector in self.lectors[:2]:
+            self.reserva(lector)
+        self.retorna("E1")
+        # dins del termini no caduca; després, l'exemplar passa al següent
+        self.assertEqual(prestecs.allibera_caducades(localdate() + timedelta(days=3)), 0)
+        call_command("allibera_reserves", stdout=StringIO())
+        dia = localdate() + timedelta(days=4)
+        with mock.patch("biblioteca.prestecs.localdate", return_value=dia):
+            self.assertEqual(prestecs.allibera_caducades(), 1)
+        self.assertEqual(Reserva.objects.get(usuari=self.lectors[0]).estat, "caducada")
+        self.assertEqual(self.cua(), {"lector1": ("assignada", None, "E1")})
+        self.assertEqual(Reserva.objects.get(usuari=self.lectors[1]).data_limit, dia + timedelta(days=3))
+        # l'últim de la cua tampoc no el recull: l'exemplar queda lliure
+        self.assertEqual(prestecs.allibera_caducades(dia + timedelta(days=4)), 1)
+        self.assertEqual(self.cua(), {})
+        self.assertEqual(self.presta("E1", self.lectors[2]).status_code, 201)
+
+    def test_un_exemplar_nou_es_per_al_primer_de_la_cua(self):
+        self.presta("E1", self.bibliotecari)
+        self.presta("E2", self.bibliotecari)
+        for lector in self.lectors:
+            self.reserva(lector)
+        # el bibliotecari vol prestar a lector1 un exemplar nou: és per a lector0, que espera primer
+        with self.captureOnCommitCallbacks(execute=True):
+            Exemplar.objects.create(cataleg=self.llibre, registre="E5", exclos_prestec=False)
+        self.assertEqual(self.cua(), {"lector0": ("assignada", None, "E5"), "lector1": ("espera", 1, None),
+                                      "lector2": ("espera", 2, None)})
+        self.assertEqual(self.presta("E5", self.lectors[1]).json()["detail"],
+                         "L'exemplar està apartat per a una altra reserva")
+        self.assertEqual(self.presta("E5", self.lectors[0]).status_code, 201)
+        # els torns continuen sent consecutius: el retorn aparta per a lector1 i després per a lector2
+        self.retorna("E1")
+        self.retorna("E2")
+        self.assertEqual(self.cua(), {"lector1": ("assignada", None, "E1"), "lector2": ("assignada", None, "E2")})
+
+    def test_prestec_d_un_exemplar_lliure_amb_cua(self):
+        self.presta("E1", self.bibliotecari)
+        self.presta("E2", self.bibliotecari)
+        for lector in self.lectors:
+            self.reserva(lector)
+        # bulk_create no envia senyals: l'exemplar queda lliure amb gent a la cua
+        Exemplar.objects.bulk_create([Exemplar(cataleg=self.llibre, registre="E5", exclos_prestec=False),
+                                      Exemplar(cataleg=self.llibre, registre="E6", exclos_prestec=False)])
+        # qui el demana no passa davant: queda apartat per al primer
+        self.assertEqual(self.presta("E5", self.lectors[1]).status_code, 409)
+        self.assertEqual(self.cua(), {"lector0": ("assignada", None, "E5"), "lector1": ("espera", 1, None),
+                                      "lector2": ("espera", 2, None)})
+        # allibera_reserves aparta els que queden
+        call_command("allibera_reserves", stdout=StringIO())
+        self.assertEqual(self.cua(), {"lector0": ("assignada", None, "E5"), "lector1": ("assignada", None, "E6"),
+                                      "lector2": ("espera", 1, None)})
+        # una reserva nova amb un exemplar lliure i cua també el passa al primer
+        Exemplar.objects.bulk_create([Exemplar(cataleg=self.llibre, registre="E7", exclos_prestec=False)])
+        self.assertEqual(self.reserva(self.bibliotecari).json()["posicio"], 1)
+        self.assertEqual(Reserva.objects.get(usuari=self.lectors[2]).exemplar.registre, "E7")
+
+    def test_admin(self):
+        admin = Usuari.objects.create_superuser("admin", "admin@example.com", "contrasenya")
+        self.client.force_login(admin)
+        url = reverse("admin:biblioteca_reserva_add")
+        self.client.post(url, {"cataleg": self.llibre.pk, "usuari": self.lectors[0].pk})
+        self.assertEqual(Reserva.objects.get(usuari=self.lectors[0]).estat, "assignada")
+        self.assertContains(self.client.post(url, {"cataleg": self.llibre.pk, "usuari": self.lectors[0].pk}),
+                            "ja té una reserva activa")
+        # una altra petició s'avança entre el formulari i el desat: missatge d'error, no un 500
+        error = prestecs.ErrorPrestec(409, "Ja tens una reserva activa d'aquest registre")
+        with mock.patch("biblioteca.prestecs.reserva", side_effect=error):
+            resposta = self.client.post(url, {"cataleg": self.llibre.pk, "usuari": self.lectors[1].pk}, follow=True)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertContains(resposta, "Ja tens una reserva activa")
+        self.assertFalse(Reserva.objects.filter(usuari=self.lectors[1]).exists())
+
+    def test_registre_sense_exemplars_prestables(self):
+        sense = Llibre.objects.create(titol="Només consulta")
+        Exemplar.objects.create(cataleg=sense, registre="C1", exclos_prestec=True)
+        resposta = self.post("/api/reserves", {"cataleg": sense.pk}, usuari=self.lectors[0])
+        self.assertEqual((resposta.status_code, resposta.json()["detail"]),
+                         (409, "El registre no té exemplars prestables"))
+
+
+class MigracionsTests(TestCase):
+    def test_registres_duplicats_amb_nom_lliure(self):
+        migracio = importlib.import_module("biblioteca.migrations.0020_indexos_unics")
+        llibre = Llibre.objects.create(titol="Duplicats")
+        for registre in ("R1-7", "R1-7-2", "X" * 100):
+            Exemplar.objects.create(cataleg=llibre, registre=registre)
+        self.assertEqual(migracio.registre_lliure(Exemplar, "R1", 7), "R1-7-3")
+        self.assertEqual(migracio.registre_lliure(Exemplar, "X" * 100, 7), "X" * 98 + "-7")
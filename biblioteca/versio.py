@@ -0,0 +1,180 @@
+"""
+Versió del catàleg per a les peticions condicionals (ETag / Last-Modified).
+
+La versió és un identificador aleatori i el moment del canvi, guardats a
+la memòria cau de Django. Canvia quan es confirma una transacció que ha
+modificat el catàleg, els exemplars, les categories, els països, les
+llengües o els comptadors d'exemplars (senyals de signals.py,
+comptadors.aplica i comptadors.recompta). Les vistes decorades amb
+`condicional` responen 304 a If-None-Match / If-Modified-Since sense fer
+cap consulta.
+
+Els préstecs i les reserves només canvien la disponibilitat (exemplars
+prestats i reservats). Si canviessin la versió, en hores de circulació
+no es reaprofitaria cap resposta. Marquen que hi ha hagut circulació
+(`circula`) i la part de disponibilitat de la versió es renova, com a
+molt, cada DISPONIBILITAT_INTERVAL segons: és el retard màxim amb què
+les llistes mostren la disponibilitat.
+
+La versió només és fiable si tots els processos la llegeixen del mateix
+lloc. Amb la memòria cau local (locmem, per defecte) cada procés té la
+seva i un worker que no ha vist un canvi continuaria responent 304 i
+servint respostes desades de la versió vella. Per això `condicional` i
+la memòria cau de respostes (respostes.py) només actuen si la memòria
+cau per defecte és compartida (CACHE_URL amb Redis, Memcached, la BD o
+fitxers) o si el servidor té un sol procés (CACHE_UN_SOL_PROCES, activat
+per defecte amb DEBUG). Si no, les vistes responen sempre senceres i
+`manage.py check` en dona un avís.
+"""
+import functools
+import secrets
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from ninja.decorators import decorate_view
+
+
+CLAU = "biblioteca:versio-cataleg"
+CLAU_DISPONIBILITAT = "biblioteca:versio-disponibilitat"
+# moment de la darrera circulació (préstec, retorn o reserva) confirmada
+CLAU_CIRCULACIO = "biblioteca:circulacio"
+# backends amb una còpia per procés
+PER_PROCES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def fiable():
+    """La versió és la mateixa per a tots els processos."""
+    if getattr(settings, "CACHE_UN_SOL_PROCES", False):
+        return True
+    return settings.CACHES["default"]["BACKEND"] not in PER_PROCES
+
+
+@checks.register(checks.Tags.caches)
+def comprova_cache(app_configs, **kwargs):
+    if fiable():
+        return []
+    return [checks.Warning(
+        "La memòria cau per defecte és de cada procés: les respostes condicionals (ETag) "
+        "i la memòria cau de respostes del catàleg estan desactivades.",
+        hint="Feu servir una memòria cau compartida (p. ex. CACHE_URL=rediscache://127.0.0.1:6379/1) "
+             "o, si el servidor té un sol procés, CACHE_UN_SOL_PROCES=on.",
+        id="biblioteca.W001",
+    )]
+
+
+def nova():
+    return {"etag": secrets.token_hex(8), "modificat": timezone.now().replace(microsecond=0)}
+
+
+def interval_disponibilitat():
+    return getattr(settings, "DISPONIBILITAT_INTERVAL", 60)
+
+
+def disponibilitat(desades):
+    """Part de la versió que segueix la circulació; es renova com a molt cada DISPONIBILITAT_INTERVAL segons."""
+    versio = desades.get(CLAU_DISPONIBILITAT)
+    circulacio = desades.get(CLAU_CIRCULACIO, 0)
+    ara = time.time()
+    if versio is None or (circulacio > versio["circulacio"] and ara - versio["desat"] >= interval_disponibilitat()):
+        # les dues claus no es desen juntes: dos processos poden renovar-la alhora, i
+        # només costa tornar a generar alguna resposta
+        versio = {**nova(), "desat": ara, "circulacio": circulacio}
+        cache.set(CLAU_DISPONIBILITAT, versio, timeout=None)
+    return versio
+
+
+def actual():
+    desades = cache.get_many([CLAU, CLAU_DISPONIBILITAT, CLAU_CIRCULACIO])
+    versio = desades.get(CLAU)
+    if versio is None:
+        # memòria cau buida (reinici, expulsió): una versió nova, i els clients tornen a descarregar
+        versio = nova()
+        if not cache.add(CLAU, versio, timeout=None):
+            versio = cache.get(CLAU) or versio
+    circulacio = disponibilitat(desades)
+    return {
+        "etag": f"{versio['etag']}-{circulacio['etag']}",
+        "modificat": max(versio["modificat"], circulacio["modificat"]),
+    }
+
+
+def incrementa():
+    cache.set(CLAU, nova(), timeout=None)
+
+
+def marca_circulacio():
+    cache.set(CLAU_CIRCULACIO, time.time(), timeout=None)
+
+
+class Pendent:
+    """Callback d'on_commit que recorda si ja s'ha executat."""
+    executat = False
+
+    def __init__(self, funcio):
+        self.funcio = funcio
+
+    def __call__(self):
+        self.executat = True
+        self.funcio()
+
+
+def en_confirmar(funcio):
+    """Executa `funcio` quan es confirmi la transacció en curs (o ara mateix, si no n'hi ha)."""
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(isinstance(f, Pendent) and f.funcio is funcio and not f.executat
+                                          for _, f, *_ in connection.run_on_commit):
+        # una vegada per transacció n'hi ha prou (captureOnCommitCallbacks executa
+        # els callbacks sense treure'ls de la llista: els executats no compten)
+        return
+    transaction.on_commit(Pendent(funcio))
+
+
+def canvia():
+    """Canvia la versió quan es confirmi la transacció en curs."""
+    en_confirmar(incrementa)
+
+
+def circula():
+    """Hi ha hagut préstecs, retorns o reserves: la disponibilitat es renovarà a l'interval següent."""
+    en_confirmar(marca_circulacio)
+
+
+def versio_peticio(request):
+    # etag i last_modified de la mateixa petició llegeixen la memòria cau una sola vegada
+    if not hasattr(request, "_versio_cataleg"):
+        request._versio_cataleg = actual()
+    return request._versio_cataleg
+
+
+def etag(request, *args, **kwargs):
+    return versio_peticio(request)["etag"]
+
+
+def modificat(request, *args, **kwargs):
+    return versio_peticio(request)["modificat"]
+
+
+def si_es_fiable(decorador):
+    """Aplica `decorador` només quan la versió és fiable (es comprova a cada petició)."""
+    def decora(vista):
+        decorada = decorador(vista)
+        @functools.wraps(vista)
+        def embolcall(request, *args, **kwargs):
+            return (decorada if fiable() else vista)(request, *args, **kwargs)
+        return embolcall
+    return decora
+
+
+# Per a les operacions de l'API que només depenen del catàleg. no-cache: el
+# navegador pot desar la resposta però l'ha de revalidar cada vegada.
+condicional = decorate_view(si_es_fiable(condition(etag_func=etag, last_modified_func=modificat)),
+                            cache_control(no_cache=True))
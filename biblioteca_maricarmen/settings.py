@@ -53,6 +53,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
+    'biblioteca.instrumentacio.InstrumentacioSQL',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -90,6 +91,29 @@ DATABASES = {
     'default': env.db(),
 }
 
+# Memòria cau (versió del catàleg per als ETag de l'API). Amb diversos processos
+# ha de ser compartida: p. ex. CACHE_URL=rediscache://127.0.0.1:6379/1. Amb locmem
+# els ETag i la memòria cau de respostes es desactiven, tret que el servidor tingui
+# un sol procés (CACHE_UN_SOL_PROCES; per defecte, amb DEBUG: runserver)
+CACHES = {
+    'default': env.cache("CACHE_URL", default="locmemcache://"),
+    # respostes de l'API del catàleg, ja comprimides (locmem, fitxers o compartida)
+    'cataleg': {
+        **env.cache("CACHE_CATALEG_URL", default="locmemcache://cataleg"),
+        'TIMEOUT': env.int("RESPOSTES_TIMEOUT", default=24 * 3600),
+        'OPTIONS': {'MAX_ENTRIES': env.int("RESPOSTES_MAX_ENTRADES", default=1000)},
+    },
+}
+CACHE_UN_SOL_PROCES = env.bool("CACHE_UN_SOL_PROCES", default=DEBUG)
+# Els préstecs i les reserves no canvien la versió del catàleg: la disponibilitat
+# de les llistes (ETag i respostes desades) es renova com a molt cada tants segons
+DISPONIBILITAT_INTERVAL = env.int("DISPONIBILITAT_INTERVAL", default=60)
+# Les respostes més grans no es desen a la memòria cau del catàleg
+RESPOSTES_MIDA_MAXIMA = env.int("RESPOSTES_MIDA_MAXIMA", default=5 * 1024 * 1024)
+# Llistes del catàleg construïdes amb .values() i codificades directament, sense
+# validar cada fila amb pydantic (biblioteca/sortida.py). off per comprovar-les
+API_SORTIDA_DIRECTA = env.bool("API_SORTIDA_DIRECTA", default=True)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -148,10 +172,51 @@ CORS_ALLOWED_ORIGINS = [
     "https://biblioteca5.ieti.site",  # Dominio de tu frontend React
 ]
 
+# Tokens de l'API: "signat" (sense estat, caduquen) o "db" (columna auth_token)
+API_TOKEN_MODE = env("API_TOKEN_MODE", default="signat")
+API_TOKEN_DURADA = env.int("API_TOKEN_DURADA", default=8 * 3600)
+
+
+
+
+
+
+
 
 
+# Dies que un exemplar reservat queda apartat esperant que el vinguin a buscar
+RESERVA_DIES_RECOLLIDA = env.int("RESERVA_DIES_RECOLLIDA", default=3)
 
+# Durada d'un préstec en dies (data de venciment per defecte)
+PRESTEC_DIES = env.int("PRESTEC_DIES", default=30)
 
+# Segons sense notícies del worker (un lot) després dels quals una importació de
+# CSV en curs es dona per abandonada i un altre worker la reprèn
+IMPORTACIONS_TIMEOUT = env.int("IMPORTACIONS_TIMEOUT", default=600)
 
+# Fracció de peticions de les quals es mesuren consultes SQL i temps (capçalera
+# Server-Timing i GET /api/instrumentacio). 0 ho desactiva. Per defecte, totes amb
+# DEBUG i cap sense; en producció convé una mostra petita, p. ex. 0.05
+INSTRUMENTACIO_MOSTREIG = env.float("INSTRUMENTACIO_MOSTREIG", default=1.0 if DEBUG else 0.0)
+# Mostres que es guarden per endpoint, i consultes repetides a partir de les quals s'avisa al log
+INSTRUMENTACIO_FINESTRA = env.int("INSTRUMENTACIO_FINESTRA", default=200)
+INSTRUMENTACIO_LLINDAR_REPETIDES = env.int("INSTRUMENTACIO_LLINDAR_REPETIDES", default=10)
 
+# Mètriques Prometheus (/metrics). Amb diversos processos (workers), un directori
+# compartit on cada procés desa les seves
+METRIQUES_DIR = env("METRIQUES_DIR", default=None)
+METRIQUES_INTERVAL = env.float("METRIQUES_INTERVAL", default=5)
+# Xarxes des d'on es pot llegir /metrics
+METRIQUES_XARXES = env.list("METRIQUES_XARXES", default=["127.0.0.0/8", "::1/128"])
 
+# Enriquiment dels llibres amb OpenLibrary (enriquiment.py): peticions simultànies,
+# ISBN per petició i dies que es guarden les respostes (les negatives, menys)
+OPENLIBRARY_URL = env("OPENLIBRARY_URL", default="https://openlibrary.org")
+ENRIQUIMENT_CACHE_DIR = env("ENRIQUIMENT_CACHE_DIR", default=os.path.join(BASE_DIR, "cache", "openlibrary"))
+ENRIQUIMENT_CONCURRENCIA = env.int("ENRIQUIMENT_CONCURRENCIA", default=4)
+ENRIQUIMENT_MIDA_LOT = env.int("ENRIQUIMENT_MIDA_LOT", default=50)
+ENRIQUIMENT_TIMEOUT = env.float("ENRIQUIMENT_TIMEOUT", default=15)
+ENRIQUIMENT_CADUCITAT_DIES = env.int("ENRIQUIMENT_CADUCITAT_DIES", default=90)
+ENRIQUIMENT_CADUCITAT_NEGATIVA_DIES = env.int("ENRIQUIMENT_CADUCITAT_NEGATIVA_DIES", default=7)
+# Llibres que admet, com a màxim, l'acció de l'admin (es fa dins la petició)
+ENRIQUIMENT_MAXIM_ADMIN = env.int("ENRIQUIMENT_MAXIM_ADMIN", default=100)
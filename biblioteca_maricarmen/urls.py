@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from biblioteca import views
+from biblioteca import views, metriques
 
 from ninja import NinjaAPI
 from biblioteca.api import api
@@ -18,6 +18,8 @@ urlpatterns = [
   
 
     path("api/", api.urls),
+    # Prometheus; només per a la xarxa interna (METRIQUES_XARXES)
+    path("metrics", metriques.vista_metriques),
   
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
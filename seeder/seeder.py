@@ -1,30 +1,488 @@
+"""
+Generador de datos de prueba.
+
+Uso (desde la raíz del proyecto):
+
+    python seeder/seeder.py                       # escala "mini": 1.000 libros, 5.000 ejemplares
+    python seeder/seeder.py --escala grande --procesos 8
+    python seeder/seeder.py --escala mediana --semilla 7 --libros 200000
+
+Las filas se generan con Faker en procesos paralelos, por trozos. Cada
+trozo usa una semilla derivada de --semilla y de su número, de modo que
+con la misma semilla y la misma escala se obtienen los mismos datos sea
+cual sea el número de procesos. El proceso principal inserta los trozos
+en orden con bulk_create por lotes (los subtipos del catálogo con
+biblioteca.massiu.crea_subtipus) y al final recalcula los contadores de
+ejemplares, el índice de búsqueda y los préstamos vencidos.
+
+Requiere Faker (pip install Faker).
+"""
+import argparse
+import contextlib
+import hashlib
+import multiprocessing
 import os
 import random
-from datetime import datetime, timedelta
-from django.core.files import File
-from django.utils.timezone import make_aware
-from django.contrib.auth.hashers import make_password
+import sys
+import time
+import zlib
+from array import array
+from datetime import date, time as hora, timedelta
+
 from faker import Faker
 from faker.providers import lorem, person, address, company, date_time, misc
 
 # Configuración inicial de Django
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'biblioteca-maricarmen.settings')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'biblioteca_maricarmen.settings')
 import django
 django.setup()
 
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import connections, transaction
+
+from biblioteca import cerca, comptadors, prestecs
+from biblioteca.importacio import GRUPO_USUARIOS, PASSWORD_INICIAL
+from biblioteca.massiu import crea_etiquetes, crea_subtipus
 from biblioteca.models import (
-    Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva,
-    Centre, Cicle, Revista, CD, DVD, BR, Dispositiu, Imatge
+    Cataleg, Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva,
+    Centre, Cicle, Revista, CD, DVD, BR, Dispositiu
 )
 
-# Configuramos Faker para que use español de España
-fake = Faker('es_ES')
-fake.add_provider(lorem)
-fake.add_provider(person)
-fake.add_provider(address)
-fake.add_provider(company)
-fake.add_provider(date_time)
-fake.add_provider(misc)
+
+# Tamaños de cada escala. "mini" son las cantidades del seeder original.
+ESCALAS = {
+    "mini":      dict(libros=1_000,     ejemplares=5_000,     otros=110,     usuarios=50,      prestamos=500,        reservas=100),
+    "pequena":   dict(libros=10_000,    ejemplares=50_000,    otros=1_000,   usuarios=1_000,   prestamos=20_000,     reservas=1_000),
+    "mediana":   dict(libros=100_000,   ejemplares=500_000,   otros=10_000,  usuarios=10_000,  prestamos=500_000,    reservas=10_000),
+    "grande":    dict(libros=500_000,   ejemplares=2_500_000, otros=50_000,  usuarios=50_000,  prestamos=3_000_000,  reservas=50_000),
+    "enorme":    dict(libros=1_000_000, ejemplares=5_000_000, otros=100_000, usuarios=100_000, prestamos=10_000_000, reservas=100_000),
+}
+
+TROZO = 2_000           # filas que genera cada tarea de un proceso
+LOTE = 2_000            # filas por INSERT
+PORCENTAJE_ABIERTOS = 0.05
+ESTILOS_MUSICALES = ["Pop", "Rock", "Clásica", "Jazz", "Electrónica", "Hip-Hop", "Flamenco", "Salsa"]
+MARCAS = ["Lenovo", "HP", "Dell", "Apple", "Samsung", "Acer", "Asus"]
+
+# Reparto de "otros materiales" entre subtipos
+REPARTO_OTROS = (("revista", 0.45), ("cd", 0.25), ("dvd", 0.15), ("br", 0.05), ("dispositivo", 0.10))
+
+
+def nuevo_faker():
+    fake = Faker('es_ES')
+    fake.add_provider(lorem)
+    fake.add_provider(person)
+    fake.add_provider(address)
+    fake.add_provider(company)
+    fake.add_provider(date_time)
+    fake.add_provider(misc)
+    return fake
+
+
+def trozos(total, tamano=TROZO):
+    return [(inicio, min(tamano, total - inicio)) for inicio in range(0, total, tamano)]
+
+
+def isbn13(numero):
+    # ISBN único y válido a partir de un número de secuencia
+    base = f"978{numero:09d}"
+    suma = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(base))
+    return base + str((10 - suma % 10) % 10)
+
+
+# --- Procesos de generación ------------------------------------------------
+# No tocan la base de datos: reciben lo que necesitan en `_compartido` y
+# devuelven filas como diccionarios o tuplas.
+
+_fake = None
+_compartido = {}
+
+
+def _inicia_proceso(compartido):
+    global _fake
+    _compartido.clear()
+    _compartido.update(compartido)
+    _fake = nuevo_faker()
+
+
+def _semilla(tipo, trozo):
+    # semilla propia para cada trozo: el resultado no depende del reparto entre procesos
+    semilla = zlib.crc32(f"{_compartido['semilla']}:{tipo}:{trozo}".encode())
+    _fake.seed_instance(semilla)
+    return random.Random(semilla)
+
+
+def _titulo(rng):
+    return _fake.sentence(nb_words=rng.randint(2, 5)).replace('.', '').title()
+
+
+def _comun(rng, anos=50):
+    categorias = _compartido["categorias"]
+    return {
+        "data_edicio": _fake.date_between(start_date=f'-{anos}y', end_date='today'),
+        "tags": rng.sample(categorias, min(len(categorias), rng.randint(1, 4))),
+    }
+
+
+def _fila_libro(rng, numero):
+    titulo = _titulo(rng)
+    fila = _comun(rng)
+    fila.update(
+        titol=titulo,
+        titol_original=titulo if rng.random() < 0.3 else _titulo(rng),
+        autor=rng.choice(_compartido["autores"]),
+        CDU=_fake.numerify("###.##"),
+        signatura=f"LB-{_fake.bothify('??###')}",
+        resum=_fake.paragraph(nb_sentences=5),
+        anotacions=_fake.paragraph(nb_sentences=2) if rng.random() < 0.7 else None,
+        mides=f"{rng.randint(15, 30)}x{rng.randint(20, 40)} cm",
+        ISBN=isbn13(_compartido["isbn_inicial"] + numero),
+        editorial=_fake.company(),
+        colleccio=_fake.word().title() if rng.random() < 0.5 else None,
+        lloc=_fake.city(),
+        pais_id=rng.choice(_compartido["paises"]),
+        llengua_id=rng.choice(_compartido["lenguas"]),
+        numero=rng.randint(1, 10) if rng.random() < 0.3 else None,
+        volums=rng.randint(1, 5) if rng.random() < 0.2 else None,
+        pagines=rng.randint(50, 800) if rng.random() < 0.9 else None,
+        info_url=_fake.url() if rng.random() < 0.5 else None,
+        preview_url=_fake.url() if rng.random() < 0.3 else None,
+        thumbnail_url=_fake.image_url(width=200, height=300) if rng.random() < 0.4 else None,
+    )
+    # el número de ejemplares se reparte de forma exacta entre los libros
+    base, resto = divmod(_compartido["ejemplares"], _compartido["libros"])
+    fila["ejemplares"] = [(rng.random() < 0.1, rng.random() < 0.05) for _ in range(base + (numero < resto))]
+    return fila
+
+
+def _fila_revista(rng, numero):
+    fila = _comun(rng, anos=20)
+    fila.update(
+        titol=f"Revista {_fake.word().capitalize()} {_fake.word().capitalize()}",
+        resum=_fake.paragraph(nb_sentences=3),
+        ISSN=_fake.bothify("####-####"),
+        editorial=_fake.company(),
+        lloc=_fake.city(),
+        pais_id=rng.choice(_compartido["paises"]),
+        llengua_id=rng.choice(_compartido["lenguas"]),
+        numero=rng.randint(1, 100),
+        pagines=rng.randint(20, 200),
+    )
+    # las revistas no se prestan
+    fila["ejemplares"] = [(True, rng.random() < 0.05) for _ in range(rng.randint(1, 3))]
+    return fila
+
+
+def _duracion(rng):
+    return hora(rng.randint(0, 2), rng.randint(0, 59))
+
+
+def _fila_cd(rng, numero):
+    fila = _comun(rng, anos=30)
+    fila.update(
+        titol=f"{_fake.word().capitalize()} {_fake.word().capitalize()}",
+        autor=_fake.name(),
+        discografica=_fake.company(),
+        estil=rng.choice(ESTILOS_MUSICALES),
+        duracio=_duracion(rng),
+    )
+    fila["ejemplares"] = [(rng.random() < 0.2, rng.random() < 0.05) for _ in range(rng.randint(1, 3))]
+    return fila
+
+
+def _fila_pelicula(rng, numero):
+    fila = _comun(rng, anos=30)
+    fila.update(
+        titol=_titulo(rng),
+        autor=_fake.name(),
+        productora=_fake.company(),
+        duracio=_duracion(rng),
+    )
+    fila["ejemplares"] = [(rng.random() < 0.2, rng.random() < 0.05) for _ in range(rng.randint(1, 3))]
+    return fila
+
+
+def _fila_dispositivo(rng, numero):
+    marca = rng.choice(MARCAS)
+    fila = _comun(rng, anos=5)
+    fila.update(
+        titol=f"Portátil {marca} {numero}",
+        marca=marca,
+        model=_fake.bothify("??-####").upper(),
+    )
+    fila["ejemplares"] = [(False, rng.random() < 0.05)]
+    return fila
+
+
+# tipo: (modelo, generador de filas, prefijo del registro)
+TIPOS = {
+    "libro": (Llibre, _fila_libro, "LB"),
+    "revista": (Revista, _fila_revista, "REV"),
+    "cd": (CD, _fila_cd, "CD"),
+    "dvd": (DVD, _fila_pelicula, "DVD"),
+    "br": (BR, _fila_pelicula, "BR"),
+    "dispositivo": (Dispositiu, _fila_dispositivo, "DIS"),
+}
+
+
+def _genera_catalogo(tarea):
+    tipo, trozo, inicio, n = tarea
+    rng = _semilla(tipo, trozo)
+    generador = TIPOS[tipo][1]
+    return [generador(rng, inicio + i) for i in range(n)]
+
+
+def _genera_usuarios(tarea):
+    trozo, inicio, n = tarea
+    rng = _semilla("usuario", trozo)
+    filas = []
+    for i in range(n):
+        numero = inicio + i
+        filas.append(dict(
+            # el número al final garantiza que el nombre de usuario es único
+            username=f"{_fake.user_name()}{numero}",
+            email=f"{_fake.user_name()}{numero}@{_fake.free_email_domain()}",
+            first_name=_fake.first_name(),
+            last_name=f"{_fake.last_name()} {_fake.last_name()}",
+            telefon=_fake.numerify("6########"),
+            centre_id=rng.choice(_compartido["centros"]),
+            cicle_id=rng.choice(_compartido["ciclos"]),
+            auth_token=hashlib.md5(f"{_compartido['semilla']}:{numero}".encode()).hexdigest(),
+        ))
+    return filas
+
+
+def _genera_prestamos(tarea):
+    trozo, inicio, n = tarea
+    rng = _semilla("prestamo", trozo)
+    ejemplares = _compartido["ejemplares"]
+    usuarios = _compartido["usuarios"]
+    historicos = _compartido["historicos"]
+    paso = _compartido["paso_abiertos"]
+    hoy = _compartido["hoy"]
+    dias = _compartido["dias_prestamo"]
+    filas = []
+    for i in range(n):
+        numero = inicio + i
+        if numero < historicos:
+            # préstamo ya devuelto, en los últimos cinco años
+            prestamo = hoy - timedelta(days=rng.randint(7, 5 * 365))
+            retorno = min(hoy, prestamo + timedelta(days=rng.randint(1, 45)))
+            ejemplar = rng.choice(ejemplares)
+        else:
+            # préstamo abierto: cada uno en un ejemplar distinto
+            prestamo = hoy - timedelta(days=rng.randint(0, 60))
+            retorno = None
+            ejemplar = ejemplares[(numero - historicos) * paso]
+        filas.append((
+            rng.choice(usuarios), ejemplar, prestamo, prestamo + timedelta(days=dias), retorno,
+            _fake.sentence() if rng.random() < 0.3 else None,
+        ))
+    return filas
+
+
+# --- Proceso principal -----------------------------------------------------
+
+class Seeder:
+    def __init__(self, tamanos, semilla, procesos, lote=LOTE):
+        self.t = tamanos
+        self.semilla = semilla
+        self.procesos = procesos
+        self.lote = lote
+        self.rng = random.Random(semilla)
+        self.fake = nuevo_faker()
+        self.fake.seed_instance(semilla)
+        self.registro = Exemplar.objects.count()
+
+    @contextlib.contextmanager
+    def generador(self, compartido):
+        """Devuelve una función map(funcion, tareas) que reparte las tareas entre los procesos."""
+        compartido = dict(compartido, semilla=self.semilla)
+        if self.procesos <= 1:
+            _inicia_proceso(compartido)
+            yield map
+            return
+        # los procesos no usan la BD, pero no deben heredar la conexión abierta
+        connections.close_all()
+        with multiprocessing.Pool(self.procesos, initializer=_inicia_proceso, initargs=(compartido,)) as pool:
+            # imap conserva el orden de las tareas: los ids salen siempre iguales
+            yield pool.imap
+
+    def crear_categorias(self):
+        print("Creando categorías...")
+        # pocas filas: save() una a una para que calcule el camino del árbol
+        categorias_principales = [
+            "Literatura", "Ciencia", "Historia", "Arte", "Tecnología",
+            "Filosofía", "Economía", "Salud", "Deportes", "Infantil"
+        ]
+        for cat in categorias_principales:
+            categoria = Categoria.objects.create(nom=cat)
+            for _ in range(self.rng.randint(2, 5)):
+                subcat = Categoria.objects.create(nom=f"{cat} - {self.fake.word().capitalize()}", parent=categoria)
+                if self.rng.random() < 0.3:
+                    for __ in range(self.rng.randint(1, 3)):
+                        Categoria.objects.create(nom=f"{subcat.nom} - {self.fake.word().capitalize()}", parent=subcat)
+
+    def crear_paises_y_lenguas(self):
+        print("Creando países y lenguas...")
+        paises_comunes = [
+            "España", "Francia", "Italia", "Reino Unido", "Alemania",
+            "Estados Unidos", "México", "Argentina", "China", "Japón"
+        ]
+        Pais.objects.bulk_create([Pais(nom=pais) for pais in paises_comunes])
+        lenguas_comunes = [
+            "Catalán", "Español", "Inglés", "Francés", "Alemán",
+            "Italiano", "Portugués", "Chino", "Japonés", "Ruso", "Árabe"
+        ]
+        Llengua.objects.bulk_create([Llengua(nom=lengua) for lengua in lenguas_comunes])
+
+    def crear_catalogo(self):
+        print("Creando catálogo...")
+        compartido = {
+            "autores": [self.fake.name() for _ in range(max(100, self.t["libros"] // 10))],
+            "categorias": list(Categoria.objects.values_list("pk", flat=True)),
+            "paises": list(Pais.objects.values_list("pk", flat=True)),
+            "lenguas": list(Llengua.objects.values_list("pk", flat=True)),
+            "libros": max(1, self.t["libros"]),
+            "ejemplares": self.t["ejemplares"],
+            "isbn_inicial": Llibre.objects.count(),
+        }
+        cantidades = [("libro", self.t["libros"])]
+        cantidades += [(tipo, int(self.t["otros"] * parte)) for tipo, parte in REPARTO_OTROS]
+        with self.generador(compartido) as mapa:
+            for tipo, total in cantidades:
+                tareas = [(tipo, i, inicio, n) for i, (inicio, n) in enumerate(trozos(total))]
+                hechos = 0
+                for filas in mapa(_genera_catalogo, tareas):
+                    self.inserta_catalogo(tipo, filas)
+                    hechos += len(filas)
+                    if hechos % 50_000 < TROZO or hechos == total:
+                        print(f"  {TIPOS[tipo][0].__name__}: {hechos}/{total} (ejemplares: {self.registro})")
+
+    def inserta_catalogo(self, tipo, filas):
+        modelo, _, prefijo = TIPOS[tipo]
+        objetos = []
+        for fila in filas:
+            fila = dict(fila)
+            fila.pop("tags"), fila.pop("ejemplares")
+            objetos.append(modelo(**fila))
+        with transaction.atomic():
+            crea_subtipus(modelo, objetos, self.lote, exclusiu=True)  # la base de datos es solo suya
+            crea_etiquetes(((obj.pk, tag) for obj, fila in zip(objetos, filas) for tag in fila["tags"]), self.lote)
+            ejemplares = []
+            for obj, fila in zip(objetos, filas):
+                for exclos, baixa in fila["ejemplares"]:
+                    self.registro += 1
+                    ejemplares.append(Exemplar(cataleg_id=obj.pk, registre=f"{prefijo}-{self.registro:08d}",
+                                               exclos_prestec=exclos, baixa=baixa))
+            Exemplar.objects.bulk_create(ejemplares, batch_size=self.lote)
+
+    def crear_centros_y_ciclos(self):
+        print("Creando centros y ciclos formativos...")
+        Centre.objects.bulk_create([Centre(nom=f"Instituto {self.fake.word().capitalize()}") for _ in range(5)])
+        areas = ["Informática", "Administración", "Comercio", "Sanidad", "Diseño"]
+        Cicle.objects.bulk_create([
+            Cicle(nom=f"{nivel} en {area} {self.fake.word().capitalize()}")
+            for area in areas for nivel in ["GS", "GM"]
+        ])
+
+    def crear_usuarios(self):
+        print("Creando usuarios...")
+        self.crear_centros_y_ciclos()
+        compartido = {
+            "centros": list(Centre.objects.values_list("pk", flat=True)),
+            "ciclos": list(Cicle.objects.values_list("pk", flat=True)),
+        }
+        # la misma contraseña para todos: cifrarla una vez por usuario tardaría horas
+        password = make_password(PASSWORD_INICIAL)
+        grupo, _ = Group.objects.get_or_create(name=GRUPO_USUARIOS)
+        Pertenencia = Usuari.groups.through
+        # numeración a continuación de los existentes para no repetir nombres de usuario
+        existentes = Usuari.objects.count()
+        tareas = [(i, existentes + inicio, n) for i, (inicio, n) in enumerate(trozos(self.t["usuarios"]))]
+        with self.generador(compartido) as mapa:
+            for filas in mapa(_genera_usuarios, tareas):
+                with transaction.atomic():
+                    Usuari.objects.bulk_create([Usuari(password=password, **fila) for fila in filas],
+                                               batch_size=self.lote)
+                    # bulk_create no llama a Usuari.save(): el grupo se añade aquí
+                    ids = Usuari.objects.filter(username__in=[f["username"] for f in filas]).values_list("pk", flat=True)
+                    Pertenencia.objects.bulk_create([Pertenencia(usuari_id=pk, group_id=grupo.pk) for pk in ids],
+                                                    batch_size=self.lote, ignore_conflicts=True)
+        print(f"  {self.t['usuarios']} usuarios (contraseña: {PASSWORD_INICIAL})")
+
+    def crear_prestamos(self):
+        print("Creando préstamos...")
+        # sin los que ya tienen un préstamo abierto de una ejecución anterior
+        ejemplares = array("q", Exemplar.objects.filter(baixa=False, exclos_prestec=False)
+                           .exclude(pk__in=Prestec.objects.filter(data_retorn__isnull=True).values("exemplar_id"))
+                           .order_by("pk").values_list("pk", flat=True).iterator(chunk_size=10_000))
+        usuarios = array("q", Usuari.objects.order_by("pk").values_list("pk", flat=True).iterator(chunk_size=10_000))
+        if not ejemplares or not usuarios:
+            return
+        total = self.t["prestamos"]
+        abiertos = min(int(total * PORCENTAJE_ABIERTOS), len(ejemplares))
+        compartido = {
+            "ejemplares": ejemplares,
+            "usuarios": usuarios,
+            "historicos": total - abiertos,
+            "paso_abiertos": max(1, len(ejemplares) // max(1, abiertos)),
+            "hoy": date.today(),
+            "dias_prestamo": getattr(settings, "PRESTEC_DIES", 30),
+        }
+        tareas = [(i, inicio, n) for i, (inicio, n) in enumerate(trozos(total))]
+        hechos = 0
+        with self.generador(compartido) as mapa:
+            for filas in mapa(_genera_prestamos, tareas):
+                Prestec.objects.bulk_create([
+                    Prestec(usuari_id=u, exemplar_id=e, data_prestec=p, data_venciment=v,
+                            data_retorn=r, anotacions=a)
+                    for u, e, p, v, r, a in filas
+                ], batch_size=self.lote)
+                hechos += len(filas)
+                if hechos % 200_000 < TROZO or hechos == total:
+                    print(f"  {hechos}/{total} préstamos ({abiertos} abiertos)")
+
+    def crear_reservas(self):
+        print("Creando reservas...")
+        libros = Llibre.objects.filter(exemplars_prestables__gt=0).values_list("pk", flat=True)
+        libros = array("q", libros.iterator(chunk_size=10_000))
+        usuarios = array("q", Usuari.objects.values_list("pk", flat=True).iterator(chunk_size=10_000))
+        if not libros or not usuarios:
+            return
+        # pocos títulos muy solicitados para que haya colas largas
+        populares = libros[:max(1, len(libros) // 100)]
+        # las colas continúan donde las dejó una ejecución anterior
+        activas = Reserva.objects.filter(cataleg_id__in=populares, estat__in=Reserva.ESTATS_ACTIUS)
+        vistos = set(activas.values_list("usuari_id", "cataleg_id"))
+        colas = dict(Cataleg.objects.filter(pk__in=populares, cua_final__gt=0).values_list("pk", "cua_final"))
+        reservas = []
+        for _ in range(self.t["reservas"]):
+            cataleg = self.rng.choice(populares)
+            usuari = self.rng.choice(usuarios)
+            if (usuari, cataleg) in vistos:
+                continue
+            vistos.add((usuari, cataleg))
+            colas[cataleg] = colas.get(cataleg, 0) + 1
+            reservas.append(Reserva(usuari_id=usuari, cataleg_id=cataleg, posicio=colas[cataleg], estat="espera"))
+        with transaction.atomic():
+            Reserva.objects.bulk_create(reservas, batch_size=self.lote)
+            Cataleg.objects.bulk_update(
+                [Cataleg(pk=pk, cua_final=n) for pk, n in colas.items()], ["cua_final"], batch_size=self.lote
+            )
+        print(f"  {len(reservas)} reservas en {len(colas)} colas")
+
+    def finalizar(self):
+        print("Recalculando contadores de ejemplares...")
+        comptadors.recompta()
+        print("Marcando préstamos vencidos...")
+        prestecs.marca_vencuts()
+        print("Reconstruyendo el índice de búsqueda...")
+        cerca.reindexa_tot(sortida=print)
+
 
 def limpiar_db():
     """Opcional: Limpiar la base de datos existente (solo para desarrollo)"""
@@ -37,385 +495,55 @@ def limpiar_db():
         cursor.execute('SET CONSTRAINTS ALL DEFERRED;')
     except:
         pass
-    
+
     # Eliminar todos los datos
-    models = [Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, 
+    models = [Categoria, Pais, Llengua, Llibre, Exemplar, Usuari,
               Prestec, Reserva, Centre, Cicle, Revista, CD, DVD, BR, Dispositiu]
-    
+
     for model in models:
         model.objects.all().delete()
     print("Base de datos limpiada")
 
-def crear_categorias():
-    print("Creando categorías...")
-    categorias_principales = [
-        "Literatura", "Ciencia", "Historia", "Arte", "Tecnología",
-        "Filosofía", "Economía", "Salud", "Deportes", "Infantil"
-    ]
-    
-    for cat in categorias_principales:
-        categoria = Categoria.objects.create(nom=cat)
-        
-        # Subcategorías nivel 1
-        for _ in range(random.randint(2, 5)):
-            subcat = Categoria.objects.create(
-                nom=f"{cat} - {fake.word().capitalize()}",
-                parent=categoria
-            )
-            
-            # Subcategorías nivel 2 (30% de probabilidad)
-            if random.random() < 0.3:
-                for __ in range(random.randint(1, 3)):
-                    Categoria.objects.create(
-                        nom=f"{subcat.nom} - {fake.word().capitalize()}",
-                        parent=subcat
-                    )
-
-def crear_paises_y_lenguas():
-    print("Creando países y lenguas...")
-    paises_comunes = [
-        "España", "Francia", "Italia", "Reino Unido", "Alemania",
-        "Estados Unidos", "México", "Argentina", "China", "Japón"
-    ]
-    
-    for pais in paises_comunes:
-        Pais.objects.create(nom=pais)
-    
-    lenguas_comunes = [
-        "Catalán", "Español", "Inglés", "Francés", "Alemán",
-        "Italiano", "Portugués", "Chino", "Japonés", "Ruso", "Árabe"
-    ]
-    
-    for lengua in lenguas_comunes:
-        Llengua.objects.create(nom=lengua)
-
-def crear_autores_y_libros():
-    print("Creando autores y libros...")
-    
-    # Crear exactamente 100 autores con nombres en español
-    autores = [fake.name() for _ in range(100)]
-    
-    paises = list(Pais.objects.all())
-    lenguas = list(Llengua.objects.all())
-    categorias = list(Categoria.objects.all())
-    
-    # Contadores para seguimiento
-    libros_creados = 0
-    ejemplares_creados = 0
-    ejemplares_objetivo = 5000
-    
-    # Conjunto para almacenar ISBNs ya utilizados y garantizar unicidad
-    used_isbns = set()
-    
-    # Función para obtener un ISBN único
-    def get_unique_isbn():
-        while True:
-            isbn = fake.isbn13()
-            if isbn not in used_isbns:
-                used_isbns.add(isbn)
-                return isbn
-    
-    # Primera pasada: asignar entre 1 y 10 libros a cada autor
-    for autor in autores:
-        # Determinar cuántos libros tendrá este autor (entre 1 y 10)
-        num_libros = random.randint(1, 10)
-        
-        # Crear los libros para este autor
-        for _ in range(num_libros):
-            # Si ya alcanzamos 1000 libros, salimos del bucle
-            if libros_creados >= 1000:
-                break
-                
-            titulo = fake.sentence(nb_words=3).replace('.', '').title()
-            
-            libro = Llibre.objects.create(
-                titol=titulo,
-                titol_original=titulo if random.random() < 0.3 else fake.sentence(nb_words=3).replace('.', '').title(),
-                autor=autor,
-                CDU=fake.numerify("###.##"),
-                signatura=f"LB-{fake.bothify('??###')}",
-                data_edicio=fake.date_between(start_date='-50y', end_date='today'),
-                resum=fake.paragraph(nb_sentences=5),
-                anotacions=fake.paragraph(nb_sentences=2) if random.random() < 0.7 else None,
-                mides=f"{random.randint(15, 30)}x{random.randint(20, 40)} cm",
-                ISBN=get_unique_isbn(),  # Siempre generamos un ISBN único
-                editorial=fake.company(),
-                colleccio=fake.word().title() if random.random() < 0.5 else None,
-                lloc=fake.city(),
-                pais=random.choice(paises),
-                llengua=random.choice(lenguas),
-                numero=random.randint(1, 10) if random.random() < 0.3 else None,
-                volums=random.randint(1, 5) if random.random() < 0.2 else None,
-                pagines=random.randint(50, 800) if random.random() < 0.9 else None,
-                info_url=fake.url() if random.random() < 0.5 else None,
-                preview_url=fake.url() if random.random() < 0.3 else None,
-                thumbnail_url=fake.image_url(width=200, height=300) if random.random() < 0.4 else None
-            )
-            
-            # Añadir 1-4 categorías aleatorias
-            cats = random.sample(categorias, random.randint(1, 4))
-            libro.tags.set(cats)
-            
-            libros_creados += 1
-            
-            # Para controlar los ejemplares y llegar exactamente a 5000
-            ejemplares_por_libro = 5
-            # Ajustamos el último libro para llegar exactamente a 5000 ejemplares
-            if ejemplares_creados + ejemplares_por_libro > ejemplares_objetivo:
-                ejemplares_por_libro = ejemplares_objetivo - ejemplares_creados
-            
-            # Crear ejemplares para este libro
-            for _ in range(ejemplares_por_libro):
-                Exemplar.objects.create(
-                    cataleg=libro,
-                    registre=f"REG-{fake.bothify('####-####')}",
-                    exclos_prestec=random.random() < 0.1,
-                    baixa=random.random() < 0.05
-                )
-                ejemplares_creados += 1
-                
-                # Si ya alcanzamos los 5000 ejemplares, detenemos la creación
-                if ejemplares_creados >= ejemplares_objetivo:
-                    break
-            
-            if libros_creados % 100 == 0:
-                print(f"Creados {libros_creados} libros y {ejemplares_creados} ejemplares...")
-                
-            # Si ya alcanzamos los 5000 ejemplares, salimos del bucle
-            if ejemplares_creados >= ejemplares_objetivo:
-                break
-                
-        # Si ya alcanzamos los objetivos, salimos del bucle principal
-        if libros_creados >= 1000 or ejemplares_creados >= ejemplares_objetivo:
-            break
-    
-    # Si no hemos llegado a 1000 libros, añadimos más a autores aleatorios
-    while libros_creados < 1000:
-        autor = random.choice(autores)
-        titulo = fake.sentence(nb_words=3).replace('.', '').title()
-        
-        libro = Llibre.objects.create(
-            titol=titulo,
-            titol_original=titulo if random.random() < 0.3 else fake.sentence(nb_words=3).replace('.', '').title(),
-            autor=autor,
-            CDU=fake.numerify("###.##"),
-            signatura=f"LB-{fake.bothify('??###')}",
-            data_edicio=fake.date_between(start_date='-50y', end_date='today'),
-            resum=fake.paragraph(nb_sentences=5),
-            anotacions=fake.paragraph(nb_sentences=2) if random.random() < 0.7 else None,
-            mides=f"{random.randint(15, 30)}x{random.randint(20, 40)} cm",
-            ISBN=get_unique_isbn(),  # Siempre generamos un ISBN único
-            editorial=fake.company(),
-            colleccio=fake.word().title() if random.random() < 0.5 else None,
-            lloc=fake.city(),
-            pais=random.choice(paises),
-            llengua=random.choice(lenguas),
-            numero=random.randint(1, 10) if random.random() < 0.3 else None,
-            volums=random.randint(1, 5) if random.random() < 0.2 else None,
-            pagines=random.randint(50, 800) if random.random() < 0.9 else None,
-            info_url=fake.url() if random.random() < 0.5 else None,
-            preview_url=fake.url() if random.random() < 0.3 else None,
-            thumbnail_url=fake.image_url(width=200, height=300) if random.random() < 0.4 else None
-        )
-        
-        cats = random.sample(categorias, random.randint(1, 4))
-        libro.tags.set(cats)
-        
-        libros_creados += 1
-        
-        if libros_creados % 100 == 0:
-            print(f"Creados {libros_creados} libros...")
-    
-    # Si no hemos llegado a 5000 ejemplares, añadimos más a libros existentes
-    if ejemplares_creados < ejemplares_objetivo:
-        libros = list(Llibre.objects.all())
-        while ejemplares_creados < ejemplares_objetivo:
-            libro = random.choice(libros)
-            Exemplar.objects.create(
-                cataleg=libro,
-                registre=f"REG-{fake.bothify('####-####')}",
-                exclos_prestec=random.random() < 0.1,
-                baixa=random.random() < 0.05
-            )
-            ejemplares_creados += 1
-            
-            if ejemplares_creados % 100 == 0:
-                print(f"Creados {ejemplares_creados} ejemplares...")
-    
-    print(f"Final: {libros_creados} libros y {ejemplares_creados} ejemplares")
-
-def crear_otros_materiales():
-    print("Creando otros materiales...")
-    categorias = list(Categoria.objects.all())
-    paises = list(Pais.objects.all())
-    lenguas = list(Llengua.objects.all())
-    
-    # Revistas (50 unidades)
-    for i in range(50):
-        revista = Revista.objects.create(
-            titol=f"Revista {fake.word().capitalize()} {fake.word().capitalize()}",
-            data_edicio=fake.date_between(start_date='-20y', end_date='today'),
-            resum=fake.paragraph(nb_sentences=3),
-            ISSN=fake.bothify("####-####"),
-            editorial=fake.company(),
-            lloc=fake.city(),
-            pais=random.choice(paises),
-            llengua=random.choice(lenguas),
-            numero=random.randint(1, 100),
-            pagines=random.randint(20, 200)
-        )
-        
-        # 1-3 categorías por revista
-        cats = random.sample(categorias, random.randint(1, 3))
-        revista.tags.set(cats)
-        
-        # 1-3 ejemplares por revista
-        for _ in range(random.randint(1, 3)):
-            Exemplar.objects.create(
-                cataleg=revista,
-                registre=f"REV-{fake.bothify('####-####')}",
-                exclos_prestec=True,
-                baixa=random.random() < 0.05
-            )
-    
-    # CDs (30 unidades)
-    estilos_musicales = ["Pop", "Rock", "Clásica", "Jazz", "Electrónica", "Hip-Hop", "Flamenco", "Salsa"]
-    for i in range(30):
-        cd = CD.objects.create(
-            titol=f"{fake.word().capitalize()} {fake.word().capitalize()}",
-            autor=fake.name(),
-            data_edicio=fake.date_between(start_date='-30y', end_date='today'),
-            discografica=fake.company(),
-            estil=random.choice(estilos_musicales),
-            duracio=make_aware(datetime.now() + timedelta(minutes=random.randint(30, 120)))
-        )
-        
-        # 1-2 categorías por CD
-        cats = random.sample(categorias, random.randint(1, 2))
-        cd.tags.set(cats)
-        
-        # 1-3 ejemplares por CD
-        for _ in range(random.randint(1, 3)):
-            Exemplar.objects.create(
-                cataleg=cd,
-                registre=f"CD-{fake.bothify('####-####')}",
-                exclos_prestec=random.random() < 0.2,
-                baixa=random.random() < 0.05
-            )
-
-def crear_centros_y_ciclos():
-    print("Creando centros y ciclos formativos...")
-    # Centros educativos
-    centros = []
-    for i in range(5):
-        centro = Centre.objects.create(
-            nom=f"Instituto {fake.word().capitalize()}"
-        )
-        centros.append(centro)
-    
-    # Ciclos formativos
-    ciclos = []
-    areas = ["Informática", "Administración", "Comercio", "Sanidad", "Diseño"]
-    for area in areas:
-        for nivel in ["GS", "GM"]:
-            cicle = Cicle.objects.create(
-                nom=f"{nivel} en {area} {fake.word().capitalize()}"
-            )
-            ciclos.append(cicle)
-    
-    return centros, ciclos
-
-def crear_usuarios_y_prestamos():
-    print("Creando usuarios y préstamos...")
-    centros, ciclos = crear_centros_y_ciclos()
-    
-    # Crear 50 usuarios
-    usuarios = []
-    for i in range(50):
-        username = fake.user_name()
-        usuario = Usuari.objects.create_user(
-            username=username,
-            email=fake.email(),
-            password=make_password(username),  # Contraseña igual al username
-            first_name=fake.first_name(),
-            last_name=fake.last_name(),
-            centre=random.choice(centros),
-            cicle=random.choice(ciclos),
-            auth_token=fake.md5()
-        )
-        usuarios.append(usuario)
-    
-    # Crear préstamos (500 unidades)
-    ejemplares = list(Exemplar.objects.filter(baixa=False, exclos_prestec=False))
-    
-    # Fecha actual para referencia
-    current_date = datetime.now().date()
-    
-    # Crear préstamos
-    for i in range(500):
-        ejemplar = random.choice(ejemplares)
-        usuario = random.choice(usuarios)
-        
-        # CORRECCIÓN: Generar fecha de préstamo de forma segura (hasta hace 60 días)
-        max_days_ago = min(365, (current_date - datetime(2023, 1, 1).date()).days)
-        days_ago = random.randint(7, max_days_ago)
-        fecha_prestamo = current_date - timedelta(days=days_ago)
-        
-        # CORRECCIÓN: Asegurar que la fecha de devolución es POSTERIOR a la fecha de préstamo
-        # Rango: desde 1 día después hasta la fecha actual
-        min_return_date = fecha_prestamo + timedelta(days=1)  # Mínimo 1 día después del préstamo
-        
-        # Calcular los días entre la fecha mínima de devolución y hoy
-        days_range = (current_date - min_return_date).days
-        if days_range > 0:
-            # Si hay al menos un día de diferencia, elegir una fecha aleatoria en ese rango
-            days_after = random.randint(0, days_range)
-            fecha_devolucion = min_return_date + timedelta(days=days_after)
-        else:
-            # Si la fecha mínima ya es hoy o después, usar esa fecha
-            fecha_devolucion = min_return_date
-        
-        # Verificación final para garantizar que fecha_devolucion > fecha_prestamo
-        assert fecha_devolucion > fecha_prestamo, f"Error: fecha_devolucion ({fecha_devolucion}) <= fecha_prestamo ({fecha_prestamo})"
-        
-        # Crear el préstamo
-        Prestec.objects.create(
-            usuari=usuario,
-            exemplar=ejemplar,
-            data_prestec=fecha_prestamo,
-            data_retorn=fecha_devolucion,
-            anotacions=fake.sentence() if random.random() < 0.3 else None
-        )
-        
-        if i % 50 == 0:
-            print(f"Creados {i} préstamos...")
-    
-    # Crear reservas (100 unidades)
-    for i in range(100):
-        Reserva.objects.create(
-            usuari=random.choice(usuarios),
-            exemplar=random.choice(ejemplares),
-            data=fake.date_between(start_date='-6m', end_date='today')
-        )
 
 def main():
+    parser = argparse.ArgumentParser(description="Genera datos de prueba para la biblioteca")
+    parser.add_argument("--escala", choices=ESCALAS, default="mini")
+    parser.add_argument("--semilla", type=int, default=1234, help="misma semilla, mismos datos")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1,
+                        help="procesos que generan filas con Faker")
+    parser.add_argument("--lote", type=int, default=LOTE, help="filas por INSERT")
+    parser.add_argument("--limpiar", action="store_true", help="borra los datos existentes antes de empezar")
+    for nombre in ESCALAS["mini"]:
+        parser.add_argument(f"--{nombre}", type=int, help=f"sustituye el número de {nombre} de la escala")
+    args = parser.parse_args()
+
+    tamanos = dict(ESCALAS[args.escala])
+    tamanos.update({k: getattr(args, k) for k in tamanos if getattr(args, k) is not None})
+
     print("=== INICIANDO GENERACIÓN DE DATOS DE PRUEBA ===")
-    print("Este proceso puede tardar varios minutos...")
-    
-    # Limpiar base de datos
-    # limpiar_db()
-    
-    crear_categorias()
-    crear_paises_y_lenguas()
-    crear_autores_y_libros()
-    # crear_otros_materiales()
-    crear_usuarios_y_prestamos()
-    
+    print(f"Escala {args.escala}: {tamanos}, semilla {args.semilla}, {args.procesos} procesos")
+    inicio = time.perf_counter()
+
+    if args.limpiar:
+        limpiar_db()
+
+    seeder = Seeder(tamanos, args.semilla, args.procesos, args.lote)
+    seeder.crear_categorias()
+    seeder.crear_paises_y_lenguas()
+    seeder.crear_catalogo()
+    seeder.crear_usuarios()
+    seeder.crear_prestamos()
+    seeder.finalizar()
+    # las reservas necesitan los contadores de ejemplares prestables
+    seeder.crear_reservas()
+    comptadors.recompta()
+
     print("=== GENERACIÓN DE DATOS COMPLETADA ===")
     print(f"Total libros creados: {Llibre.objects.count()}")
     print(f"Total ejemplares creados: {Exemplar.objects.count()}")
     print(f"Total usuarios creados: {Usuari.objects.count()}")
     print(f"Total préstamos creados: {Prestec.objects.count()}")
+    print(f"Tiempo: {time.perf_counter() - inicio:.1f} s")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()